@@ -1,7 +1,45 @@
+import logging
+import os
+import threading
 from flask import Flask
 
 app = Flask(__name__)
 app.config.from_pyfile('../config.local')
+# Optional overrides (such as a benchmark or staging setup), named by PYBINDER_SETTINGS
+app.config.from_envvar('PYBINDER_SETTINGS', silent=True)
 
-from app import views
+# Objects with background threads (they have a start method). Threads don't
+# survive a fork (and a thread running in the parent could hold a lock the
+# child inherits), so they are started only in the process serving requests:
+# by each worker after the fork, or on the first request.
+background_services = []
+_services_pid = None
+_services_lock = threading.Lock()
+
+@app.before_request
+def start_background_services():
+    """
+    Start the background services, once per process
+    """
+    global _services_pid # pylint: disable=global-statement
+    if _services_pid == os.getpid():
+        return
+    with _services_lock:
+        if _services_pid != os.getpid():
+            for service in background_services:
+                service.start()
+            _services_pid = os.getpid()
 
+def add_log_handler():
+    """
+    Send informational log messages (who changes what) to LOGFILE, if configured
+    """
+    if 'LOGFILE' in app.config:
+        handler = logging.FileHandler(app.config['LOGFILE'])
+        handler.setLevel(logging.INFO)
+        handler.setFormatter(logging.Formatter(fmt='%(asctime)s : %(message)s'))
+        app.logger.addHandler(handler)
+        # Without debug, Flask's logger only passes on warnings
+        app.logger.setLevel(logging.INFO)
+
+from app import views
@@ -0,0 +1,280 @@
+"""
+Free address allocation within SUBNETS. Each subnet has a bitmap (a Python
+int, one bit per address) of addresses with a PTR record, loaded by reverse
+zone transfer and kept current as the app adds and deletes records, so the
+next free addresses are found without a lookup per candidate.
+"""
+
+import ipaddress
+import threading
+import time
+import dns.exception
+import dns.query
+import dns.rdatatype
+import dns.reversename
+import dns.xfr
+import dns.zone
+from app import app
+from .functions import DNS_TIMEOUT, key_name, keyring, key_algorithm
+from .functions import lookup_many, reverse_zone_blocks, search_pool
+
+# Largest number of addresses tracked per subnet (bigger subnets, such as an
+# IPv6 /64, allocate from their first ALLOCATE_MAX_ADDRESSES addresses)
+ALLOCATE_MAX_ADDRESSES = app.config.get('ALLOCATE_MAX_ADDRESSES', 65536)
+# Seconds before a bitmap is reloaded, to pick up changes made outside the app
+ALLOCATE_REFRESH = app.config.get('ALLOCATE_REFRESH', 300)
+ALLOCATE_RESERVED = [ipaddress.ip_network(n) for n in app.config.get('ALLOCATE_RESERVED', ())]
+# Addresses looked up per pipelined batch, for a reverse zone the server won't transfer
+LOOKUP_BATCH = 256
+
+# Bits scanned per step when looking for free addresses
+WORD_BITS = 64
+WORD_BYTES = WORD_BITS // 8
+EMPTY_WORD = bytes(WORD_BYTES)
+
+
+class SubnetBitmap(object):
+    """
+    Occupancy bitmap of one subnet: bit i is set when the address at offset i
+    has a PTR record. Reserved addresses (network and broadcast addresses,
+    ALLOCATE_RESERVED) are kept in a separate mask and never handed out.
+    """
+
+    def __init__(self, network, max_addresses=ALLOCATE_MAX_ADDRESSES,
+                 reserved=ALLOCATE_RESERVED):
+        self.subnet = network
+        if network.num_addresses > max_addresses:
+            network = next(network.subnets(
+                new_prefix=network.max_prefixlen - (max_addresses.bit_length() - 1)))
+        self.network = network
+        self.first = int(network.network_address)
+        self.size = network.num_addresses
+        self.used = 0
+        self.loaded = None
+        self.stale = True
+        # The network (or subnet-router anycast) address, and the IPv4 broadcast address
+        self.reserved = 0
+        if self.subnet.max_prefixlen - self.subnet.prefixlen > 1:
+            self.reserved = 1
+            if self.subnet.version == 4 and self.subnet.num_addresses == self.size:
+                self.reserved |= 1 << (self.size - 1)
+        for block in reserved:
+            if block.version == network.version and block.overlaps(network):
+                start = max(int(block.network_address), self.first) - self.first
+                end = min(int(block.broadcast_address), self.first + self.size - 1) - self.first
+                self.reserved |= ((1 << (end - start + 1)) - 1) << start
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def offset(self, ip):
+        """ Return the bit for ip, or None if it is outside the bitmap """
+        ip = ipaddress.ip_address(ip)
+        if ip.version != self.network.version:
+            return None
+        offset = int(ip) - self.first
+        return offset if 0 <= offset < self.size else None
+
+    def mark(self, ip, used=True):
+        """ Record that ip now has (used) or no longer has a PTR record """
+        offset = self.offset(ip)
+        if offset is None:
+            return
+        with self._lock:
+            if used:
+                self.used |= 1 << offset
+            else:
+                self.used &= ~(1 << offset)
+            if self._pending is not None:
+                self._pending.append((offset, used))
+
+    def load(self, used):
+        """
+        Replace the bitmap with one built from a zone transfer, replaying any
+        marks made since begin_load (the transfer may have missed them)
+        """
+        with self._lock:
+            for offset, is_used in self._pending or ():
+                if is_used:
+                    used |= 1 << offset
+                else:
+                    used &= ~(1 << offset)
+            self.used = used
+            self._pending = None
+            self.loaded = time.monotonic()
+            self.stale = False
+
+    def begin_load(self):
+        """ Start recording marks, to replay over the bitmap being loaded """
+        with self._lock:
+            self._pending = []
+
+    def needs_load(self, refresh=ALLOCATE_REFRESH):
+        """ Return True if the bitmap must be (re)loaded before use """
+        return self.stale or self.loaded is None or \
+            (refresh and time.monotonic() - self.loaded > refresh)
+
+    def find_free(self, count, start=0, end=None, take=False):
+        """
+        Return up to count free addresses, lowest first, between offsets start
+        and end (inclusive). Words with no free bit are skipped whole, and within
+        a word the lowest free bit is isolated with x & -x. With take, the
+        addresses are marked used before the lock is released.
+        """
+        end = self.size - 1 if end is None else end
+        found = []
+        with self._lock:
+            free = (~(self.used | self.reserved) & ((1 << (end + 1)) - 1)) >> start
+            data = free.to_bytes((end - start + WORD_BITS) // WORD_BITS * WORD_BYTES, 'little')
+            for base in range(0, len(data), WORD_BYTES):
+                if data[base:base + WORD_BYTES] == EMPTY_WORD:
+                    continue
+                word = int.from_bytes(data[base:base + WORD_BYTES], 'little')
+                while word and len(found) < count:
+                    low = word & -word
+                    found.append(start + base * 8 + low.bit_length() - 1)
+                    word ^= low
+                if len(found) == count:
+                    break
+            if take:
+                for offset in found:
+                    self.used |= 1 << offset
+                if self._pending is not None:
+                    self._pending.extend((offset, True) for offset in found)
+        return [str(ipaddress.ip_address(self.first + offset)) for offset in found]
+
+    def free_count(self):
+        """ Return number of free addresses """
+        with self._lock:
+            return self.size - bin(self.used | self.reserved).count('1')
+
+
+class AddressAllocator(object):
+    """
+    Bitmaps for every subnet in SUBNETS, loaded on first use (and when stale)
+    by transferring the reverse zones covering them from server
+    """
+
+    def __init__(self, subnets, server, port=53):
+        self.server = server
+        self.port = port
+        self.bitmaps = [SubnetBitmap(network) for network in subnets or []]
+        self.loads = 0
+        self.allocations = 0
+        self._load_lock = threading.Lock()
+
+    def bitmap_for(self, network):
+        """ Return the bitmap of the configured subnet holding network, or None """
+        for bitmap in self.bitmaps:
+            subnet = bitmap.subnet
+            if network.version == subnet.version and \
+                    subnet.network_address <= network.network_address and \
+                    network.broadcast_address <= subnet.broadcast_address:
+                return bitmap
+        return None
+
+    def _transfer(self, origin):
+        """ Return the addresses with a PTR record in reverse zone origin """
+        zone = dns.zone.Zone(origin)
+        query, _ = dns.xfr.make_query(zone, keyring=keyring, keyname=key_name,
+                                      keyalgorithm=key_algorithm)
+        dns.query.inbound_xfr(self.server, zone, query, port=self.port, timeout=DNS_TIMEOUT)
+        addresses = []
+        for name, _ in zone.iterate_rdatasets(dns.rdatatype.PTR):
+            try:
+                addresses.append(dns.reversename.to_address(name.derelativize(zone.origin)))
+            except (dns.exception.SyntaxError, ValueError):
+                continue
+        return addresses
+
+    def _used(self, origin, blocks):
+        """
+        Return the addresses with a PTR record in reverse zone origin. If the
+        server refuses the transfer (or doesn't have the zone), the addresses of
+        blocks are looked up instead; a missing zone has none.
+        """
+        try:
+            return self._transfer(origin)
+        except dns.xfr.TransferError as err:
+            app.logger.info("allocate: transfer of " + origin + " failed (" + str(err) +
+                            "), looking up addresses instead")
+        addresses = []
+        for block in blocks:
+            candidates = iter(block)
+            while True:
+                batch = [str(ip) for _, ip in zip(range(LOOKUP_BATCH), candidates)]
+                if not batch:
+                    break
+                queries = [(ipaddress.ip_address(ip).reverse_pointer, 'PTR') for ip in batch]
+                addresses.extend(ip for ip, names in zip(batch, lookup_many(queries)) if names)
+        return addresses
+
+    def load(self, bitmap):
+        """ (Re)build bitmap from its reverse zones, transferred concurrently """
+        with self._load_lock:
+            if not bitmap.needs_load():
+                return
+            bitmap.begin_load()
+            used = 0
+            zones = reverse_zone_blocks(bitmap.network)
+            for addresses in search_pool.map(self._used, zones.keys(), zones.values()):
+                for ip in addresses:
+                    offset = bitmap.offset(ip)
+                    if offset is not None:
+                        used |= 1 << offset
+            bitmap.load(used)
+            self.loads += 1
+
+    def allocate(self, network, count, take=False):
+        """
+        Return (addresses, free): up to count free addresses in network (which
+        must be within SUBNETS) and how many remain free. With take, the
+        addresses are marked used, so concurrent callers get different ones.
+        """
+        network = ipaddress.ip_network(network, strict=False)
+        bitmap = self.bitmap_for(network)
+        if bitmap is None:
+            raise ValueError("Not authorized to allocate from " + str(network))
+        if bitmap.needs_load():
+            try:
+                self.load(bitmap)
+            except (EOFError, OSError, dns.exception.DNSException) as err:
+                raise ValueError("Unable to load " + str(bitmap.network) + ": " + str(err))
+        start = max(int(network.network_address) - bitmap.first, 0)
+        end = min(int(network.broadcast_address) - bitmap.first, bitmap.size - 1)
+        addresses = bitmap.find_free(count, start, end, take) if start <= end else []
+        self.allocations += 1
+        return addresses, bitmap.free_count()
+
+    def _bitmaps_of(self, addresses):
+        """ Yield (bitmap, address) for each address within a bitmap """
+        for ip in addresses:
+            for bitmap in self.bitmaps:
+                if bitmap.offset(ip) is not None:
+                    yield bitmap, ip
+                    break
+
+    def mark_used(self, *addresses):
+        """ Record that addresses now have PTR records """
+        for bitmap, ip in self._bitmaps_of(addresses):
+            bitmap.mark(ip, True)
+
+    def mark_free(self, *addresses):
+        """ Record that addresses no longer have PTR records """
+        for bitmap, ip in self._bitmaps_of(addresses):
+            bitmap.mark(ip, False)
+
+    def invalidate(self, *addresses):
+        """
+        Reload the bitmaps holding addresses (all bitmaps if none are given) on
+        next use, after a change whose effect on them isn't known
+        """
+        if not addresses:
+            for bitmap in self.bitmaps:
+                bitmap.stale = True
+        for bitmap, _ in self._bitmaps_of(addresses):
+            bitmap.stale = True
+
+    def stats(self):
+        """ Return load/allocation counters and free addresses across loaded subnets """
+        return {'loads': self.loads, 'allocations': self.allocations,
+                'free': sum(b.free_count() for b in self.bitmaps if b.loaded is not None)}
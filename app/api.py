@@ -2,58 +2,31 @@
 Collection of Flask-RESTFul Resources
 """
 
-import ipaddress
+import itertools
+import json
+import dns.exception
+from flask import Response, request, stream_with_context
 from flask_httpauth import HTTPBasicAuth
 from flask_restful import Resource, reqparse
-from .functions import searcher, manager
+from .functions import searcher, iter_search, manager, mirror, allocator, record_index
+from .functions import split_range_name, range_name
+from .audit import audit_log
 from .auth import SystemAuth
+from .batch import Batch
+from .history import history_store, parse_query
+from .jobs import job_queue
+from .plan import plan_range
+from .export import EXPORT_FORMATS, ExportError, parse_target, export_rows, render
+from .export import gzip_chunks, zone_serials
+from .httpcache import cache_headers, json_response, make_etag, max_age, not_modified
+from .metrics import count_error
+from .policy import name_allowed, address_allowed, addresses_allowed, range_allowed
+from .policy import is_address
 from managedns import ManageDNSError
-from app import app
 
 http_auth = HTTPBasicAuth()
 system_auth = SystemAuth()
 
-FORWARD_ZONE = app.config['FORWARD_ZONE']
-if 'ALLOWED_DOMAINS' in app.config:
-    ALLOWED_DOMAINS = [d for d in app.config['ALLOWED_DOMAINS']]
-else:
-    ALLOWED_DOMAINS = None
-
-if 'SUBNETS' in app.config:
-    SUBNETS = [ipaddress.ip_network(x) for x in app.config['SUBNETS']]
-else:
-    SUBNETS = None
-
-def name_allowed(name):
-    """ Return true if name is within the allowed domain list """
-    if not ALLOWED_DOMAINS:
-        return True
-    if '.' in name:
-        [hostname, domain] = name.split('.', 1)
-    else:
-        return True
-    if domain in ALLOWED_DOMAINS or domain == FORWARD_ZONE:
-        return True
-    return False
-
-def address_allowed(ip):
-    """ Return true if IP address is within the allowed subnet list """
-    if not SUBNETS:
-        return True
-    ip = ipaddress.ip_address(ip)
-    for sub in SUBNETS:
-        if ip in sub:
-            return True
-    return False
-
-def is_address(entry):
-    """ Checks if entry is a valid IP address """
-    try:
-        _ = ipaddress.ip_address(entry)
-    except ValueError:
-        return False
-    return True
-
 @http_auth.verify_password
 def verify_pwd(user, pwd):
     """
@@ -64,8 +37,55 @@ def verify_pwd(user, pwd):
 class SearchRecord(Resource):
     """ Represent a search query and result """
     def get(self, entry):
-        """ Return search result from get request """
-        return {entry: str(searcher.query(entry)).split(' ', 1)[1]}
+        """ Return search result from get request (cacheable for the record TTL) """
+        result = searcher.query(entry)
+        return json_response({entry: str(result).split(' ', 1)[1]},
+                             max_age([getattr(result, 'ttl', None)]))
+
+class PatternSearch(Resource):
+    """ Represent a prefix/glob name or CIDR address search """
+    def get(self, pattern):
+        """ Return {name or address: answer} for everything matching pattern """
+        if record_index is None:
+            return {'message': 'Error: pattern search is not enabled'}, 404
+        try:
+            answer = record_index.search(pattern)
+        except ValueError as err:
+            count_error(err)
+            return {'message': 'Error: ' + str(err)}, 400
+        return json_response(answer, max_age([]))
+
+class BulkSearch(Resource):
+    """ Represent many search queries, answered as newline-delimited JSON """
+    def post(self):
+        """
+        Return search results for a list of names and addresses, given as a JSON
+        list or as {"entries": [...]}. Each result is streamed as a {entry: answer}
+        line as soon as its lookup finishes, so results are not in request order
+        (gzip compressed, a line at a time, if the client accepts it).
+        """
+        entries = request.get_json(silent=True)
+        if isinstance(entries, dict):
+            entries = entries.get('entries')
+        if not isinstance(entries, list) or not all(isinstance(e, str) for e in entries):
+            return {'message': 'Error: expected a list of names and addresses'}, 400
+        def generate():
+            for entry, answer in iter_search(e.strip() for e in entries):
+                yield json.dumps({entry: answer}) + '\n'
+        chunks, headers = generate(), {'Vary': 'Accept-Encoding'}
+        if 'gzip' in request.accept_encodings:
+            chunks = gzip_chunks(chunks, flush=True)
+            headers['Content-Encoding'] = 'gzip'
+        return Response(stream_with_context(chunks), mimetype='application/x-ndjson',
+                        headers=headers)
+
+class MirrorStatus(Resource):
+    """ Represent the state of the local zone mirror """
+    def get(self):
+        """ Return serial and age (seconds since last check) of each mirrored zone """
+        if mirror is None:
+            return {'message': 'Error: zone mirror is not enabled'}, 404
+        return mirror.status()
 
 class AddRecord(Resource):
     """ Represent an A and PTR add """
@@ -83,14 +103,15 @@ class AddRecord(Resource):
         name = args['name']
         ip = args['address'].split(' ')
         try:
-            if not name_allowed(name):
-                raise ValueError("Not authorized to add " + name)
-            for addr in ip:
-                if not address_allowed(addr):
-                    raise ValueError("Not authorized to add " + addr)
-            answer = manager.add_record(name, ip, force)
+            with audit_log.action(http_auth.username(), 'replace' if force else 'add', name, ip):
+                if not name_allowed(name):
+                    raise ValueError("Not authorized to add " + name)
+                if not addresses_allowed(ip):
+                    raise ValueError("Not authorized to add " + ' '.join(ip))
+                answer = manager.add_record(name, ip, force)
             answer = [str(a) for a in answer]
         except (ManageDNSError, ValueError) as mde:
+            count_error(mde)
             return {'message': 'Error: ' + str(mde)}, 400
         return {'message': str(answer)}
 
@@ -110,11 +131,14 @@ class AddAlias(Resource):
         alias = args['alias']
         real_name = args['real_name']
         try:
-            if not name_allowed(alias):
-                raise ValueError("Not authorized to add " + alias)
-            answer = manager.add_alias(alias, real_name, force)
+            with audit_log.action(http_auth.username(), 'alias', alias) as entry:
+                entry['target'] = real_name
+                if not name_allowed(alias):
+                    raise ValueError("Not authorized to add " + alias)
+                answer = manager.add_alias(alias, real_name, force)
             answer = [str(a) for a in answer]
         except (ManageDNSError, ValueError) as mde:
+            count_error(mde)
             return {'message': 'Error: ' + str(mde)}, 400
         return {'message': str(answer)}
 
@@ -132,14 +156,293 @@ class DeleteRecord(Resource):
     def delete(self, entry):
         """ Remove record from delete request """
         try:
-            if is_address(entry):
-                if not address_allowed(entry):
-                    raise ValueError("Not authorized to delete " + entry)
-            else:
-                if not name_allowed(entry):
-                    raise ValueError("Not authorized to delete " + entry)
-            answer = manager.delete_record(entry)
+            with audit_log.action(http_auth.username(), 'delete', entry):
+                if is_address(entry):
+                    if not address_allowed(entry):
+                        raise ValueError("Not authorized to delete " + entry)
+                else:
+                    if not name_allowed(entry):
+                        raise ValueError("Not authorized to delete " + entry)
+                answer = manager.delete_record(entry)
             answer = [str(a) for a in answer]
         except (ManageDNSError, ValueError) as mde:
+            count_error(mde)
             return {'message': 'Error: ' + str(mde)}, 400
         return {'message': str(answer)}
+
+class BatchChange(Resource):
+    """ Represent many adds, aliases, replaces and deletes applied together """
+    decorators = [http_auth.login_required]
+
+    def post(self):
+        """
+        Apply a JSON list of operations (or {"operations": [...]}). Every operation
+        is authorized before anything is changed; changes are then sent as one
+        update per zone, and a result is returned for each operation (only for the
+        failed ones, with their positions, if any failed).
+        """
+        specs = request.get_json(silent=True)
+        if isinstance(specs, dict):
+            specs = specs.get('operations')
+        if not isinstance(specs, list) or not specs:
+            return {'message': 'Error: expected a list of operations'}, 400
+        try:
+            batch = Batch(specs)
+            for index, oper in enumerate(batch.operations):
+                if oper.is_address_delete():
+                    allowed = address_allowed(oper.name)
+                else:
+                    allowed = name_allowed(oper.name)
+                    allowed = allowed and addresses_allowed(oper.addresses)
+                if not allowed:
+                    raise ValueError("Operation " + str(index) + ": not authorized to " +
+                                     oper.op + " " + oper.name)
+        except ValueError as err:
+            count_error(err)
+            return {'message': 'Error: ' + str(err)}, 400
+        try:
+            with audit_log.action(http_auth.username(), 'batch', count=len(specs)) as entry:
+                results = batch.apply()
+                entry['failed'] = sum(1 for oper in batch.operations if oper.errors)
+        except ValueError as err:
+            count_error(err)
+            return {'message': 'Error: ' + str(err)}, 400
+        except (OSError, EOFError, dns.exception.DNSException) as err:
+            count_error(err)
+            return {'message': 'Error: unable to reach DNS server: ' + str(err)}, 503
+        if batch.failed():
+            return {'messages': batch.messages, 'results': batch.failures()}, 400
+        return {'messages': batch.messages, 'results': results}
+
+class RangeJob(Resource):
+    """ Represent a range add, replace or delete, run as a background job """
+    decorators = [http_auth.login_required]
+
+    def __init__(self):
+        super()
+        self.parser = reqparse.RequestParser()
+        self.parser.add_argument('action', type=str, choices=('add', 'replace', 'delete'),
+                                 help='add, replace or delete', required=True)
+        self.parser.add_argument('name', type=str, help='First hostname/FQDN (or IP address,'
+                                 ' for delete)', required=True)
+        self.parser.add_argument('address', type=str, help='First IP address (add/replace)')
+        self.parser.add_argument('num', type=int, help='Number of entries', required=True)
+        self.parser.add_argument('start_index', type=str, help='Starting index (optional)')
+
+    def post(self):
+        """ Submit range job from post request, returning its ID """
+        args = self.parser.parse_args()
+        action = 'range-' + args['action']
+        name = args['name'].strip()
+        num = args['num']
+        try:
+            if num < 1:
+                raise ValueError("Number of entries must be positive")
+            if action == 'range-delete':
+                address = None
+                allowed = range_allowed(name, num) if is_address(name) else name_allowed(name)
+            else:
+                address = (args['address'] or '').strip()
+                if not address:
+                    raise ValueError("An address is required to " + args['action'])
+                allowed = name_allowed(name) and range_allowed(address, num)
+            if not allowed:
+                raise ValueError("Not authorized to " + args['action'] + " " + str(num) +
+                                 " entries from " + name)
+            job_id = job_queue.submit(http_auth.username(), action, name, address, num,
+                                      args['start_index'])
+            audit_log.record(http_auth.username(), action + '-submit', name,
+                             [address] if address else [], num, job=job_id,
+                             start_index=args['start_index'])
+        except ValueError as err:
+            count_error(err)
+            return {'message': 'Error: ' + str(err)}, 400
+        return {'job': job_id, 'status': '/api/jobs/' + job_id}, 202
+
+class RangePlan(RangeJob):
+    """ Represent the changes a range add or replace would make (nothing is changed) """
+
+    def post(self):
+        """ Return planned changes (create, replace, delete, conflict) from post request """
+        args = self.parser.parse_args()
+        name = args['name'].strip()
+        address = (args['address'] or '').strip()
+        num = args['num']
+        try:
+            if args['action'] == 'delete':
+                raise ValueError("Only range add and replace can be planned")
+            if num < 1:
+                raise ValueError("Number of entries must be positive")
+            if not address:
+                raise ValueError("An address is required to " + args['action'])
+            if not (name_allowed(name) and range_allowed(address, num)):
+                raise ValueError("Not authorized to " + args['action'] + " " + str(num) +
+                                 " entries from " + name)
+            plan = plan_range(name, address, num, args['start_index'],
+                              force=args['action'] == 'replace')
+        except ValueError as err:
+            count_error(err)
+            return {'message': 'Error: ' + str(err)}, 400
+        except (OSError, EOFError, dns.exception.DNSException) as err:
+            count_error(err)
+            return {'message': 'Error: unable to reach DNS server: ' + str(err)}, 503
+        return plan
+
+class JobStatus(Resource):
+    """ Represent a range job """
+    decorators = [http_auth.login_required]
+
+    @staticmethod
+    def _job(job_id):
+        """ Return the job if it belongs to the current user """
+        job = job_queue.store.get(job_id)
+        if job is None or job['user'] != http_auth.username():
+            return None
+        return job
+
+    def get(self, job_id):
+        """ Return job status and progress (records done vs. total) """
+        job = self._job(job_id)
+        if job is None:
+            return {'message': 'Error: no such job ' + job_id}, 404
+        return job
+
+    def delete(self, job_id):
+        """ Cancel job """
+        job = self._job(job_id)
+        if job is None:
+            return {'message': 'Error: no such job ' + job_id}, 404
+        job_queue.cancel(job_id)
+        audit_log.record(http_auth.username(), 'cancel', job['name'], job=job_id)
+        return self._job(job_id)
+
+class Allocate(Resource):
+    """ Represent the next free addresses of a subnet, optionally added as hosts """
+    decorators = [http_auth.login_required]
+
+    def __init__(self):
+        super()
+        self.parser = reqparse.RequestParser()
+        self.parser.add_argument('subnet', type=str, help='Subnet (within SUBNETS)',
+                                 required=True)
+        self.parser.add_argument('count', type=int, help='Number of addresses', default=1)
+        self.parser.add_argument('name', type=str, help='Hostname/FQDN to add (the first of'
+                                 ' a range, if count is more than 1)')
+        self.parser.add_argument('start_index', type=str, help='Starting index (optional)')
+
+    def post(self):
+        """
+        Return the next count free addresses of subnet. With a name, they are
+        also added (name, or a range of names like a range add) in one batch.
+        Addresses are reserved only in this process's bitmap, so across worker
+        processes the batch's prerequisite that each name and address has no
+        records is the only guard against handing one out twice: if it fails
+        (another request took the address first), the response is 409.
+        """
+        args = self.parser.parse_args()
+        count = args['count']
+        name = (args['name'] or '').strip()
+        try:
+            if count < 1:
+                raise ValueError("Number of addresses must be positive")
+            if name:
+                if count > 1 or args['start_index']:
+                    prefix, index, width, domain = split_range_name(name, args['start_index'])
+                    names = [range_name(prefix, index + i, width, domain) for i in range(count)]
+                else:
+                    names = [name]
+                for entry in names:
+                    if not name_allowed(entry):
+                        raise ValueError("Not authorized to add " + entry)
+            addresses, free = allocator.allocate(args['subnet'], count, take=bool(name))
+            if len(addresses) < count:
+                raise ValueError("Only " + str(len(addresses)) + " free addresses in " +
+                                 args['subnet'])
+        except ValueError as err:
+            count_error(err)
+            return {'message': 'Error: ' + str(err)}, 400
+        if not name:
+            return {'subnet': args['subnet'], 'addresses': addresses, 'free': free}
+        batch = Batch([{'op': 'add', 'name': n, 'address': a} for n, a in zip(names, addresses)])
+        try:
+            with audit_log.action(http_auth.username(), 'allocate', names[0], addresses,
+                                  count) as entry:
+                results = batch.apply()
+                entry['failed'] = sum(1 for oper in batch.operations if oper.errors)
+        except (OSError, EOFError, dns.exception.DNSException) as err:
+            allocator.invalidate(*addresses)
+            count_error(err)
+            return {'message': 'Error: unable to reach DNS server: ' + str(err)}, 503
+        if batch.failed():
+            return {'subnet': args['subnet'], 'addresses': addresses, 'free': free,
+                    'results': batch.failures()}, 409 if batch.conflicted() else 400
+        return {'subnet': args['subnet'], 'addresses': addresses, 'free': free,
+                'results': results}
+
+class Export(Resource):
+    """ Represent every record of a subnet (PTR) or domain (A, AAAA, CNAME) """
+    decorators = [http_auth.login_required]
+
+    def get(self, target):
+        """
+        Stream the records as CSV (?format=csv, the default) or newline-delimited
+        JSON (?format=ndjson), gzip compressed if the client accepts it. The ETag
+        is made from the serials of the zones read, so a client with a current
+        copy gets 304 Not Modified without anything being transferred. The first
+        records are read before the response starts, so an export that can't be
+        started is an error (without an ETag), not a cacheable error body.
+        """
+        fmt = request.args.get('format', 'csv')
+        try:
+            if fmt not in EXPORT_FORMATS:
+                raise ExportError("Format must be one of " + ', '.join(EXPORT_FORMATS))
+            network, domain = parse_target(target)
+        except ExportError as err:
+            count_error(err)
+            return {'message': 'Error: ' + str(err)}, 400
+        try:
+            serials = zone_serials(network, domain)
+        except (OSError, EOFError, dns.exception.DNSException):
+            serials = None
+        etag = make_etag(target, fmt, *serials) if serials else None
+        if etag:
+            unchanged = not_modified(etag, max_age([]))
+            if unchanged is not None:
+                return unchanged
+        rows = export_rows(network, domain)
+        try:
+            first = next(rows, None)
+        except (ExportError, EOFError, OSError, dns.exception.DNSException) as err:
+            count_error(err)
+            return {'message': 'Error: unable to export ' + target + ': ' + str(err)}, 503, \
+                   {'Cache-Control': 'no-store'}
+        if first is not None:
+            rows = itertools.chain([first], rows)
+        chunks = render(rows, fmt)
+        headers = {'Content-Disposition': 'attachment; filename="' +
+                                          target.replace('/', '_') + '.' + fmt + '"',
+                   'Vary': 'Accept-Encoding'}
+        if 'gzip' in request.accept_encodings:
+            chunks = gzip_chunks(chunks)
+            headers['Content-Encoding'] = 'gzip'
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+        response = Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+        return cache_headers(response, etag, max_age([])) if etag else response
+
+class History(Resource):
+    """ Represent a page of the user's modification history """
+    decorators = [http_auth.login_required]
+
+    def get(self):
+        """
+        Return up to ?limit= entries (newest first) older than the ?before= cursor,
+        filtered by ?action=, ?name=, ?address=, ?since= and ?until=, and the
+        cursor of the next page (null on the last page)
+        """
+        try:
+            query = parse_query(request.args)
+        except ValueError as err:
+            count_error(err)
+            return {'message': 'Error: ' + str(err)}, 400
+        entries, cursor = history_store.page(http_auth.username(), **query)
+        return {'entries': entries, 'next': cursor}
@@ -0,0 +1,184 @@
+"""
+Audit log of every change made through the views and the API, as JSON lines
+(user, action, name, addresses, count, result, duration). Requests only put a
+record on a bounded queue; a background thread writes them out in batches,
+so a slow disk doesn't hold up the change being made. Records that don't fit
+on the queue are dropped and counted rather than waited for.
+"""
+
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from app import app, background_services
+from .metrics import StatsGauge
+
+AUDIT_LOG = app.config.get('AUDIT_LOG')
+AUDIT_MAX_BYTES = app.config.get('AUDIT_MAX_BYTES', 10 * 1024 * 1024)
+AUDIT_BACKUPS = app.config.get('AUDIT_BACKUPS', 5)
+AUDIT_QUEUE_SIZE = app.config.get('AUDIT_QUEUE_SIZE', 10000)
+AUDIT_BATCH_SIZE = app.config.get('AUDIT_BATCH_SIZE', 256)
+AUDIT_FLUSH_INTERVAL = app.config.get('AUDIT_FLUSH_INTERVAL', 1.0)
+
+
+class AuditLog(object):
+    """
+    Queue of audit records, written by a background thread to path (rotated
+    once it reaches max_bytes, keeping backups old files) or, without a path,
+    to the application log. Several worker processes can share one file: lines
+    are appended whole, and a writer reopens the file when another has rotated it.
+    """
+
+    def __init__(self, path=AUDIT_LOG, max_bytes=AUDIT_MAX_BYTES, backups=AUDIT_BACKUPS,
+                 queue_size=AUDIT_QUEUE_SIZE, batch_size=AUDIT_BATCH_SIZE,
+                 flush_interval=AUDIT_FLUSH_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.rotations = 0
+        self._queue = queue.Queue(queue_size)
+        self._file = None
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+    def record(self, user, action, name=None, addresses=(), count=None, result='ok',
+               duration=None, **extra):
+        """ Queue an audit record, dropping it (and counting the drop) if the queue is full """
+        entry = {'time': time.time(), 'user': user, 'action': action, 'name': name,
+                 'addresses': list(addresses or []), 'count': count, 'result': result,
+                 'duration_ms': None if duration is None else round(duration * 1000, 2)}
+        entry.update(extra)
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    @contextmanager
+    def action(self, user, action, name=None, addresses=(), count=None):
+        """
+        Audit the block as one action, timed, with result 'ok' or the error
+        it raised (which is re-raised). The block can add fields to the
+        record it is given.
+        """
+        entry = {}
+        start = time.perf_counter()
+        result = 'ok'
+        try:
+            yield entry
+        except Exception as err:
+            result = 'error: ' + str(err)
+            raise
+        finally:
+            self.record(user, action, name, addresses, count, result,
+                        time.perf_counter() - start, **entry)
+
+    def start(self):
+        """ Start the writer thread """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='audit-log', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """ Write queued records, a batch at a time """
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            self._write(self._drain(batch))
+
+    def _drain(self, batch):
+        """ Add records already queued to batch, up to batch_size """
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self):
+        """ Write everything queued now (at exit, or for tests) """
+        while not self._queue.empty():
+            self._write(self._drain([]))
+
+    def _open(self):
+        """ Return the open log file, reopening it if another process rotated it """
+        if self._file is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self._file.fileno()).st_ino:
+                    return self._file
+            except OSError:
+                pass
+            self._file.close()
+        self._file = open(self.path, 'a')
+        return self._file
+
+    def _rotate(self):
+        """
+        Move the log to path.1 (and older logs along), keeping backups of them,
+        unless another process has already rotated the file this one has open
+        """
+        try:
+            rotated = os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            rotated = True
+        self._file.close()
+        self._file = None
+        if rotated:
+            return
+        for index in range(self.backups - 1, 0, -1):
+            source = self.path + '.' + str(index)
+            if os.path.exists(source):
+                os.replace(source, self.path + '.' + str(index + 1))
+        if self.backups:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+
+    def _write(self, batch):
+        """ Write a batch of records and flush once """
+        if not batch:
+            return
+        lines = ''.join(json.dumps(entry, sort_keys=True) + '\n' for entry in batch)
+        with self._write_lock:
+            if self.path is None:
+                for line in lines.splitlines():
+                    app.logger.info(line)
+            else:
+                try:
+                    out = self._open()
+                    out.write(lines)
+                    out.flush()
+                except OSError as err:
+                    self.dropped += len(batch)
+                    app.logger.warning("audit: unable to write " + self.path + ": " + str(err))
+                    return
+                if self.max_bytes and out.tell() >= self.max_bytes:
+                    try:
+                        self._rotate()
+                    except OSError as err:
+                        # The records are written; rotation is tried again after the next batch
+                        app.logger.warning("audit: unable to rotate " + self.path + ": " +
+                                           str(err))
+            self.written += len(batch)
+            self.batches += 1
+
+    def stats(self):
+        """ Return records written, dropped and queued, batches and rotations """
+        return {'written': self.written, 'dropped': self.dropped, 'queued': self._queue.qsize(),
+                'batches': self.batches, 'rotations': self.rotations}
+
+
+audit_log = AuditLog()
+atexit.register(audit_log.flush)
+background_services.append(audit_log)
+StatsGauge('pybinder_audit_log', 'Audit records written, dropped and queued.', audit_log)
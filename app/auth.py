@@ -2,14 +2,102 @@
 Simple class to manage system authentication through PAM
 """
 
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
 from pam import pam
 from app import app
+from .metrics import pam_seconds, StatsGauge
+from .timing import timed
 
 if 'USERS' in app.config:
     ALLOWED_USERS = app.config['USERS']
 else:
     ALLOWED_USERS = None
 
+AUTH_CACHE_TTL = app.config.get('AUTH_CACHE_TTL', 300)
+AUTH_CACHE_SIZE = app.config.get('AUTH_CACHE_SIZE', 1024)
+
+class CredentialCache(object):
+    """
+    Bounded cache of recently verified credentials, so that repeat requests
+    from the same user do not need a full PAM conversation. Passwords are never
+    stored, only a salted hash (keyed with a random per-process salt). Entries
+    expire after ttl seconds and the least recently used entry is evicted once
+    max_entries is reached. Only successful authentications are cached.
+    """
+
+    def __init__(self, ttl=AUTH_CACHE_TTL, max_entries=AUTH_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._salt = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _verifier(self, user, pwd):
+        """ Return salted hash of the user and password """
+        message = (user + '\0' + pwd).encode('utf-8')
+        return hmac.new(self._salt, message, hashlib.sha256).digest()
+
+    def check(self, user, pwd):
+        """
+        Return True if user and pwd match an unexpired cached entry
+        """
+        if not self.ttl or not self.max_entries:
+            return False
+        verifier = self._verifier(user, pwd)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user)
+            if entry and entry[1] > now and hmac.compare_digest(entry[0], verifier):
+                self._entries.move_to_end(user)
+                self.hits += 1
+                return True
+            if entry and entry[1] <= now:
+                del self._entries[user]
+            self.misses += 1
+        return False
+
+    def add(self, user, pwd):
+        """
+        Remember a successful authentication for user
+        """
+        if not self.ttl or not self.max_entries:
+            return
+        verifier = self._verifier(user, pwd)
+        with self._lock:
+            self._entries[user] = (verifier, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user=None):
+        """
+        Forget the cached entry for user (or all entries, if no user given)
+        """
+        with self._lock:
+            if user is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user, None)
+
+    def stats(self):
+        """
+        Return hit/miss counters and current size
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+# Shared by every SystemAuth instance (API and web views)
+credential_cache = CredentialCache()
+StatsGauge('pybinder_auth_cache', 'PAM credential cache counters and size.', credential_cache)
+
 class SystemAuth(object):
     """
     Rely on PAM for system authentication verification
@@ -17,16 +105,27 @@ class SystemAuth(object):
 
     auth_service = 'login'
 
-    def __init__(self):
+    def __init__(self, cache=credential_cache):
         self.auth = pam()
         self.service = self.__class__.auth_service
+        self.cache = cache
 
+    @timed('auth')
     def authenticate(self, user, pwd):
         """
-        Use PAM module to verify credentials against system
+        Use PAM module to verify credentials against system, skipping PAM when
+        the same credentials were recently verified
         """
         if ALLOWED_USERS and user in ALLOWED_USERS:
-            return self.auth.authenticate(user, pwd, service=self.service)
+            if self.cache.check(user, pwd):
+                return True
+            start = time.perf_counter()
+            authenticated = self.auth.authenticate(user, pwd, service=self.service)
+            pam_seconds.observe(time.perf_counter() - start,
+                                result='success' if authenticated else 'failure')
+            if authenticated:
+                self.cache.add(user, pwd)
+                return True
         return False
 
     def change_service(self, new_service):
@@ -34,3 +133,4 @@ class SystemAuth(object):
         Change to another PAM service (no validation performed)
         """
         self.service = new_service
+        self.cache.invalidate()
@@ -0,0 +1,386 @@
+"""
+Apply many DNS changes at once, combined into as few dynamic update messages
+as possible (one per zone, split only when very large)
+"""
+
+import ipaddress
+from collections import OrderedDict
+import dns.name
+import dns.rcode
+import dns.reversename
+import dns.update
+from app import app
+from .functions import key_name, keyring, key_algorithm
+from .functions import qualify, forward_zone_for, reverse_zone_for, address_type
+from .functions import lookup_many, lookup_rrsets, searcher, dns_pool, allocator
+from .metrics import dns_update_seconds
+from .timing import span
+
+RECORD_TTL = app.config.get('RECORD_TTL', 3600)
+BATCH_MAX_CHANGES = app.config.get('BATCH_MAX_CHANGES', 1000)
+OPERATIONS = ('add', 'replace', 'alias', 'delete')
+# Record types removed when a name is deleted or replaced (and restored by a rollback)
+NAME_TYPES = ('A', 'AAAA', 'CNAME')
+# Update rcodes meaning a prerequisite failed (something changed since the batch was checked)
+PREREQUISITE_RCODES = (dns.rcode.YXDOMAIN, dns.rcode.YXRRSET, dns.rcode.NXDOMAIN,
+                       dns.rcode.NXRRSET)
+
+
+class BatchOperation(object):
+    """
+    A single add, replace, alias or delete within a batch
+    """
+
+    def __init__(self, spec):
+        if not isinstance(spec, dict) or spec.get('op') not in OPERATIONS:
+            raise ValueError("Operation must be one of " + ', '.join(OPERATIONS))
+        self.op = spec['op']
+        self.force = self.op == 'replace' or bool(spec.get('force'))
+        self.addresses = []
+        self.real_name = None
+        self.changes = []
+        self.errors = []
+        # Whether it failed because its name or address already had records
+        self.conflict = False
+        # Zones whose update for this operation has been applied
+        self.applied = []
+        if self.op in ('add', 'replace'):
+            self.name = qualify(spec['name'])
+            addresses = spec['address']
+            if isinstance(addresses, str):
+                addresses = addresses.split()
+            self.addresses = [str(ipaddress.ip_address(a)) for a in addresses]
+        elif self.op == 'alias':
+            self.name = qualify(spec['alias'])
+            self.real_name = qualify(spec['real_name'])
+        else:
+            self.name = spec['entry'].strip().lower().rstrip('.')
+            try:
+                self.name = str(ipaddress.ip_address(self.name))
+                self.addresses = [self.name]
+            except ValueError:
+                self.name = qualify(self.name)
+
+    def is_address_delete(self):
+        """ Return True if this deletes by IP address """
+        return self.op == 'delete' and self.addresses == [self.name]
+
+    def change(self, zone, action, name, rdtype=None, rdata=None):
+        """ Record a change to make in zone """
+        self.changes.append((zone, action, name, rdtype, rdata))
+
+    def result(self):
+        """ Return result summary for this operation (its changes, not prerequisites) """
+        result = {'op': self.op, 'entry': self.name}
+        if self.errors:
+            result['message'] = 'Error: ' + '; '.join(self.errors)
+        else:
+            result['message'] = str([' '.join(str(c) for c in change[1:] if c)
+                                     for change in self.changes if change[1] != 'absent'])
+        return result
+
+
+class Batch(object):
+    """
+    Collection of BatchOperations, planned and sent per zone. Conflicting
+    operations are found (and left out) before anything is sent, the rest of
+    each zone's changes go in one update message, and an operation that fails
+    in one zone has its changes in the other zones rolled back.
+    """
+
+    def __init__(self, specs):
+        self.operations = []
+        self.messages = 0
+        self.existing = {}
+        for index, spec in enumerate(specs):
+            try:
+                self.operations.append(BatchOperation(spec))
+            except (KeyError, TypeError, ValueError) as err:
+                if isinstance(err, KeyError):
+                    err = 'missing ' + str(err)
+                raise ValueError('Operation ' + str(index) + ': ' + str(err))
+
+    def _existing(self):
+        """
+        Look up (pipelined) the records that forced changes and deletes remove,
+        with their TTLs, so they can be cleaned up and, after a failure, put
+        back as they were: the NAME_TYPES records of names, the PTRs of
+        addresses, and the addresses of the names those PTRs point to. Return
+        {(name, rdtype): (ttl, records)}.
+        """
+        queries = set()
+        for oper in self.operations:
+            if oper.is_address_delete() or (oper.force and oper.addresses):
+                queries.update((ipaddress.ip_address(a).reverse_pointer, 'PTR')
+                               for a in oper.addresses)
+            if not oper.is_address_delete() and (oper.force or oper.op == 'delete'):
+                queries.update((oper.name, rdtype) for rdtype in NAME_TYPES)
+        existing = self._lookup(queries)
+        names = set(name.lower() for (_, rdtype), (_, records) in existing.items()
+                    if rdtype == 'PTR' for name in records)
+        existing.update(self._lookup(set((name, rdtype) for name in names
+                                         for rdtype in ('A', 'AAAA')) - set(existing)))
+        return existing
+
+    @staticmethod
+    def _lookup(queries):
+        """ Return {(name, rdtype): (ttl, records)} for queries """
+        queries = list(queries)
+        return dict(zip(queries, lookup_rrsets(queries))) if queries else {}
+
+    @staticmethod
+    def _remove_address(oper, name, ip):
+        """ Remove the A/AAAA and PTR records pairing name and ip """
+        oper.change(forward_zone_for(name), 'delete', name, address_type(ip), ip)
+        oper.change(reverse_zone_for(ip), 'delete', ipaddress.ip_address(ip).reverse_pointer,
+                    'PTR', name + '.')
+
+    def plan(self):
+        """
+        Work out the changes each operation makes, per zone. Deleting a name
+        (or an address) deletes its NAME_TYPES (or PTR) records by type, so a
+        rollback knows everything the delete removed.
+        """
+        self.existing = existing = self._existing()
+        for oper in self.operations:
+            if oper.is_address_delete():
+                pointer = ipaddress.ip_address(oper.name).reverse_pointer
+                for name in existing.get((pointer, 'PTR'), (None, []))[1]:
+                    self._remove_address(oper, name.lower(), oper.name)
+                oper.change(reverse_zone_for(oper.name), 'delete', pointer, 'PTR')
+                continue
+            name_zone = forward_zone_for(oper.name)
+            if oper.force or oper.op == 'delete':
+                for rdtype in ('A', 'AAAA'):
+                    for ip in existing.get((oper.name, rdtype), (None, []))[1]:
+                        self._remove_address(oper, oper.name, ip)
+                for rdtype in NAME_TYPES:
+                    oper.change(name_zone, 'delete', oper.name, rdtype)
+            else:
+                oper.change(name_zone, 'absent', oper.name)
+            if oper.op == 'alias':
+                oper.change(name_zone, 'add', oper.name, 'CNAME', oper.real_name + '.')
+            for ip in oper.addresses:
+                pointer = ipaddress.ip_address(ip).reverse_pointer
+                ptr_zone = reverse_zone_for(ip)
+                if oper.force:
+                    for name in existing.get((pointer, 'PTR'), (None, []))[1]:
+                        if name.lower() != oper.name:
+                            self._remove_address(oper, name.lower(), ip)
+                    oper.change(ptr_zone, 'delete', pointer, 'PTR')
+                else:
+                    oper.change(ptr_zone, 'absent', pointer)
+                oper.change(name_zone, 'add', oper.name, address_type(ip), ip)
+                oper.change(ptr_zone, 'add', pointer, 'PTR', oper.name + '.')
+        self._check_overlaps()
+
+    def _check_overlaps(self):
+        """
+        Raise ValueError if an operation (unless forced) adds a name or address
+        that another operation in the batch also adds or deletes. The server
+        checks every prerequisite of an update before making any of its
+        changes, so operations in one batch never see each other's records.
+        """
+        changed = {}
+        for index, oper in enumerate(self.operations):
+            for _, action, name, _, _ in oper.changes:
+                if action in ('add', 'delete'):
+                    changed.setdefault(name, set()).add(index)
+        for index, oper in enumerate(self.operations):
+            if oper.force:
+                continue
+            for _, action, name, _, _ in oper.changes:
+                others = changed[name] - {index} if action == 'add' else None
+                if others:
+                    if name.endswith('.arpa'):
+                        name = dns.reversename.to_address(dns.name.from_text(name))
+                    first, second = sorted([index, min(others)])
+                    raise ValueError('Operations ' + str(first) + ' and ' + str(second) +
+                                     ' both change ' + name +
+                                     ' (use replace or force to allow this)')
+
+    def check_conflicts(self):
+        """
+        Fail (before anything is sent) the operations that add a name or
+        address that already has records, so they don't fail the rest of
+        their zone's update
+        """
+        queries = []
+        for oper in self.operations:
+            for _, action, name, _, _ in oper.changes:
+                if action == 'absent':
+                    rdtypes = ('PTR',) if name.endswith('.arpa') else ('A', 'AAAA', 'CNAME')
+                    queries.extend((oper, name, rdtype) for rdtype in rdtypes)
+        if not queries:
+            return
+        results = lookup_many([(name, rdtype) for _, name, rdtype in queries])
+        for (oper, name, rdtype), records in zip(queries, results):
+            if records and not oper.errors:
+                oper.errors.append(name + ' already exists (' + rdtype + ' ' + records[0] + ')')
+                oper.conflict = True
+
+    @staticmethod
+    def _update(zone, changes, ttls=None):
+        """
+        Return an update message making changes in zone. Added records get
+        RECORD_TTL, or their TTL from ttls ({(name, rdtype): (ttl, records)}).
+        """
+        update = dns.update.Update(zone, keyring=keyring, keyname=key_name,
+                                   keyalgorithm=key_algorithm)
+        for _, action, name, rdtype, rdata in changes:
+            owner = dns.name.from_text(name)
+            if action == 'absent':
+                update.absent(owner)
+            elif action == 'delete' and rdata:
+                update.delete(owner, rdtype, rdata)
+            elif action == 'delete':
+                update.delete(owner, rdtype)
+            else:
+                ttl = (ttls or {}).get((name, rdtype), (None, []))[0]
+                update.add(owner, RECORD_TTL if ttl is None else ttl, rdtype, rdata)
+        return update
+
+    def _inverse(self, change):
+        """ Return the changes undoing change (adding back what it deleted, as it was) """
+        zone, action, name, rdtype, rdata = change
+        if action == 'add':
+            return [(zone, 'delete', name, rdtype, rdata)]
+        if action == 'delete' and rdata:
+            return [(zone, 'add', name, rdtype, rdata)]
+        if action == 'delete':
+            suffix = '.' if rdtype in ('CNAME', 'PTR') else ''
+            return [(zone, 'add', name, rdtype, record + suffix)
+                    for record in self.existing.get((name, rdtype), (None, []))[1]]
+        return []
+
+    def _messages(self):
+        """
+        Yield (zone, operations, update message) with each zone's changes in as
+        few messages as possible (an operation's changes are never split).
+        Operations that have failed by the time their zone is reached (in an
+        earlier zone, or a conflict) are left out.
+        """
+        zones = OrderedDict()
+        for oper in self.operations:
+            for change in oper.changes:
+                zones.setdefault(change[0], OrderedDict()).setdefault(id(oper), (oper, []))
+                zones[change[0]][id(oper)][1].append(change)
+        for zone, opers in zones.items():
+            members, pending = [], []
+            for oper, changes in opers.values():
+                if oper.errors:
+                    continue
+                if pending and len(pending) + len(changes) > BATCH_MAX_CHANGES:
+                    yield zone, members, self._update(zone, pending)
+                    members, pending = [], []
+                members.append(oper)
+                pending.extend(changes)
+            if members:
+                yield zone, members, self._update(zone, pending)
+
+    def _send(self, update):
+        """ Send an update, returning None or the error (rcode name or exception text) """
+        self.messages += 1
+        try:
+            with dns_update_seconds.time(operation='batch'), span('dns-update'):
+                response = dns_pool.query(update)
+        except Exception as exc: # pylint: disable=broad-except
+            return str(exc) or exc.__class__.__name__
+        rcode = response.rcode()
+        if rcode == dns.rcode.NOERROR:
+            return None
+        return dns.rcode.to_text(rcode)
+
+    def _send_zone(self, zone, members, update):
+        """
+        Send one zone's update for members. If a prerequisite fails (a record
+        was added since the conflict check), each member is retried alone, so
+        only the conflicting ones fail.
+        """
+        error = self._send(update)
+        if error in [dns.rcode.to_text(r) for r in PREREQUISITE_RCODES] and len(members) > 1:
+            for oper in members:
+                changes = [change for change in oper.changes if change[0] == zone]
+                self._send_zone(zone, [oper], self._update(zone, changes))
+            return
+        for oper in members:
+            if error:
+                oper.errors.append('update of ' + zone + ' failed (' + error + ')')
+                oper.conflict = error in [dns.rcode.to_text(r) for r in PREREQUISITE_RCODES]
+            else:
+                oper.applied.append(zone)
+
+    def _roll_back(self):
+        """
+        Undo, zone by zone, the applied changes of operations that failed in
+        another zone (so an address isn't left with a PTR to a name that wasn't
+        added, or the other way round)
+        """
+        zones = OrderedDict()
+        for oper in self.operations:
+            if not (oper.errors and oper.applied):
+                continue
+            for change in reversed(oper.changes):
+                inverses = self._inverse(change)
+                if inverses and change[0] in oper.applied:
+                    zones.setdefault(change[0], OrderedDict()).setdefault(id(oper), (oper, []))
+                    zones[change[0]][id(oper)][1].extend(inverses)
+        for zone, opers in zones.items():
+            changes = [change for _, inverses in opers.values() for change in inverses]
+            error = self._send(self._update(zone, changes, self.existing))
+            for oper, _ in opers.values():
+                if error:
+                    oper.errors.append('changes to ' + zone + ' could not be rolled back (' +
+                                       error + ')')
+                else:
+                    oper.applied.remove(zone)
+                    oper.errors.append('changes to ' + zone + ' were rolled back')
+
+    def apply(self):
+        """
+        Plan and send all changes, returning the per-operation results
+        """
+        self.plan()
+        self.check_conflicts()
+        for zone, members, update in self._messages():
+            self._send_zone(zone, members, update)
+        self._roll_back()
+        touched = set()
+        for oper in self.operations:
+            touched.update(change[2] for change in oper.changes)
+            touched.update(oper.addresses)
+            self._update_allocator(oper)
+        searcher.invalidate(*touched)
+        return [oper.result() for oper in self.operations]
+
+    @staticmethod
+    def _update_allocator(oper):
+        """ Mark the addresses oper gave or took PTR records as used or free """
+        if oper.errors:
+            allocator.invalidate(*oper.addresses)
+            return
+        for _, action, _, rdtype, rdata in oper.changes:
+            if rdtype in ('A', 'AAAA') and action == 'add':
+                allocator.mark_used(rdata)
+            elif rdtype in ('A', 'AAAA') and action == 'delete' and rdata:
+                allocator.mark_free(rdata)
+        if oper.is_address_delete():
+            allocator.mark_free(oper.name)
+
+    def failed(self):
+        """ Return True if any operation failed """
+        return any(oper.errors for oper in self.operations)
+
+    def conflicted(self):
+        """ Return True if any operation failed because what it adds already exists """
+        return any(oper.conflict for oper in self.operations)
+
+    def failures(self):
+        """ Return the results of the operations that failed, with their positions """
+        failures = []
+        for index, oper in enumerate(self.operations):
+            if oper.errors:
+                result = oper.result()
+                result['index'] = index
+                failures.append(result)
+        return failures
@@ -0,0 +1,175 @@
+"""
+Export of every record in a subnet (PTR) or domain (A, AAAA, CNAME), streamed
+as CSV or newline-delimited JSON. Records come from zone transfers, read one
+message at a time, so memory use doesn't grow with the size of the zone.
+"""
+
+import csv
+import io
+import ipaddress
+import json
+import zlib
+import dns.exception
+import dns.name
+import dns.query
+import dns.rdatatype
+import dns.reversename
+from app import app
+from .functions import DNS_TIMEOUT, key_name, keyring, key_algorithm
+from .functions import forward_zone_for, reverse_zone_blocks, lookup_many
+from .policy import domain_matcher, range_allowed
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+COLUMNS = ('name', 'type', 'value', 'ttl')
+# Largest subnet exported by PTR lookups, when the server refuses a zone transfer
+EXPORT_MAX_LOOKUPS = app.config.get('EXPORT_MAX_LOOKUPS', 65536)
+# Addresses looked up per pipelined batch
+LOOKUP_BATCH = 256
+
+
+class ExportError(Exception):
+    """ Raised when a target can't be exported """
+
+
+def parse_target(target):
+    """
+    Return (network, None) for a subnet or (None, domain) for a domain, raising
+    ExportError if it isn't allowed
+    """
+    target = target.strip().lower().rstrip('.')
+    try:
+        network = ipaddress.ip_network(target, strict=False)
+    except ValueError:
+        # Only the managed zones (FORWARD_ZONE without ALLOWED_DOMAINS, which allows any name)
+        if '.' not in target or not domain_matcher.match(target):
+            raise ExportError("Not authorized to export " + target)
+        return None, target
+    if not range_allowed(network.network_address, network.num_addresses):
+        raise ExportError("Not authorized to export " + target)
+    return network, None
+
+def _transfer(origin):
+    """ Yield the rrsets of zone origin, one transfer message at a time """
+    messages = dns.query.xfr(app.config['SERVER'], origin, timeout=DNS_TIMEOUT,
+                             keyring=keyring, keyname=key_name, keyalgorithm=key_algorithm,
+                             relativize=False)
+    for message in messages:
+        for rrset in message.answer:
+            if rrset.rdtype != dns.rdatatype.SOA:
+                yield rrset
+
+def _text(name):
+    """ Return name without the trailing dot """
+    return name.to_text().rstrip('.').lower()
+
+def _subnet_by_lookup(network):
+    """ Yield PTR rows for network by pipelined lookups of each address """
+    if network.num_addresses > EXPORT_MAX_LOOKUPS:
+        raise ExportError("Zone transfer refused and " + str(network) + " is too large " +
+                          "to look up address by address")
+    addresses = iter(network)
+    while True:
+        batch = [str(ip) for _, ip in zip(range(LOOKUP_BATCH), addresses)]
+        if not batch:
+            return
+        queries = [(ipaddress.ip_address(ip).reverse_pointer, 'PTR') for ip in batch]
+        rows = []
+        for ip, names in zip(batch, lookup_many(queries)):
+            rows.extend((ip, 'PTR', name.lower(), None) for name in names)
+        yield rows
+
+def _subnet_rows(network):
+    """
+    Yield lists of PTR rows (address, 'PTR', name, ttl) within network. If the
+    server refuses to transfer a zone, its addresses are looked up instead.
+    """
+    for origin, blocks in reverse_zone_blocks(network).items():
+        sent = False
+        try:
+            for rrset in _transfer(origin):
+                if rrset.rdtype != dns.rdatatype.PTR:
+                    continue
+                try:
+                    ip = dns.reversename.to_address(rrset.name)
+                except (dns.exception.SyntaxError, ValueError):
+                    continue
+                if ipaddress.ip_address(ip) in network:
+                    sent = True
+                    yield [(ip, 'PTR', _text(r.target), rrset.ttl) for r in rrset]
+        except (EOFError, OSError, dns.exception.DNSException) as err:
+            if sent:
+                raise
+            app.logger.info("export: transfer of " + origin + " failed (" + str(err) +
+                            "), looking up addresses instead")
+            for block in blocks:
+                yield from _subnet_by_lookup(block)
+
+def _domain_rows(domain):
+    """ Yield lists of A/AAAA/CNAME rows (name, type, value, ttl) at or below domain """
+    domain_name = dns.name.from_text(domain)
+    for rrset in _transfer(forward_zone_for(domain)):
+        if rrset.rdtype in (dns.rdatatype.A, dns.rdatatype.AAAA, dns.rdatatype.CNAME) and \
+                rrset.name.is_subdomain(domain_name):
+            rdtype = dns.rdatatype.to_text(rrset.rdtype)
+            yield [(_text(rrset.name), rdtype, r.to_text().rstrip('.').lower(), rrset.ttl)
+                   for r in rrset]
+
+def export_rows(network=None, domain=None):
+    """ Yield lists of (name, type, value, ttl) rows for a subnet or a domain """
+    if network is not None:
+        return _subnet_rows(network)
+    return _domain_rows(domain)
+
+def render(row_lists, fmt='csv'):
+    """
+    Yield text chunks (one per list of rows) in fmt. A failure part way
+    through ends the output with an error line, since the response has
+    already started.
+    """
+    if fmt == 'csv':
+        yield ','.join(COLUMNS) + '\r\n'
+    try:
+        for rows in row_lists:
+            if fmt == 'csv':
+                out = io.StringIO()
+                csv.writer(out).writerows(rows)
+                yield out.getvalue()
+            else:
+                yield ''.join(json.dumps(dict(zip(COLUMNS, row))) + '\n' for row in rows)
+    except (ExportError, EOFError, OSError, dns.exception.DNSException) as err:
+        app.logger.warning("export: failed: " + str(err))
+        if fmt == 'csv':
+            yield '# Error: ' + str(err) + '\r\n'
+        else:
+            yield json.dumps({'error': str(err)}) + '\n'
+
+def zone_serials(network=None, domain=None):
+    """
+    Return the SOA serials of the zones a subnet or domain export reads, or
+    None if a zone has no SOA record
+    """
+    if network is not None:
+        zones = list(reverse_zone_blocks(network))
+    else:
+        zones = [forward_zone_for(domain)]
+    serials = []
+    for zone, records in zip(zones, lookup_many([(zone, 'SOA') for zone in zones])):
+        if not records:
+            return None
+        serials.append(zone + ' ' + records[0].split()[2])
+    return serials
+
+def gzip_chunks(chunks, level=6, flush=False):
+    """
+    Compress text chunks into a gzip stream, a piece at a time. With flush,
+    each chunk is sent as soon as it is compressed (for results streamed as
+    they are found), at some cost in compression.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if flush:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
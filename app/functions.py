@@ -1,4 +1,18 @@
 import os, sys
+import ipaddress
+import json
+import select
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import dns.exception
+import dns.message
+import dns.query
+import dns.rdatatype
+import dns.tsig
+import dns.tsigkeyring
 # Assumes that pybinder is a sibling folder (same parent). Adjust accordingly.
 pybinder_path = os.path.abspath(os.path.join('..', 'pybinder'))
 sys.path.append(pybinder_path)
@@ -6,13 +20,518 @@ from searchdns import SearchDNS
 from managedns import ManageDNS
 from modifydns import parse_key_file
 
-from app import app
+from flask import request
+from app import app, background_services
+from .history import SQLiteStore
+from .metrics import dns_query_seconds, dns_update_seconds, StatsGauge
+from .policy import SUBNETS, is_address
+from .timing import span
 
 if os.path.isfile(app.config['DDNS_KEY']):
     key_name, key_hash = parse_key_file(app.config['DDNS_KEY'])
 else:
     key_name, key_hash = (None, None)
 
+# Keyring for the DDNS key, used by updates and zone transfers made directly with dnspython
+if key_name:
+    keyring = dns.tsigkeyring.from_text({key_name: key_hash})
+    key_algorithm = app.config.get('DDNS_KEY_ALGORITHM', dns.tsig.default_algorithm)
+else:
+    keyring, key_algorithm = (None, dns.tsig.default_algorithm)
+
+FORWARD_ZONE = app.config['FORWARD_ZONE']
+REVERSE_ZONE = app.config.get('REVERSE_ZONE')
+# Longest zone first, so the most specific zone matches a name
+ZONES = sorted(set([FORWARD_ZONE] + list(app.config.get('ALLOWED_DOMAINS', ()))),
+               key=len, reverse=True)
+SEARCH_CACHE_TTL = app.config.get('SEARCH_CACHE_TTL', 60)
+SEARCH_CACHE_SIZE = app.config.get('SEARCH_CACHE_SIZE', 4096)
+SEARCH_WORKERS = app.config.get('SEARCH_WORKERS', 16)
+SEARCH_TIMEOUT = app.config.get('SEARCH_TIMEOUT', 5)
+# Search short names in FORWARD_ZONE and every ALLOWED_DOMAINS zone at once
+SEARCH_ALL_ZONES = app.config.get('SEARCH_ALL_ZONES', False)
+SEARCH_ZONE_TIMEOUT = app.config.get('SEARCH_ZONE_TIMEOUT', 3)
+SEARCH_ZONE_WORKERS = app.config.get('SEARCH_ZONE_WORKERS', 32)
+DNS_TIMEOUT = app.config.get('DNS_TIMEOUT', 10)
+MANAGER_CACHE_SIZE = app.config.get('MANAGER_CACHE_SIZE', 64)
+DNS_POOL_SIZE = app.config.get('DNS_POOL_SIZE', 8)
+DNS_POOL_IDLE = app.config.get('DNS_POOL_IDLE', 60)
+DNS_POOL_MAX_BACKOFF = app.config.get('DNS_POOL_MAX_BACKOFF', 30)
+DNS_PIPELINE_DEPTH = app.config.get('DNS_PIPELINE_DEPTH', 64)
+CHANGE_FEED_RETENTION = app.config.get('CHANGE_FEED_RETENTION', 3600)
+CHANGE_FEED_INTERVAL = app.config.get('CHANGE_FEED_INTERVAL', 0.25)
+
+def normalize_query(entry):
+    """
+    Return the cache key for a search term: lowercase FQDN (default zone
+    appended to short names) or canonical IP address
+    """
+    entry = entry.strip().lower().rstrip('.')
+    try:
+        return str(ipaddress.ip_address(entry))
+    except ValueError:
+        pass
+    if '.' not in entry:
+        entry = entry + '.' + FORWARD_ZONE.lower()
+    return entry
+
+def qualify(name):
+    """ Return name as FQDN (in FORWARD_ZONE if no domain given) """
+    name = name.strip().lower().rstrip('.')
+    if '.' not in name:
+        name = name + '.' + FORWARD_ZONE
+    return name
+
+def forward_zone_for(name):
+    """ Return the zone a fully qualified name belongs to """
+    for zone in ZONES:
+        if name == zone or name.endswith('.' + zone):
+            return zone
+    return name.split('.', 1)[1]
+
+def reverse_zone_for(ip):
+    """
+    Return the reverse zone holding the PTR for ip: REVERSE_ZONE if it covers
+    the address, otherwise the "reverse class C" zone (or the /64 for IPv6)
+    """
+    pointer = ipaddress.ip_address(ip).reverse_pointer
+    if REVERSE_ZONE and pointer.endswith('.' + REVERSE_ZONE):
+        return REVERSE_ZONE
+    if ipaddress.ip_address(ip).version == 4:
+        return pointer.split('.', 1)[1]
+    return pointer.split('.', 16)[16]
+
+def reverse_zones(network):
+    """
+    Return the reverse zones (as used by reverse_zone_for) covering network
+    """
+    network = ipaddress.ip_network(network)
+    prefix = 24 if network.version == 4 else 64
+    if network.prefixlen >= prefix:
+        blocks = [network.supernet(new_prefix=prefix)]
+    else:
+        blocks = network.subnets(new_prefix=prefix)
+    zones = []
+    for block in blocks:
+        zone = reverse_zone_for(block.network_address)
+        if zone not in zones:
+            zones.append(zone)
+    return zones
+
+def reverse_zone_blocks(network):
+    """
+    Return an OrderedDict of the reverse zones covering network, each with the
+    parts of network it holds
+    """
+    prefix = 24 if network.version == 4 else 64
+    blocks = [network] if network.prefixlen >= prefix else network.subnets(new_prefix=prefix)
+    zones = OrderedDict()
+    for block in blocks:
+        zones.setdefault(reverse_zone_for(block.network_address), []).append(block)
+    return zones
+
+def split_range_name(name, start_index=None):
+    """
+    Return (prefix, index, width, domain) for the first name of a range. The
+    index is start_index if given, otherwise the trailing digits of the hostname;
+    width is the number of digits, which is preserved for the whole range.
+    """
+    hostname, domain = name.split('.', 1) if '.' in name else (name, '')
+    if start_index:
+        index = start_index.strip()
+    else:
+        index = hostname[len(hostname.rstrip('0123456789')):]
+        hostname = hostname[:len(hostname) - len(index)]
+    if not index.isdigit():
+        raise ValueError("Name must end with the starting index, or one must be given")
+    return hostname, int(index), len(index), domain
+
+def range_name(prefix, index, width, domain):
+    """ Return the name of a range entry (inverse of split_range_name) """
+    name = prefix + str(index).zfill(width)
+    return name + '.' + domain if domain else name
+
+def expand_range(name, ipaddr, num, start_index=None):
+    """
+    Return the (name, address) pairs a range add creates: both the index and
+    the address are incremented for each entry
+    """
+    prefix, index, width, domain = split_range_name(name, start_index)
+    ipaddr = ipaddress.ip_address(ipaddr)
+    return [(range_name(prefix, index + i, width, domain), str(ipaddr + i)) for i in range(num)]
+
+def address_type(ip):
+    """ Return the record type used for ip """
+    return 'A' if ipaddress.ip_address(ip).version == 4 else 'AAAA'
+
+def _answer_tokens(result):
+    """ Return the set of normalized names/addresses mentioned in a search result """
+    tokens = set()
+    for token in str(result).lower().replace(',', ' ').split():
+        tokens.add(token.strip('[]()\'"').rstrip('.'))
+    return tokens
+
+class CachedSearch(object):
+    """
+    Wrap a SearchDNS object with a bounded TTL cache. Each answer is kept for
+    the record TTL (when the answer exposes one), capped at ttl seconds. The
+    least recently used answer is evicted once max_entries is reached.
+    Concurrent queries for the same term share a single lookup (even with the
+    cache disabled): the first makes it, the others wait for its result.
+    Changes are published to feed (when given), and changes other worker
+    processes publish there are applied here as if made locally.
+    """
+
+    def __init__(self, search, ttl=SEARCH_CACHE_TTL, max_entries=SEARCH_CACHE_SIZE, feed=None):
+        self.search = search
+        self.feed = feed
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        if feed is not None:
+            feed.subscribe(self._forget)
+
+    def query(self, entry):
+        """
+        Return the (possibly cached) search result for entry
+        """
+        caching = self.ttl and self.max_entries
+        key = normalize_query(entry)
+        with self._lock:
+            cached = self._entries.get(key) if caching else None
+            if cached and cached[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            flight = self._inflight.get(key)
+            if flight is None:
+                flight = self._inflight[key] = Future()
+                self.misses += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+            generation = self._generation
+        if not leader:
+            return flight.result()
+        try:
+            with dns_query_seconds.time(source='searcher'), span('dns'):
+                result = self.search.query(entry)
+        except BaseException as err:
+            flight.set_exception(err)
+            raise
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+        flight.set_result(result)
+        if not caching:
+            return result
+        ttl = getattr(result, 'ttl', None)
+        ttl = min(ttl, self.ttl) if isinstance(ttl, int) and ttl > 0 else self.ttl
+        with self._lock:
+            # A change was made while this lookup was in flight; don't cache it
+            if generation == self._generation:
+                self._entries[key] = (result, time.monotonic() + ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return result
+
+    def invalidate(self, *terms):
+        """
+        Drop cached answers for terms, and any cached answer that refers to them
+        """
+        self._forget(terms)
+        if self.feed is not None:
+            self.feed.publish(terms)
+
+    def clear(self):
+        """
+        Drop all cached answers
+        """
+        self._forget(())
+        if self.feed is not None:
+            self.feed.publish(())
+
+    def _forget(self, terms):
+        """ Drop cached answers for terms (all of them when terms is empty) """
+        if not terms:
+            with self._lock:
+                self._generation += 1
+                self._entries.clear()
+                self._inflight.clear()
+            if hasattr(self.search, 'clear'):
+                self.search.clear()
+            return
+        keys = set(normalize_query(t) for t in terms if t)
+        with self._lock:
+            self._generation += 1
+            for key, (result, _) in list(self._entries.items()):
+                if key in keys or keys & _answer_tokens(result):
+                    del self._entries[key]
+            # Lookups started before the change aren't shared with queries made after it
+            self._inflight.clear()
+        if hasattr(self.search, 'invalidate'):
+            self.search.invalidate(*terms)
+
+    def stats(self):
+        """
+        Return hit/miss/coalesced counters, current size and lookups in flight
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced,
+                    'size': len(self._entries), 'inflight': len(self._inflight)}
+
+
+class ChangeFeed(SQLiteStore):
+    """
+    Changes (the names and addresses touched) shared between worker processes
+    through SQLite, so each can drop what it cached or loaded about them. A
+    process publishes its own changes and, at most every interval seconds,
+    passes those published by the others to its subscribers (an empty list of
+    terms means anything may have changed).
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pid INTEGER NOT NULL,
+            created REAL NOT NULL,
+            terms TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, retention=CHANGE_FEED_RETENTION, interval=CHANGE_FEED_INTERVAL):
+        super().__init__()
+        self.retention = retention
+        self.interval = interval
+        self.published = 0
+        self.applied = 0
+        self._subscribers = []
+        self._pid = None
+        self._seen = 0
+        self._next_sync = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        """ Call callback(terms) for each change made by another process """
+        self._subscribers.append(callback)
+
+    def publish(self, terms):
+        """ Record a change to terms, and forget changes older than retention """
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            cursor = conn.execute('INSERT INTO changes (pid, created, terms) VALUES (?, ?, ?)',
+                                  (os.getpid(), now, json.dumps([str(t) for t in terms if t])))
+            if cursor.lastrowid % 100 == 0:
+                conn.execute('DELETE FROM changes WHERE created < ?', (now - self.retention,))
+        self.published += 1
+
+    def sync(self):
+        """ Pass on the changes other processes made since the last sync """
+        if self._pid == os.getpid() and time.monotonic() < self._next_sync:
+            return
+        with self._lock:
+            self._next_sync = time.monotonic() + self.interval
+            conn = self._connect()
+            if self._pid != os.getpid():
+                # A new process has nothing cached yet, so only later changes matter
+                self._seen = conn.execute('SELECT COALESCE(MAX(id), 0) FROM changes').fetchone()[0]
+                self._pid = os.getpid()
+                return
+            rows = conn.execute('SELECT id, pid, terms FROM changes WHERE id > ? ORDER BY id',
+                                (self._seen,)).fetchall()
+            if not rows:
+                return
+            # Changes missed (pruned after a long idle spell) could be anything
+            changes = [()] if rows[0][0] > self._seen + 1 else []
+            changes.extend(json.loads(terms) for _, pid, terms in rows if pid != os.getpid())
+            self._seen = rows[-1][0]
+        for terms in changes:
+            self.applied += 1
+            for callback in self._subscribers:
+                callback(terms)
+
+    def stats(self):
+        """ Return changes published by this process and applied from others """
+        return {'published': self.published, 'applied': self.applied}
+
+
+class ZoneAnswer(object):
+    """
+    Search result merged from several zones. Like a SearchDNS result, the string
+    form is the query followed by the answer: each name found and its answer,
+    or only the answer when the name was found just in FORWARD_ZONE.
+    """
+
+    def __init__(self, query, found, ttl=None):
+        self.query = query
+        self.found = found
+        self.ttl = ttl
+
+    def __str__(self):
+        if not self.found:
+            return self.query + ' Not found'
+        if len(self.found) == 1 and self.found[0][0] == qualify(self.query):
+            return self.query + ' ' + self.found[0][1]
+        return self.query + ' ' + ', '.join(name + ' ' + answer for name, answer in self.found)
+
+
+class ZoneFanoutSearch(object):
+    """
+    Wrap a searcher (such as a CachedSearch) to look up short names in each of
+    zones in parallel, merging whatever is found before the deadline. Names with
+    a domain and addresses belong to one zone, so they are passed straight on.
+    """
+
+    def __init__(self, search, zones, timeout=SEARCH_ZONE_TIMEOUT, workers=SEARCH_ZONE_WORKERS):
+        self.search = search
+        self.zones = zones
+        self.timeout = timeout
+        self.fanouts = 0
+        self.timeouts = 0
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    def query(self, entry):
+        """
+        Return the search result for entry, from every zone if it is a short name
+        """
+        term = entry.strip().lower().rstrip('.')
+        if '.' in term or ':' in term:
+            return self.search.query(entry)
+        self.fanouts += 1
+        futures = OrderedDict((term + '.' + zone, self._pool.submit(self.search.query,
+                                                                     term + '.' + zone))
+                              for zone in self.zones)
+        wait(futures.values(), timeout=self.timeout)
+        found, ttls, errors = [], [], []
+        for name, future in futures.items():
+            if not future.done():
+                future.cancel()
+                self.timeouts += 1
+                errors.append(dns.exception.Timeout("lookup of " + name + " timed out"))
+            elif future.exception():
+                errors.append(future.exception())
+            else:
+                result = future.result()
+                answer = str(result).split(' ', 1)[1]
+                if answer != 'Not found':
+                    found.append((name, answer))
+                    ttl = getattr(result, 'ttl', None)
+                    if isinstance(ttl, int):
+                        ttls.append(ttl)
+        if errors and not found:
+            raise errors[0]
+        return ZoneAnswer(entry, found, min(ttls) if ttls else None)
+
+    def invalidate(self, *terms):
+        """ Pass change notification on to the wrapped searcher """
+        self.search.invalidate(*terms)
+
+    def clear(self):
+        """ Pass change notification on to the wrapped searcher """
+        self.search.clear()
+
+    def stats(self):
+        """ Return the wrapped searcher's counters, with fan-out counters added """
+        stats = self.search.stats()
+        stats.update({'fanouts': self.fanouts, 'zone_timeouts': self.timeouts})
+        return stats
+
+
+class CachingManageDNS(ManageDNS):
+    """
+    ManageDNS that invalidates cached search results for everything it touches,
+    and keeps the address allocator's bitmaps current. Invalidation also happens
+    when a change fails, since it may be partially applied. History is kept in
+    the history store, so ManageDNS's own (in-process) history is dropped after
+    each change rather than growing without bound.
+    """
+
+    def add_record(self, name, ipaddr, force=False):
+        try:
+            with dns_update_seconds.time(operation='add_record'), span('dns-update'):
+                answer = super().add_record(name, ipaddr, force)
+        except BaseException:
+            allocator.invalidate(*ipaddr)
+            raise
+        finally:
+            searcher.invalidate(name, *ipaddr)
+            self.clear_history()
+        if force:
+            # Addresses the name had before are freed, but which ones isn't known
+            allocator.invalidate()
+        allocator.mark_used(*ipaddr)
+        return answer
+
+    def add_alias(self, alias, real_name, force=False):
+        try:
+            with dns_update_seconds.time(operation='add_alias'), span('dns-update'):
+                answer = super().add_alias(alias, real_name, force)
+        finally:
+            searcher.invalidate(alias)
+            self.clear_history()
+        if force:
+            allocator.invalidate()
+        return answer
+
+    def add_range(self, name, ipaddr, num, start_index=None, force=False):
+        addresses = [str(ipaddress.ip_address(ipaddr) + i) for i in range(num)]
+        try:
+            with dns_update_seconds.time(operation='add_range'), span('dns-update'):
+                answer = super().add_range(name, ipaddr, num, start_index, force)
+        except BaseException:
+            allocator.invalidate(*addresses)
+            raise
+        finally:
+            searcher.clear()
+            self.clear_history()
+        if force:
+            allocator.invalidate()
+        allocator.mark_used(*addresses)
+        return answer
+
+    def delete_record(self, entry):
+        try:
+            with dns_update_seconds.time(operation='delete_record'), span('dns-update'):
+                answer = super().delete_record(entry)
+        except BaseException:
+            allocator.invalidate()
+            raise
+        finally:
+            searcher.invalidate(entry)
+            self.clear_history()
+        if is_address(entry):
+            allocator.mark_free(entry)
+        else:
+            allocator.invalidate()
+        return answer
+
+    def delete_range(self, entry, num):
+        try:
+            with dns_update_seconds.time(operation='delete_range'), span('dns-update'):
+                answer = super().delete_range(entry, num)
+        except BaseException:
+            allocator.invalidate()
+            raise
+        finally:
+            searcher.clear()
+            self.clear_history()
+        if is_address(entry):
+            allocator.mark_free(*[str(ipaddress.ip_address(entry) + i) for i in range(num)])
+        else:
+            allocator.invalidate()
+        return answer
+
+
 def create_manager(user):
     """
     Return a ManageDNS object associated with user (for history)
@@ -21,13 +540,365 @@ def create_manager(user):
         revzone = app.config['REVERSE_ZONE']
     else:
         revzone = None
-    return ManageDNS(nameserver=app.config['SERVER'], forward_zone=app.config['FORWARD_ZONE'],
-                     reverse_zone=revzone, user=user, key_name=key_name,
-                     key_hash=key_hash)
+    return CachingManageDNS(nameserver=app.config['SERVER'], forward_zone=FORWARD_ZONE,
+                            reverse_zone=revzone, user=user, key_name=key_name,
+                            key_hash=key_hash)
+
+class ManagerPool(object):
+    """
+    Per-user ManageDNS objects, keeping only the max_size most recently used.
+    History is kept in the history store, so evicting a manager loses nothing.
+    """
+
+    def __init__(self, max_size=MANAGER_CACHE_SIZE):
+        self.max_size = max_size
+        self._managers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user):
+        """
+        Return the ManageDNS object for user, creating it if needed
+        """
+        with self._lock:
+            if user in self._managers:
+                self._managers.move_to_end(user)
+                return self._managers[user]
+            user_manager = create_manager(user)
+            self._managers[user] = user_manager
+            while len(self._managers) > self.max_size:
+                self._managers.popitem(last=False)
+            return user_manager
+
+    def __len__(self):
+        return len(self._managers)
+
+
+class DNSConnectionPool(object):
+    """
+    Thread-safe pool of persistent TCP connections to a nameserver, shared by
+    the queries and updates the app makes itself with dnspython (bulk lookups,
+    batch updates and mirror checks). pybinder's ManageDNS and SearchDNS make
+    their own connections, so single changes and live searches don't use it.
+    At most size connections are open (callers wait for a free one). Idle
+    connections are checked before reuse, and failed connects back off
+    exponentially.
+    """
+
+    def __init__(self, server, port=53, size=DNS_POOL_SIZE, timeout=DNS_TIMEOUT,
+                 max_idle=DNS_POOL_IDLE, max_backoff=DNS_POOL_MAX_BACKOFF):
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_backoff = max_backoff
+        self.created = 0
+        self.reused = 0
+        self._idle = deque()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._backoff = 0
+        self._retry_at = 0
+        self._pid = os.getpid()
+
+    def _connect(self):
+        """ Open a new connection, unless backing off after a failure """
+        with self._lock:
+            if time.monotonic() < self._retry_at:
+                raise ConnectionError("Unable to connect to " + self.server +
+                                      " (retrying in " + str(round(self._backoff, 1)) + "s)")
+        try:
+            sock = socket.create_connection((self.server, self.port), timeout=self.timeout)
+        except OSError:
+            with self._lock:
+                self._backoff = min(max(self._backoff * 2, 0.1), self.max_backoff)
+                self._retry_at = time.monotonic() + self._backoff
+            raise
+        with self._lock:
+            self._backoff = 0
+            self.created += 1
+        return sock
+
+    def _checkout(self):
+        """ Return (socket, reused): a healthy idle connection, or a new one """
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connections inherited across a fork belong to the parent
+                self._idle.clear()
+                self._pid = os.getpid()
+            while self._idle:
+                sock, last_used = self._idle.pop()
+                # An idle connection should have nothing to read; if it does, the
+                # server has closed it (or sent something unexpected)
+                if time.monotonic() - last_used < self.max_idle and \
+                        not select.select([sock], [], [], 0)[0]:
+                    self.reused += 1
+                    return sock, True
+                sock.close()
+        return self._connect(), False
+
+    def _checkin(self, sock):
+        """ Return a connection to the pool """
+        with self._lock:
+            if self._pid == os.getpid():
+                self._idle.append((sock, time.monotonic()))
+                return
+        sock.close()
+
+    def query(self, message, timeout=None):
+        """
+        Send message (query or update) and return the response. If a reused
+        connection turns out to be dead, the message is sent once more on a new one.
+        """
+        timeout = timeout or self.timeout
+        with self._slots:
+            while True:
+                sock, reused = self._checkout()
+                try:
+                    response = dns.query.tcp(message, self.server, timeout=timeout,
+                                             port=self.port, sock=sock)
+                except (OSError, EOFError, dns.exception.DNSException) as err:
+                    sock.close()
+                    if reused and not isinstance(err, dns.exception.Timeout):
+                        continue
+                    raise
+                self._checkin(sock)
+                return response
+
+    def query_many(self, messages, timeout=None):
+        """
+        Send messages pipelined on one connection (at most DNS_PIPELINE_DEPTH
+        outstanding) and return their responses in the same order. If a reused
+        connection turns out to be dead, the unanswered messages are sent once
+        more on a new one.
+        """
+        timeout = timeout or self.timeout
+        responses = [None] * len(messages)
+        with self._slots:
+            while True:
+                sock, reused = self._checkout()
+                try:
+                    self._pipeline(sock, messages, responses, time.time() + timeout)
+                except (OSError, EOFError, dns.exception.DNSException) as err:
+                    sock.close()
+                    if reused and not isinstance(err, dns.exception.Timeout):
+                        continue
+                    raise
+                self._checkin(sock)
+                return responses
+
+    @staticmethod
+    def _pipeline(sock, messages, responses, expiration):
+        """
+        Fill in responses for the messages without one, keeping a window of
+        queries in flight (responses may arrive in any order)
+        """
+        todo = deque(i for i, response in enumerate(responses) if response is None)
+        outstanding = {}
+        while todo or outstanding:
+            while todo and len(outstanding) < DNS_PIPELINE_DEPTH:
+                index = todo.popleft()
+                # IDs need only be unique among outstanding queries
+                messages[index].id = index & 0xFFFF
+                dns.query.send_tcp(sock, messages[index], expiration)
+                outstanding[messages[index].id] = index
+            response, _ = dns.query.receive_tcp(sock, expiration)
+            index = outstanding.pop(response.id, None)
+            if index is not None:
+                if not messages[index].is_response(response):
+                    raise dns.exception.FormError("Mismatched response to pipelined query")
+                responses[index] = response
+
+    def close(self):
+        """ Close all idle connections """
+        with self._lock:
+            while self._idle:
+                self._idle.pop()[0].close()
+
+    def stats(self):
+        """
+        Return connection counters and current idle count
+        """
+        with self._lock:
+            return {'created': self.created, 'reused': self.reused, 'idle': len(self._idle)}
+
 
+# Connections to the managed server, shared by bulk lookups, batch updates and the zone mirror
+dns_pool = DNSConnectionPool(app.config['SERVER'])
+
+# Local copy of the zones, kept for ZONE_MIRROR and PATTERN_SEARCH
+if app.config.get('ZONE_MIRROR') or app.config.get('PATTERN_SEARCH'):
+    from .mirror import ZoneMirror, MirrorSearch, mirrored_zones
+    zone_copy = ZoneMirror(mirrored_zones(), app.config['SERVER'], pool=dns_pool)
+    background_services.append(zone_copy)
+else:
+    zone_copy = None
+
+# Changes made by any worker process, so each keeps its caches and bitmaps current
+change_feed = ChangeFeed()
+# Endpoints answered from the search cache, the zone mirror or the allocator bitmaps
+CACHED_ENDPOINTS = ('searchrecord', 'bulksearch', 'patternsearch', 'allocate', 'search_main',
+                    'search_specific')
+
+@app.before_request
+def sync_changes():
+    """ Apply changes other worker processes made, before a request that reads cached data """
+    if request.endpoint in CACHED_ENDPOINTS:
+        change_feed.sync()
+
+# Searcher using FORWARD_ZONE, with results cached until they expire or are changed.
+# With ZONE_MIRROR enabled, searches are answered from a local copy of the zones when possible.
+if app.config.get('ZONE_MIRROR'):
+    mirror = zone_copy
+    searcher = CachedSearch(MirrorSearch(mirror, SearchDNS(nameserver=app.config['SERVER'],
+                                                           zone=FORWARD_ZONE)),
+                            feed=change_feed)
+else:
+    mirror = None
+    searcher = CachedSearch(SearchDNS(nameserver=app.config['SERVER'], zone=FORWARD_ZONE),
+                            feed=change_feed)
+
+# Short names searched in every zone at once, each zone's name through the cache above
+if SEARCH_ALL_ZONES:
+    searcher = ZoneFanoutSearch(searcher, [FORWARD_ZONE] + [
+        d for d in app.config.get('ALLOWED_DOMAINS', ()) if d != FORWARD_ZONE])
+
+# Prefix/glob name and CIDR address search, over an index of the zone copy
+if zone_copy is not None:
+    from .index import RecordIndex
+    record_index = RecordIndex(zone_copy)
+    StatsGauge('pybinder_pattern_index', 'Pattern search index size and rebuilds.',
+               record_index)
+else:
+    record_index = None
+
+StatsGauge('pybinder_search_cache', 'Search cache and coalescing counters, and sizes.', searcher)
+StatsGauge('pybinder_dns_pool', 'DNS connection pool counters and idle connections.', dns_pool)
+StatsGauge('pybinder_change_feed', 'Changes published to and applied from other workers.',
+           change_feed)
 
 # A userless manager is used for API calls
 manager = create_manager(None)
 
-# Searcher using FORWARD_ZONE
-searcher = SearchDNS(nameserver=app.config['SERVER'], zone=app.config['FORWARD_ZONE'])
+# Bounded worker pool for resolving multiple search terms at once
+search_pool = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+
+def search_terms(terms, timeout=SEARCH_TIMEOUT):
+    """
+    Resolve search terms concurrently and return an OrderedDict of term to
+    answer, in input order with duplicates collapsed. Each term is given
+    timeout seconds; terms that don't finish in time (or fail) are reported
+    in place of their answer, rather than failing the whole search.
+    """
+    futures = OrderedDict()
+    for term in terms:
+        if term and term not in futures:
+            futures[term] = search_pool.submit(searcher.query, term)
+    # Terms beyond the pool size queue up, so allow one timeout per wave of workers
+    waves = -(-len(futures) // SEARCH_WORKERS)
+    wait(futures.values(), timeout=timeout * waves)
+    answer = OrderedDict()
+    for term, future in futures.items():
+        answer[term] = _search_answer(future)
+    return answer
+
+def iter_search(terms, timeout=SEARCH_TIMEOUT):
+    """
+    Resolve search terms concurrently, yielding (term, answer) pairs as each
+    lookup finishes (not in input order). Duplicate terms are skipped, and at
+    most SEARCH_WORKERS lookups are outstanding at a time, so terms can be a
+    generator of any length.
+    """
+    terms = iter(terms)
+    seen = set()
+    pending = {}
+    exhausted = False
+    while pending or not exhausted:
+        while not exhausted and len(pending) < SEARCH_WORKERS:
+            term = next(terms, None)
+            if term is None:
+                exhausted = True
+            elif term and term not in seen:
+                seen.add(term)
+                pending[search_pool.submit(searcher.query, term)] = (term, time.monotonic())
+        if not pending:
+            break
+        oldest = min(started for _, started in pending.values())
+        done, _ = wait(pending, timeout=max(0, oldest + timeout - time.monotonic()),
+                       return_when=FIRST_COMPLETED)
+        now = time.monotonic()
+        for future, (term, started) in list(pending.items()):
+            if future in done or started + timeout <= now:
+                del pending[future]
+                yield term, _search_answer(future)
+
+def _search_answer(future):
+    """ Return the answer text for a finished (or abandoned) search future """
+    if not future.done():
+        future.cancel()
+        return 'Error: lookup timed out'
+    if future.exception():
+        return 'Error: ' + str(future.exception())
+    return str(future.result()).split(' ', 1)[1]
+
+def _records(response, rdtype):
+    """ Return the records of rdtype in response's answer, as text (without trailing dots) """
+    records = []
+    for rrset in response.answer:
+        if rrset.rdtype == dns.rdatatype.from_text(rdtype):
+            records.extend(rdata.to_text().rstrip('.') for rdata in rrset)
+    return records
+
+def lookup_records(qname, rdtype):
+    """
+    Query the managed DNS server directly (over a pooled connection), returning
+    the records of rdtype for qname as text (without trailing dots)
+    """
+    query = dns.message.make_query(qname, rdtype)
+    with dns_query_seconds.time(source='lookup'), span('dns'):
+        response = dns_pool.query(query)
+    return _records(response, rdtype)
+
+def lookup_many(queries):
+    """
+    Return the records (as lookup_records does) for each (qname, rdtype) in
+    queries, in order. The queries are pipelined on one pooled connection, so
+    this takes about one round trip per DNS_PIPELINE_DEPTH queries.
+    """
+    messages = [dns.message.make_query(qname, rdtype) for qname, rdtype in queries]
+    with dns_query_seconds.time(source='lookup'), span('dns'):
+        responses = dns_pool.query_many(messages)
+    return [_records(response, rdtype) for (_, rdtype), response in zip(queries, responses)]
+
+def lookup_rrsets(queries):
+    """
+    Return (ttl, records) for each (qname, rdtype) in queries, pipelined as
+    lookup_many does. Only records owned by qname itself count (not those at
+    the end of a CNAME), and ttl is None when there are none.
+    """
+    messages = [dns.message.make_query(qname, rdtype) for qname, rdtype in queries]
+    with dns_query_seconds.time(source='lookup'), span('dns'):
+        responses = dns_pool.query_many(messages)
+    answers = []
+    for message, response in zip(messages, responses):
+        question = message.question[0]
+        rrset = response.get_rrset(response.answer, question.name, question.rdclass,
+                                   question.rdtype)
+        if rrset is None:
+            answers.append((None, []))
+        else:
+            answers.append((rrset.ttl, [rdata.to_text().rstrip('.') for rdata in rrset]))
+    return answers
+
+# Next free addresses in SUBNETS, from bitmaps of the addresses that have PTR records
+from .allocate import AddressAllocator
+allocator = AddressAllocator(SUBNETS, app.config['SERVER'])
+StatsGauge('pybinder_allocator', 'Address allocator loads, allocations and free addresses.',
+           allocator)
+
+def _invalidate_allocator(terms):
+    """ Reload bitmaps holding addresses another process changed (all if unknown) """
+    addresses = [t for t in terms if is_address(t)]
+    if addresses or not terms:
+        allocator.invalidate(*addresses)
+
+change_feed.subscribe(_invalidate_allocator)
@@ -0,0 +1,277 @@
+"""
+Per-user DNS modification history, kept outside of the ManageDNS objects so
+it is shared by every worker process and survives restarts
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from app import app
+
+HISTORY_BACKEND = app.config.get('HISTORY_BACKEND', 'sqlite')
+HISTORY_DB = app.config.get('HISTORY_DB', os.path.join(app.root_path, '..', 'history.db'))
+HISTORY_PAGE_SIZE = app.config.get('HISTORY_PAGE_SIZE', 50)
+HISTORY_MAX_PAGE_SIZE = app.config.get('HISTORY_MAX_PAGE_SIZE', 500)
+HISTORY_ACTIONS = ('add', 'replace', 'alias', 'delete', 'range-add', 'range-replace',
+                   'range-delete')
+TIME_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S')
+
+def _parse_time(text):
+    """ Return seconds since the epoch for a local date (and optional time) """
+    for fmt in TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            continue
+    raise ValueError("Invalid time " + text + " (expected YYYY-MM-DD or YYYY-MM-DDTHH:MM)")
+
+def parse_query(args):
+    """
+    Return the page size, cursor and filters (as keyword arguments for
+    HistoryStore.page) from request arguments, raising ValueError if invalid
+    """
+    query = {}
+    try:
+        query['limit'] = int(args.get('limit') or HISTORY_PAGE_SIZE)
+        query['before'] = int(args['before']) if args.get('before') else None
+    except ValueError:
+        raise ValueError("Page size and cursor must be numbers")
+    if not 0 < query['limit'] <= HISTORY_MAX_PAGE_SIZE:
+        raise ValueError("Page size must be between 1 and " + str(HISTORY_MAX_PAGE_SIZE))
+    action = (args.get('action') or '').strip()
+    if action and action not in HISTORY_ACTIONS:
+        raise ValueError("Action must be one of " + ', '.join(HISTORY_ACTIONS))
+    query['action'] = action or None
+    query['name'] = (args.get('name') or '').strip() or None
+    query['address'] = (args.get('address') or '').strip() or None
+    query['since'] = _parse_time(args['since'].strip()) if args.get('since') else None
+    query['until'] = _parse_time(args['until'].strip()) if args.get('until') else None
+    return query
+
+
+class HistoryStore(object):
+    """
+    Interface for history backends. Each entry is one transaction: the action
+    taken, the name and addresses it applied to, and the resulting changes.
+    """
+
+    def append(self, user, action, name, addresses, answer):
+        """ Record a transaction for user """
+        raise NotImplementedError
+
+    def page(self, user, limit=HISTORY_PAGE_SIZE, before=None, action=None, name=None,
+             address=None, since=None, until=None):
+        """
+        Return (entries, cursor): up to limit of user's transactions older than
+        the before cursor (newest first) that match the filters, and the cursor
+        of the next page (None on the last page). Each entry is a dict of id,
+        time, action, name, addresses and answer.
+        """
+        raise NotImplementedError
+
+    def clear(self, user):
+        """ Remove all of user's transactions """
+        raise NotImplementedError
+
+
+class MemoryHistoryStore(HistoryStore):
+    """
+    History kept in this process only (for single-process use)
+    """
+
+    def __init__(self):
+        self._history = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def append(self, user, action, name, addresses, answer):
+        with self._lock:
+            self._history.setdefault(user, []).append({
+                'id': self._next_id, 'time': time.time(), 'action': action, 'name': name,
+                'addresses': list(addresses), 'answer': [str(a) for a in answer]})
+            self._next_id += 1
+
+    def page(self, user, limit=HISTORY_PAGE_SIZE, before=None, action=None, name=None,
+             address=None, since=None, until=None):
+        found = []
+        with self._lock:
+            entries = self._history.get(user, [])
+            # Entries are in id (and so time) order: find the cursor by bisection
+            low, high = 0, len(entries)
+            while before is not None and low < high:
+                middle = (low + high) // 2
+                if entries[middle]['id'] < before:
+                    low = middle + 1
+                else:
+                    high = middle
+            for index in range(high - 1, -1, -1):
+                entry = entries[index]
+                if since is not None and entry['time'] < since:
+                    break
+                if (action and entry['action'] != action) or \
+                        (name and entry['name'] != name) or \
+                        (address and address not in entry['addresses']) or \
+                        (until is not None and entry['time'] >= until):
+                    continue
+                found.append(dict(entry))
+                if len(found) > limit:
+                    break
+        return found[:limit], found[limit - 1]['id'] if len(found) > limit else None
+
+    def clear(self, user):
+        with self._lock:
+            self._history.pop(user, None)
+
+
+class SQLiteStore(object):
+    """
+    Base for stores kept in a SQLite database (WAL mode, so readers don't block
+    the writer), with one connection per thread. Safe to share between threads
+    and processes.
+    """
+
+    schema = ""
+
+    def __init__(self, path=HISTORY_DB):
+        self.path = path
+        self._local = threading.local()
+        self._connect().executescript(self.schema)
+
+    def _connect(self):
+        """ Return this thread's connection (connections are not shared across a fork) """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+class SQLiteHistoryStore(SQLiteStore, HistoryStore):
+    """
+    History kept in a SQLite database, indexed by user, with a side table of
+    the addresses each transaction applied to
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT NOT NULL,
+            created REAL NOT NULL,
+            action TEXT NOT NULL,
+            name TEXT,
+            addresses TEXT,
+            answer TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS history_user ON history (user, id);
+        CREATE INDEX IF NOT EXISTS history_user_action ON history (user, action, id);
+        CREATE INDEX IF NOT EXISTS history_user_name ON history (user, name, id);
+        CREATE INDEX IF NOT EXISTS history_user_created ON history (user, created);
+        CREATE TABLE IF NOT EXISTS history_address (
+            user TEXT NOT NULL,
+            address TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            PRIMARY KEY (user, address, id)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path=HISTORY_DB):
+        super().__init__(path)
+        self._index_addresses()
+
+    def _index_addresses(self):
+        """ Fill history_address from transactions recorded before it existed (once) """
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= 1:
+                return
+            rows = conn.execute("SELECT id, user, addresses FROM history WHERE addresses != ''")
+            conn.executemany('INSERT OR IGNORE INTO history_address (user, address, id) '
+                             'VALUES (?, ?, ?)',
+                             [(user, address, row_id) for row_id, user, addresses in rows
+                              for address in addresses.split()])
+            conn.execute('PRAGMA user_version = 1')
+
+    def append(self, user, action, name, addresses, answer):
+        conn = self._connect()
+        with conn:
+            cursor = conn.execute('INSERT INTO history (user, created, action, name, addresses,'
+                                  ' answer) VALUES (?, ?, ?, ?, ?, ?)',
+                                  (user, time.time(), action, name, ' '.join(addresses),
+                                   json.dumps([str(a) for a in answer])))
+            conn.executemany('INSERT OR IGNORE INTO history_address (user, address, id) '
+                             'VALUES (?, ?, ?)',
+                             [(user, address, cursor.lastrowid) for address in set(addresses)])
+
+    def _id_at(self, user, condition, when, order):
+        """
+        Return the id of user's first transaction, by created in order (ASC or
+        DESC), whose created time meets condition against when, or None
+        """
+        row = self._connect().execute('SELECT id FROM history WHERE user = ? AND created ' +
+                                      condition + ' ? ORDER BY created ' + order + ' LIMIT 1',
+                                      (user, when)).fetchone()
+        return row[0] if row else None
+
+    def page(self, user, limit=HISTORY_PAGE_SIZE, before=None, action=None, name=None,
+             address=None, since=None, until=None):
+        # Keyset pagination: each page walks back from the cursor along an index
+        # ending in id, so its cost doesn't depend on how much history there is.
+        # Ids follow creation time, so the time filters become id bounds, found
+        # along the (user, created) index.
+        low, high = None, None if before is None else before - 1
+        if since is not None:
+            low = self._id_at(user, '>=', since, 'ASC')
+            if low is None:
+                return [], None
+        if until is not None:
+            last = self._id_at(user, '<', until, 'DESC')
+            if last is None:
+                return [], None
+            high = last if high is None else min(high, last)
+        columns = 'h.id, h.created, h.action, h.name, h.addresses, h.answer'
+        if address:
+            # Walk the address's own index, rather than matching every transaction
+            sql = 'SELECT ' + columns + ' FROM history_address a JOIN history h ON h.id = a.id' \
+                ' WHERE a.user = ? AND a.address = ?'
+            params, key = [user, address], 'a.id'
+        else:
+            sql = 'SELECT ' + columns + ' FROM history h WHERE h.user = ?'
+            params, key = [user], 'h.id'
+        for clause, value in ((key + ' >= ?', low), (key + ' <= ?', high),
+                              ('h.action = ?', action), ('h.name = ?', name)):
+            if value is not None:
+                sql += ' AND ' + clause
+                params.append(value)
+        sql += ' ORDER BY ' + key + ' DESC LIMIT ?'
+        params.append(limit + 1)
+        rows = self._connect().execute(sql, params).fetchall()
+        entries = [{'id': row[0], 'time': row[1], 'action': row[2], 'name': row[3],
+                    'addresses': row[4].split() if row[4] else [], 'answer': json.loads(row[5])}
+                   for row in rows[:limit]]
+        return entries, entries[-1]['id'] if len(rows) > limit else None
+
+    def clear(self, user):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM history WHERE user = ?', (user,))
+            conn.execute('DELETE FROM history_address WHERE user = ?', (user,))
+
+
+def create_history_store():
+    """
+    Return the history backend selected by HISTORY_BACKEND
+    """
+    if HISTORY_BACKEND == 'memory':
+        return MemoryHistoryStore()
+    if HISTORY_BACKEND == 'sqlite':
+        return SQLiteHistoryStore()
+    raise ValueError("Unknown HISTORY_BACKEND " + str(HISTORY_BACKEND))
+
+
+history_store = create_history_store()
@@ -0,0 +1,66 @@
+"""
+HTTP caching for search and export responses: an ETag (from the body, or
+from zone serials when the body is streamed), 304 Not Modified for a
+matching If-None-Match, Cache-Control max-age from the record TTL, and gzip
+compression of larger bodies when the client accepts it.
+"""
+
+import gzip
+import hashlib
+import json
+from flask import Response, request
+from app import app
+
+# Longest a client may reuse an answer (changes made through the app apply at once here,
+# but a client only sees them when its copy expires)
+HTTP_MAX_AGE = app.config.get('HTTP_MAX_AGE', 60)
+# Smallest body worth compressing
+GZIP_MIN_BYTES = app.config.get('GZIP_MIN_BYTES', 1024)
+
+
+def make_etag(*parts):
+    """ Return an ETag value for the given parts (text or bytes) """
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def max_age(ttls):
+    """ Return the max-age for answers with ttls (None where unknown), capped at HTTP_MAX_AGE """
+    ttls = [t for t in ttls if isinstance(t, int) and t >= 0]
+    return min(ttls + [HTTP_MAX_AGE])
+
+def cache_headers(response, etag, age):
+    """ Set the ETag and Cache-Control headers (the answer may depend on the user) """
+    # Weak, so the same ETag serves gzip and identity encodings of the body
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, max-age=' + str(age)
+    response.vary.add('Accept-Encoding')
+    return response
+
+def not_modified(etag, age):
+    """ Return a 304 response if the client's copy (If-None-Match) has etag, else None """
+    if request.if_none_match.contains_weak(etag):
+        return cache_headers(Response(status=304), etag, age)
+    return None
+
+def cached_response(body, mimetype, age):
+    """
+    Return a response for body (text) with an ETag derived from it: 304 if the
+    client already has it, and gzip compressed if large and accepted
+    """
+    data = body.encode('utf-8')
+    etag = make_etag(data)
+    unchanged = not_modified(etag, age)
+    if unchanged is not None:
+        return unchanged
+    response = Response(data, mimetype=mimetype)
+    if len(data) >= GZIP_MIN_BYTES and 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(data, 6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return cache_headers(response, etag, age)
+
+def json_response(data, age):
+    """ Return cached_response for data as JSON """
+    return cached_response(json.dumps(data) + '\n', 'application/json', age)
@@ -0,0 +1,138 @@
+"""
+Pattern search (prefix and glob names, CIDR address ranges) over an index of
+the mirrored zones. Names are kept sorted (and sorted reversed, for patterns
+that only fix the end of a name) and addresses sorted by value, so a search
+is a binary search plus a walk over the matches, rebuilt in the background
+whenever the mirror changes.
+"""
+
+import ipaddress
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+from app import app
+from .functions import FORWARD_ZONE
+
+PATTERN_MAX_RESULTS = app.config.get('PATTERN_MAX_RESULTS', 1000)
+WILDCARDS = '*?['
+
+
+def is_pattern(term):
+    """ Check if a search term is a glob or CIDR pattern (rather than a name or address) """
+    return any(c in term for c in WILDCARDS + '/')
+
+
+class IndexSnapshot(object):
+    """
+    Immutable index of the mirrored zones at one point in time
+    """
+
+    def __init__(self, zones):
+        records = {}
+        addresses = {}
+        for zone in zones:
+            for name, rdtypes in zone.forward.items():
+                records.setdefault(name, {}).update(rdtypes)
+                for ip in rdtypes.get('A', []) + rdtypes.get('AAAA', []):
+                    addresses.setdefault(ip, set()).add(name)
+            for ip, names in zone.reverse.items():
+                addresses.setdefault(ip, set()).update(names)
+        self.records = records
+        self.names = sorted(records)
+        self.reversed_names = sorted(name[::-1] for name in records)
+        keys = sorted((ip.version, int(ip), str(ip))
+                      for ip in map(ipaddress.ip_address, addresses))
+        self.address_keys = [(version, value) for version, value, _ in keys]
+        self.addresses = [(ip, sorted(addresses[ip])) for _, _, ip in keys]
+
+    def answer(self, name):
+        """ Return the search answer for an indexed name """
+        rdtypes = self.records[name]
+        return ' '.join(rdtypes.get('CNAME', []) + rdtypes.get('A', []) +
+                        rdtypes.get('AAAA', []))
+
+    def match_names(self, pattern, limit):
+        """ Return up to limit names matching the glob pattern, in order """
+        literal = len(pattern)
+        for char in WILDCARDS:
+            if char in pattern:
+                literal = min(literal, pattern.index(char))
+        prefix = pattern[:literal]
+        suffix = pattern[max(pattern.rfind(c) for c in '*?]') + 1:]
+        matches = []
+        if prefix or not suffix:
+            # Names starting with the literal prefix are together in sorted order
+            for name in self.names[bisect_left(self.names, prefix):]:
+                if not name.startswith(prefix) or len(matches) >= limit:
+                    break
+                if fnmatchcase(name, pattern):
+                    matches.append(name)
+        else:
+            # Likewise names ending with the literal suffix, in reversed order
+            key = suffix[::-1]
+            for reversed_name in self.reversed_names[bisect_left(self.reversed_names, key):]:
+                if not reversed_name.startswith(key) or len(matches) >= limit:
+                    break
+                if fnmatchcase(reversed_name[::-1], pattern):
+                    matches.append(reversed_name[::-1])
+            matches.sort()
+        return matches
+
+    def match_network(self, network, limit):
+        """ Return up to limit (address, names) pairs within network, in order """
+        start = bisect_left(self.address_keys, (network.version, int(network.network_address)))
+        end = bisect_right(self.address_keys,
+                           (network.version, int(network.broadcast_address)))
+        return self.addresses[start:min(end, start + limit)]
+
+
+class RecordIndex(object):
+    """
+    Pattern search over a ZoneMirror, rebuilt (off the request path) after
+    every refresh that changes a zone
+    """
+
+    def __init__(self, mirror, max_results=PATTERN_MAX_RESULTS):
+        self.mirror = mirror
+        self.max_results = max_results
+        self.builds = 0
+        self._lock = threading.Lock()
+        self.rebuild(mirror)
+        mirror.listeners.append(self.rebuild)
+
+    def rebuild(self, mirror):
+        """ Replace the index with one built from the mirror's current contents """
+        with self._lock:
+            snapshot = IndexSnapshot(list(mirror.zones.values()))
+            self.snapshot = snapshot
+            self.builds += 1
+
+    def search(self, pattern):
+        """
+        Return an OrderedDict of name (or address) to answer for everything
+        matching pattern: a glob such as rack12-* (in FORWARD_ZONE unless a
+        domain is given), or a CIDR network such as 10.40.7.0/24
+        """
+        pattern = pattern.strip().lower().rstrip('.')
+        snapshot = self.snapshot
+        answer = OrderedDict()
+        if '/' in pattern:
+            try:
+                network = ipaddress.ip_network(pattern, strict=False)
+            except ValueError:
+                raise ValueError("Invalid network " + pattern)
+            for ip, names in snapshot.match_network(network, self.max_results):
+                answer[ip] = ' '.join(names)
+            return answer
+        if '.' not in pattern:
+            pattern = pattern + '.' + FORWARD_ZONE.lower()
+        for name in snapshot.match_names(pattern, self.max_results):
+            answer[name] = snapshot.answer(name)
+        return answer
+
+    def stats(self):
+        """ Return index size and number of builds """
+        snapshot = self.snapshot
+        return {'names': len(snapshot.names), 'addresses': len(snapshot.addresses),
+                'builds': self.builds}
@@ -0,0 +1,246 @@
+"""
+Background jobs for range operations. A range is applied in chunks by a
+worker thread, so the HTTP request returns immediately; progress, results
+and cancellation go through the jobs table (in the history database), so
+any worker process can report on or cancel a job. A job is run by the
+process it was submitted to; jobs left behind by a process that has exited
+are failed when the next worker process starts.
+"""
+
+import ipaddress
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from app import app, background_services
+from .audit import audit_log
+from .functions import create_manager, split_range_name, range_name
+from .history import HISTORY_DB, SQLiteStore, history_store
+from .policy import is_address
+
+JOB_WORKERS = app.config.get('JOB_WORKERS', 2)
+JOB_CHUNK_SIZE = app.config.get('JOB_CHUNK_SIZE', 16)
+JOB_RETENTION = app.config.get('JOB_RETENTION', 86400)
+
+FINISHED = ('done', 'failed', 'cancelled')
+
+def _process_exists(pid):
+    """ Return True if process pid is still running """
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore(SQLiteStore):
+    """
+    Job state and progress, kept in SQLite
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            user TEXT NOT NULL,
+            action TEXT NOT NULL,
+            name TEXT NOT NULL,
+            address TEXT,
+            start_index TEXT,
+            total INTEGER NOT NULL,
+            done INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            error TEXT,
+            answer TEXT NOT NULL DEFAULT '[]',
+            cancel INTEGER NOT NULL DEFAULT 0,
+            created REAL NOT NULL,
+            updated REAL NOT NULL,
+            pid INTEGER
+        );
+    """
+
+    columns = ('id', 'user', 'action', 'name', 'address', 'start_index', 'total', 'done',
+               'status', 'error', 'answer', 'cancel', 'created', 'updated', 'pid')
+
+    def __init__(self, path=HISTORY_DB):
+        super().__init__(path)
+        conn = self._connect()
+        if 'pid' not in [row[1] for row in conn.execute('PRAGMA table_info(jobs)')]:
+            try:
+                with conn:
+                    conn.execute('ALTER TABLE jobs ADD COLUMN pid INTEGER')
+            except sqlite3.OperationalError:
+                # Another process added it first
+                pass
+
+    def create(self, user, action, name, address, num, start_index):
+        """ Record a new (queued) job, returning its ID """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM jobs WHERE status IN (?, ?, ?) AND updated < ?',
+                         FINISHED + (now - JOB_RETENTION,))
+            conn.execute('INSERT INTO jobs (id, user, action, name, address, start_index, total,'
+                         ' status, created, updated, pid)'
+                         ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (job_id, user, action, name, address, start_index, num, 'queued',
+                          now, now, os.getpid()))
+        return job_id
+
+    def get(self, job_id):
+        """ Return job as a dict, or None """
+        row = self._connect().execute('SELECT ' + ', '.join(self.columns) +
+                                      ' FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(self.columns, row))
+        job['answer'] = json.loads(job['answer'])
+        job['cancel'] = bool(job['cancel'])
+        return job
+
+    def update(self, job_id, **fields):
+        """ Update job fields (answer is given as a list) """
+        if 'answer' in fields:
+            fields['answer'] = json.dumps(fields['answer'])
+        fields['updated'] = time.time()
+        names = sorted(fields)
+        conn = self._connect()
+        with conn:
+            conn.execute('UPDATE jobs SET ' + ', '.join(n + ' = ?' for n in names) +
+                         ' WHERE id = ?', [fields[n] for n in names] + [job_id])
+
+    def fail_orphans(self):
+        """
+        Fail the queued and running jobs whose process has exited (they would
+        otherwise never finish), returning how many there were
+        """
+        conn = self._connect()
+        rows = conn.execute("SELECT id, pid FROM jobs WHERE status IN ('queued', 'running')")
+        orphans = [job_id for job_id, pid in rows.fetchall() if not _process_exists(pid)]
+        with conn:
+            conn.executemany("UPDATE jobs SET status = 'failed', error = ?, updated = ? "
+                             "WHERE id = ? AND status IN ('queued', 'running')",
+                             [('worker process exited', time.time(), job_id)
+                              for job_id in orphans])
+        return len(orphans)
+
+    def request_cancel(self, job_id):
+        """ Ask for a job to be cancelled (takes effect before its next chunk) """
+        conn = self._connect()
+        with conn:
+            conn.execute('UPDATE jobs SET cancel = 1 WHERE id = ?', (job_id,))
+            conn.execute("UPDATE jobs SET status = 'cancelled', updated = ? "
+                         "WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+
+
+class JobQueue(object):
+    """
+    Runs range jobs on a bounded pool of worker threads (created on first use,
+    so each worker process gets its own)
+    """
+
+    def __init__(self, store, workers=JOB_WORKERS, chunk_size=JOB_CHUNK_SIZE):
+        self.store = store
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ Fail jobs left behind by worker processes that have exited """
+        try:
+            orphans = self.store.fail_orphans()
+        except sqlite3.Error as err:
+            app.logger.warning("jobs: unable to check for orphaned jobs: " + str(err))
+            return
+        if orphans:
+            app.logger.warning("jobs: failed " + str(orphans) + " jobs of exited processes")
+
+    def submit(self, user, action, name, address, num, start_index=None):
+        """
+        Queue a range-add, range-replace or range-delete, returning the job ID
+        """
+        if action != 'range-delete' or not is_address(name):
+            # Raises ValueError now, rather than in the job, if the name has no index
+            split_range_name(name, start_index)
+        job_id = self.store.create(user, action, name, address, num, start_index)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            self._executor.submit(self.run, job_id)
+        return job_id
+
+    def cancel(self, job_id):
+        """ Cancel a queued or running job """
+        self.store.request_cancel(job_id)
+
+    @staticmethod
+    def chunk(job, offset, num):
+        """
+        Apply num entries of job's range, starting offset entries in
+        """
+        user_manager = job['manager']
+        if job['action'] == 'range-delete':
+            entry = job['name']
+            if is_address(entry):
+                entry = str(ipaddress.ip_address(entry) + offset)
+            else:
+                prefix, index, width, domain = split_range_name(entry)
+                entry = range_name(prefix, index + offset, width, domain)
+            return user_manager.delete_range(entry, num)
+        force = job['action'] == 'range-replace'
+        ipaddr = str(ipaddress.ip_address(job['address']) + offset)
+        prefix, index, width, domain = split_range_name(job['name'], job['start_index'])
+        if job['start_index']:
+            return user_manager.add_range(job['name'], ipaddr, num,
+                                          str(index + offset).zfill(width), force)
+        return user_manager.add_range(range_name(prefix, index + offset, width, domain),
+                                      ipaddr, num, None, force)
+
+    def run(self, job_id):
+        """ Apply a job's range chunk by chunk, recording progress """
+        job = self.store.get(job_id)
+        if job is None or job['status'] != 'queued':
+            return
+        started = time.perf_counter()
+        answer, done, status, error = [], 0, 'done', None
+        try:
+            job['manager'] = create_manager(job['user'])
+            self.store.update(job_id, status='running')
+            while done < job['total']:
+                if self.store.get(job_id)['cancel']:
+                    status = 'cancelled'
+                    break
+                num = min(self.chunk_size, job['total'] - done)
+                answer.extend(str(a) for a in self.chunk(job, done, num))
+                done += num
+                self.store.update(job_id, done=done, answer=answer)
+        except Exception as err: # pylint: disable=broad-except
+            # Anything (DNS timeouts, database errors) fails the job rather than leaving
+            # it running forever
+            status, error = 'failed', str(err) or err.__class__.__name__
+        try:
+            self.store.update(job_id, status=status, error=error, done=done, answer=answer)
+        except Exception as err: # pylint: disable=broad-except
+            app.logger.warning("job " + job_id + ": unable to record " + status + ": " + str(err))
+        try:
+            if answer:
+                history_store.append(job['user'], job['action'], job['name'],
+                                     [job['address']] if job['address'] else [], answer)
+            audit_log.record(job['user'], job['action'], job['name'],
+                             [job['address']] if job['address'] else [], done,
+                             status if error is None else 'error: ' + error,
+                             time.perf_counter() - started, job=job_id)
+        except Exception as err: # pylint: disable=broad-except
+            app.logger.warning("job " + job_id + ": unable to record history: " + str(err))
+
+
+job_queue = JobQueue(JobStore())
+background_services.append(job_queue)
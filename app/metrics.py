@@ -0,0 +1,188 @@
+"""
+Request and backend metrics, exposed in Prometheus text format at /metrics.
+Values are per process: with several workers, each reports its own.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import g, request
+from app import app
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+registry = []
+
+def _labels(names, values):
+    """ Return Prometheus label text for names and values """
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(name + '="' + value + '"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric(object):
+    """
+    Base for labelled metrics. Each update takes the metric's lock only for a
+    dictionary update, so metrics are cheap enough to leave on.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        """ Return label values in label name order """
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def samples(self):
+        """ Return (suffix, label names, label values, value) tuples """
+        with self._lock:
+            return [('', self.label_names, key, value) for key, value in self._values.items()]
+
+    def render(self):
+        """ Return the metric in Prometheus text format """
+        lines = ['# HELP ' + self.name + ' ' + self.doc, '# TYPE ' + self.name + ' ' + self.kind]
+        for suffix, names, values, value in self.samples():
+            lines.append(self.name + suffix + _labels(names, values) + ' ' + repr(float(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """ Monotonically increasing count """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """ Increase counter """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """ Value that goes up and down """
+
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        """ Increase gauge """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """ Decrease gauge """
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """ Distribution of observed values (such as durations) """
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """ Record a value """
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """ Observe the duration of a block """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = dict((key, list(counts)) for key, counts in self._values.items())
+        names = self.label_names + ('le',)
+        samples = []
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                bound = '+Inf' if bound == float('inf') else repr(float(bound))
+                samples.append(('_bucket', names, key + (bound,), cumulative))
+            samples.append(('_sum', self.label_names, key, counts[-1]))
+            samples.append(('_count', self.label_names, key, cumulative))
+        return samples
+
+
+class StatsGauge(Metric):
+    """ Gauge read from an object's stats() dict when rendered (one sample per key) """
+
+    kind = 'gauge'
+
+    def __init__(self, name, doc, source):
+        super().__init__(name, doc, ('stat',))
+        self.source = source
+
+    def samples(self):
+        return [('', self.label_names, (key,), value)
+                for key, value in sorted(self.source.stats().items())]
+
+
+request_seconds = Histogram('pybinder_request_duration_seconds',
+                            'Request latency by endpoint (view or API resource).',
+                            ('endpoint', 'method', 'status'))
+requests_in_flight = Gauge('pybinder_requests_in_flight',
+                           'Requests currently being handled, by endpoint.', ('endpoint',))
+pam_seconds = Histogram('pybinder_pam_duration_seconds',
+                        'Time spent in PAM authentication.', ('result',))
+dns_query_seconds = Histogram('pybinder_dns_query_duration_seconds',
+                              'Time spent in DNS queries to the managed server.', ('source',))
+dns_update_seconds = Histogram('pybinder_dns_update_duration_seconds',
+                               'Time spent in DNS updates, by operation.', ('operation',))
+errors_total = Counter('pybinder_errors_total',
+                       'Requests that failed with an error, by endpoint and error type.',
+                       ('endpoint', 'type'))
+
+def count_error(err):
+    """ Count a ManageDNSError/ValueError (or other) failure of the current request """
+    errors_total.inc(endpoint=request.endpoint or 'none', type=err.__class__.__name__)
+
+def render():
+    """ Return all metrics in Prometheus text format """
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+@app.before_request
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_endpoint = request.endpoint or 'none'
+    requests_in_flight.inc(endpoint=g.metrics_endpoint)
+
+@app.after_request
+def _finish_request(response):
+    if 'metrics_start' in g:
+        request_seconds.observe(time.perf_counter() - g.metrics_start,
+                                endpoint=g.metrics_endpoint, method=request.method,
+                                status=response.status_code)
+    return response
+
+@app.teardown_request
+def _end_request(exc): # pylint: disable=unused-argument
+    if 'metrics_endpoint' in g:
+        requests_in_flight.dec(endpoint=g.metrics_endpoint)
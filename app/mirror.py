@@ -0,0 +1,317 @@
+"""
+Optional in-memory (and optionally on-disk) mirror of the managed zones, so
+searches can be answered locally instead of by the DNS server. Zones are
+loaded by zone transfer and kept current by polling the SOA serial and
+fetching changes by IXFR (the server may answer with a full transfer).
+"""
+
+import os
+import threading
+import time
+import dns.exception
+import dns.message
+import dns.name
+import dns.query
+import dns.rdatatype
+import dns.reversename
+import dns.xfr
+import dns.zone
+from app import app
+from .functions import ZONES, DNS_TIMEOUT, key_name, keyring, key_algorithm
+from .functions import normalize_query, forward_zone_for, reverse_zone_for, reverse_zones
+from .policy import SUBNETS, is_address
+from .metrics import dns_query_seconds
+
+MIRROR_REFRESH = app.config.get('MIRROR_REFRESH', 30)
+MIRROR_DIR = app.config.get('MIRROR_DIR')
+# Longest CNAME chain followed in the mirror
+MAX_CNAME_CHAIN = 8
+
+def mirrored_zones():
+    """
+    Return the zones to mirror: MIRROR_ZONES if configured, otherwise the
+    forward zones and the reverse zones covering SUBNETS
+    """
+    if 'MIRROR_ZONES' in app.config:
+        return list(app.config['MIRROR_ZONES'])
+    zones = list(ZONES)
+    for subnet in SUBNETS or []:
+        zones.extend(z for z in reverse_zones(subnet) if z not in zones)
+    return zones
+
+
+class MirrorAnswer(object):
+    """
+    Search result answered from the mirror. Like a SearchDNS result, the string
+    form is the query followed by the answer.
+    """
+
+    def __init__(self, query, records, ttl=None):
+        self.query = query
+        self.records = records
+        self.ttl = ttl
+
+    def __str__(self):
+        return self.query + ' ' + (' '.join(self.records) if self.records else 'Not found')
+
+
+class MirroredZone(object):
+    """
+    A single transferred zone and the forward and reverse indexes built from it
+    """
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.zone = dns.zone.Zone(origin)
+        self.serial = None
+        self.checked = None
+        self.forward = {}
+        self.reverse = {}
+        self.ttl = {}
+
+    def rebuild(self):
+        """ Rebuild the forward (name) and reverse (address) indexes """
+        forward, reverse, ttl = {}, {}, {}
+        for name, rdataset in self.zone.iterate_rdatasets():
+            fqdn = name.derelativize(self.zone.origin).to_text().rstrip('.').lower()
+            rdtype = dns.rdatatype.to_text(rdataset.rdtype)
+            if rdtype in ('A', 'AAAA', 'CNAME'):
+                forward.setdefault(fqdn, {})[rdtype] = [self._text(r) for r in rdataset]
+                ttl[fqdn] = rdataset.ttl
+            elif rdtype == 'PTR':
+                try:
+                    ip = str(dns.reversename.to_address(dns.name.from_text(fqdn)))
+                except (dns.exception.SyntaxError, ValueError):
+                    continue
+                reverse[ip] = [self._text(r) for r in rdataset]
+                ttl[ip] = rdataset.ttl
+        soa = self.zone.get_rdataset('@', 'SOA')
+        self.serial = soa[0].serial if soa else None
+        self.forward, self.reverse, self.ttl = forward, reverse, ttl
+
+    def _text(self, rdata):
+        """ Return rdata as text, with a target name (CNAME, PTR) made absolute """
+        if hasattr(rdata, 'target'):
+            return rdata.target.derelativize(self.zone.origin).to_text().rstrip('.').lower()
+        return rdata.to_text().lower()
+
+
+class ZoneMirror(object):
+    """
+    Mirror of a set of zones on server, refreshed by a background thread
+    """
+
+    def __init__(self, zones, server, port=53, refresh=MIRROR_REFRESH, directory=MIRROR_DIR,
+                 pool=None):
+        self.server = server
+        self.port = port
+        self.pool = pool
+        self.refresh = refresh
+        self.directory = directory
+        self.zones = dict((zone, MirroredZone(zone)) for zone in zones)
+        # Called with the mirror after a refresh that changed any zone
+        self.listeners = []
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        if directory:
+            for zone in self.zones.values():
+                self._load_file(zone)
+
+    def _path(self, zone):
+        """ Return on-disk location of zone """
+        return os.path.join(self.directory, zone.origin + '.zone')
+
+    def _load_file(self, zone):
+        """ Load a previously saved copy of zone (refresh then fetches only changes) """
+        try:
+            zone.zone = dns.zone.from_file(self._path(zone), zone.origin)
+            zone.rebuild()
+        except (IOError, dns.exception.DNSException) as err:
+            app.logger.debug("mirror: no usable copy of " + zone.origin + ": " + str(err))
+
+    def _save_file(self, zone):
+        """ Save zone to disk, replacing the previous copy atomically """
+        path = self._path(zone)
+        zone.zone.to_file(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def current_serial(self, zone):
+        """ Return the SOA serial the server currently has for zone """
+        query = dns.message.make_query(zone.origin, 'SOA')
+        with dns_query_seconds.time(source='mirror'):
+            if self.pool:
+                response = self.pool.query(query)
+            else:
+                response = dns.query.udp(query, self.server, port=self.port, timeout=DNS_TIMEOUT)
+        for rrset in response.answer:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return rrset[0].serial
+        return None
+
+    def update_zone(self, zone, check_serial=True):
+        """
+        Bring zone up to date (IXFR from the mirrored serial, or AXFR when
+        there is no copy yet), returning True if it changed
+        """
+        started = time.monotonic()
+        if check_serial and zone.serial is not None and \
+                self.current_serial(zone) == zone.serial:
+            zone.checked = started
+            self._clean(zone, started)
+            return False
+        query, _ = dns.xfr.make_query(zone.zone, serial=0 if zone.serial is not None else None,
+                                      keyring=keyring, keyname=key_name,
+                                      keyalgorithm=key_algorithm)
+        try:
+            dns.query.inbound_xfr(self.server, zone.zone, query, port=self.port,
+                                  timeout=DNS_TIMEOUT)
+        except (EOFError, dns.exception.DNSException):
+            # Start over with a full transfer into a fresh zone
+            zone.zone = dns.zone.Zone(zone.origin)
+            query, _ = dns.xfr.make_query(zone.zone, serial=None, keyring=keyring,
+                                          keyname=key_name, keyalgorithm=key_algorithm)
+            dns.query.inbound_xfr(self.server, zone.zone, query, port=self.port,
+                                  timeout=DNS_TIMEOUT)
+        zone.rebuild()
+        zone.checked = started
+        self._clean(zone, started)
+        if self.directory:
+            self._save_file(zone)
+        return True
+
+    def refresh_all(self):
+        """ Bring every zone up to date, logging (not raising) failures """
+        changed = False
+        for zone in self.zones.values():
+            try:
+                changed = self.update_zone(zone) or changed
+            except (EOFError, OSError, dns.exception.DNSException) as err:
+                app.logger.warning("mirror: unable to refresh " + zone.origin + ": " + str(err))
+        if changed:
+            for listener in self.listeners:
+                listener(self)
+
+    def _run(self):
+        """ Background refresh loop """
+        while True:
+            self.refresh_all()
+            self._wakeup.wait(self.refresh)
+            self._wakeup.clear()
+
+    def start(self):
+        """ Start the background thread (loads zones, then keeps them current) """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='zone-mirror', daemon=True)
+            self._thread.start()
+
+    def _zone_of(self, key):
+        """ Return the MirroredZone holding key (a normalized name or address), if any """
+        try:
+            origin = reverse_zone_for(key)
+        except ValueError:
+            origin = forward_zone_for(key)
+        return self.zones.get(origin)
+
+    def _clean(self, zone, started):
+        """ Forget dirty entries of zone that were marked before started """
+        with self._lock:
+            for key, (origin, marked) in list(self._dirty.items()):
+                if origin == zone.origin and marked < started:
+                    del self._dirty[key]
+
+    def invalidate(self, *terms):
+        """
+        Mark terms as changed: they are answered live until their zone has been
+        refreshed, and a refresh is started now
+        """
+        now = time.monotonic()
+        with self._lock:
+            for term in terms:
+                key = normalize_query(term)
+                zone = self._zone_of(key)
+                if zone:
+                    self._dirty[key] = (zone.origin, now)
+        self._wakeup.set()
+
+    def clear(self):
+        """ Mark every zone as changed (answered live until refreshed) """
+        now = time.monotonic()
+        with self._lock:
+            for zone in self.zones.values():
+                self._dirty[zone.origin] = (zone.origin, now)
+        self._wakeup.set()
+
+    def lookup(self, term):
+        """
+        Return a MirrorAnswer for term, or None if the mirror can't answer it
+        (zone not mirrored, not loaded yet, or changed since the last refresh)
+        """
+        key = normalize_query(term)
+        zone = self._current_zone(key)
+        if zone is None:
+            return None
+        if is_address(term.strip()):
+            return MirrorAnswer(term, zone.reverse.get(key, []), zone.ttl.get(key))
+        records = zone.forward.get(key, {})
+        chain = []
+        while 'CNAME' in records:
+            if len(chain) == MAX_CNAME_CHAIN:
+                # Too long (or a loop): left to a live lookup
+                return None
+            # Targets are stored fully qualified
+            target = records['CNAME'][0]
+            chain.append(target)
+            target_zone = self._current_zone(target)
+            if target_zone is None:
+                return MirrorAnswer(term, chain, zone.ttl.get(key))
+            records = target_zone.forward.get(target, {})
+        return MirrorAnswer(term, chain + records.get('A', []) + records.get('AAAA', []),
+                            zone.ttl.get(key))
+
+    def _current_zone(self, key):
+        """
+        Return the mirrored zone holding key, or None if it isn't mirrored, isn't
+        loaded yet, or key (or the zone) has changed since the last refresh
+        """
+        zone = self._zone_of(key)
+        if zone is None or zone.serial is None:
+            return None
+        with self._lock:
+            if key in self._dirty or zone.origin in self._dirty:
+                return None
+        return zone
+
+    def status(self):
+        """ Return serial and staleness (seconds since last successful check) per zone """
+        now = time.monotonic()
+        status = {}
+        for origin, zone in self.zones.items():
+            status[origin] = {'serial': zone.serial,
+                              'age': round(now - zone.checked, 3) if zone.checked else None}
+        return status
+
+
+class MirrorSearch(object):
+    """
+    Searcher answering from a ZoneMirror, falling back to a live search (such
+    as SearchDNS) for anything the mirror can't answer
+    """
+
+    def __init__(self, mirror, search):
+        self.mirror = mirror
+        self.search = search
+
+    def query(self, entry):
+        """ Return search result for entry """
+        return self.mirror.lookup(entry) or self.search.query(entry)
+
+    def invalidate(self, *terms):
+        """ Pass change notification on to the mirror """
+        self.mirror.invalidate(*terms)
+
+    def clear(self):
+        """ Pass change notification on to the mirror """
+        self.mirror.clear()
+
@@ -0,0 +1,62 @@
+"""
+Dry-run planning of range adds and replaces: the records a range would
+touch are looked up in one pipelined pass, and the changes it would make
+are returned without writing anything.
+"""
+
+import ipaddress
+from collections import OrderedDict
+from .functions import expand_range, address_type, lookup_many, qualify
+
+ACTIONS = ('create', 'replace', 'delete', 'conflict')
+
+
+def _change(action, name, address, existing=None):
+    """ Return a single planned change """
+    change = OrderedDict([('action', action), ('name', name), ('address', address)])
+    if existing:
+        change['existing'] = existing
+    return change
+
+def plan_range(name, ipaddr, num, start_index=None, force=False):
+    """
+    Return the changes a range add (or, with force, a range replace) would
+    make, and a count of each action. Without force, any entry with existing
+    records is a conflict. With force, it is a replace, and the records it
+    displaces (other addresses of the name, aliases, other names of the
+    address) are deletes.
+    """
+    entries = expand_range(qualify(name), ipaddr, num, start_index)
+    queries = []
+    for entry_name, address in entries:
+        queries.extend([(entry_name, address_type(address)), (entry_name, 'CNAME'),
+                        (ipaddress.ip_address(address).reverse_pointer, 'PTR')])
+    results = lookup_many(queries)
+    changes = []
+    for index, (entry_name, address) in enumerate(entries):
+        addresses, aliases, names = results[index * 3:index * 3 + 3]
+        if aliases:
+            # An A lookup of an alias answers with the addresses of its target
+            addresses = []
+        names = [n for n in names if n.lower() != entry_name.lower()]
+        existing = ['CNAME ' + a for a in aliases] + \
+                   [address_type(a) + ' ' + a for a in addresses] + \
+                   ['PTR ' + n for n in names]
+        if not existing:
+            changes.append(_change('create', entry_name, address))
+        elif not force:
+            changes.append(_change('conflict', entry_name, address, existing))
+        else:
+            changes.append(_change('replace', entry_name, address, existing))
+            for alias in aliases:
+                changes.append(_change('delete', entry_name, None, ['CNAME ' + alias]))
+            for other in addresses:
+                if other != address:
+                    changes.append(_change('delete', entry_name, other,
+                                           [address_type(other) + ' ' + other]))
+            for other in names:
+                changes.append(_change('delete', other, address, ['PTR ' + other]))
+    summary = OrderedDict((action, 0) for action in ACTIONS)
+    for change in changes:
+        summary[change['action']] += 1
+    return {'changes': changes, 'summary': summary, 'lookups': len(queries)}
@@ -0,0 +1,151 @@
+"""
+Allow-list policy: which names (ALLOWED_DOMAINS, FORWARD_ZONE) and which
+addresses (SUBNETS) may be modified. Shared by the web views and the API.
+"""
+
+import ipaddress
+from bisect import bisect_right
+from app import app
+from .timing import timed
+
+FORWARD_ZONE = app.config['FORWARD_ZONE']
+if 'ALLOWED_DOMAINS' in app.config:
+    ALLOWED_DOMAINS = [d for d in app.config['ALLOWED_DOMAINS']]
+else:
+    ALLOWED_DOMAINS = None
+
+if 'SUBNETS' in app.config:
+    SUBNETS = [ipaddress.ip_network(x) for x in app.config['SUBNETS']]
+else:
+    SUBNETS = None
+
+class DomainMatcher(object):
+    """
+    Suffix trie of domain labels (stored right to left). A domain matches when
+    it is one of the domains, or nested anywhere below one of them.
+    """
+
+    def __init__(self, domains):
+        self._root = {}
+        for domain in domains:
+            node = self._root
+            for label in reversed(domain.lower().rstrip('.').split('.')):
+                node = node.setdefault(label, {})
+            node[None] = True
+
+    def match(self, domain):
+        """ Return True if domain is at or below one of the domains """
+        node = self._root
+        for label in reversed(domain.lower().rstrip('.').split('.')):
+            node = node.get(label)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+
+class SubnetIndex(object):
+    """
+    Subnets compiled to sorted, merged integer intervals (per IP version), so
+    membership is a binary search rather than a test against every network.
+    """
+
+    def __init__(self, networks):
+        self._starts = {4: [], 6: []}
+        self._ends = {4: [], 6: []}
+        intervals = sorted((n.version, int(n.network_address), int(n.broadcast_address))
+                           for n in networks)
+        for version, start, end in intervals:
+            starts, ends = self._starts[version], self._ends[version]
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+
+    def _interval(self, version, value):
+        """ Return index of the interval holding value, or None """
+        i = bisect_right(self._starts[version], value) - 1
+        if i >= 0 and value <= self._ends[version][i]:
+            return i
+        return None
+
+    def contains(self, ip):
+        """ Return True if ip is within one of the subnets """
+        ip = ipaddress.ip_address(ip)
+        return self._interval(ip.version, int(ip)) is not None
+
+    def contains_range(self, ip, num):
+        """ Return True if all num addresses starting at ip are within the subnets """
+        ip = ipaddress.ip_address(ip)
+        i = self._interval(ip.version, int(ip))
+        return i is not None and int(ip) + num - 1 <= self._ends[ip.version][i]
+
+    def contains_all(self, ips):
+        """
+        Return True if every address in ips is within the subnets (one pass
+        over the sorted addresses and intervals)
+        """
+        values = sorted((a.version, int(a)) for a in map(ipaddress.ip_address, ips))
+        i, version = 0, None
+        for ver, value in values:
+            if ver != version:
+                version, i = ver, 0
+            starts, ends = self._starts[version], self._ends[version]
+            while i < len(ends) and ends[i] < value:
+                i += 1
+            if i == len(ends) or value < starts[i]:
+                return False
+        return True
+
+
+domain_matcher = DomainMatcher((ALLOWED_DOMAINS or []) + [FORWARD_ZONE])
+subnet_index = SubnetIndex(SUBNETS or [])
+
+@timed('policy')
+def name_allowed(name):
+    """ Return true if name is within (or below) the allowed domain list """
+    if not ALLOWED_DOMAINS:
+        return True
+    if '.' in name:
+        [_, domain] = name.split('.', 1)
+    else:
+        return True
+    return domain_matcher.match(domain)
+
+@timed('policy')
+def domain_allowed(domain):
+    """ Return true if domain is one of (or below) the allowed domains """
+    if not ALLOWED_DOMAINS:
+        return True
+    return domain_matcher.match(domain)
+
+@timed('policy')
+def address_allowed(ip):
+    """ Return true if IP address is within the allowed subnet list """
+    if not SUBNETS:
+        return True
+    return subnet_index.contains(ip)
+
+@timed('policy')
+def addresses_allowed(ips):
+    """ Return true if every IP address is within the allowed subnet list """
+    if not SUBNETS:
+        return True
+    return subnet_index.contains_all(ips)
+
+@timed('policy')
+def range_allowed(ip, num):
+    """ Return true if num consecutive addresses from ip are all allowed """
+    if not SUBNETS:
+        return True
+    return subnet_index.contains_range(ip, num)
+
+def is_address(entry):
+    """ Check if entry is a valid IP address """
+    try:
+        _ = ipaddress.ip_address(entry)
+    except ValueError:
+        return False
+    return True
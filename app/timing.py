@@ -0,0 +1,191 @@
+"""
+Per-request timing: spans (auth, policy checks, DNS round trips, template
+rendering) are returned in a Server-Timing header, and requests slower than
+SLOW_REQUEST_MS have a profile (stack samples, or cProfile output) saved to
+PROFILE_DIR for later inspection.
+"""
+
+import cProfile
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from flask import before_render_template, g, has_request_context, request
+from flask import template_rendered
+from app import app, background_services
+
+SLOW_REQUEST_MS = app.config.get('SLOW_REQUEST_MS')
+PROFILE_MODE = app.config.get('PROFILE_MODE', 'sample')
+PROFILE_DIR = app.config.get('PROFILE_DIR', os.path.join(app.root_path, '..', 'slow-requests'))
+PROFILE_KEEP = app.config.get('PROFILE_KEEP', 100)
+PROFILE_INTERVAL_MS = app.config.get('PROFILE_INTERVAL_MS', 10)
+
+def add_span(name, duration):
+    """ Add duration (seconds) to the named span of the current request """
+    if not has_request_context():
+        return
+    spans = g.setdefault('timing_spans', OrderedDict())
+    total, count = spans.get(name, (0.0, 0))
+    spans[name] = (total + duration, count + 1)
+
+@contextmanager
+def span(name):
+    """ Time a block as part of the named span of the current request """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span(name, time.perf_counter() - start)
+
+def timed(name):
+    """ Decorator timing every call of a function as part of the named span """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def server_timing(spans, total):
+    """ Return Server-Timing header value for spans and the total duration """
+    entries = []
+    for name, (duration, count) in spans.items():
+        entry = name + ';dur=' + str(round(duration * 1000, 2))
+        if count > 1:
+            entry += ';desc="' + str(count) + ' calls"'
+        entries.append(entry)
+    entries.append('total;dur=' + str(round(total * 1000, 2)))
+    return ', '.join(entries)
+
+
+class SlowRequestProfiler(object):
+    """
+    Keeps a profile of each in-flight request and saves those of requests
+    slower than threshold_ms to directory (keeping the newest keep files).
+    In 'sample' mode, a background thread samples the stacks of in-flight
+    requests every interval_ms (cheap); 'cprofile' mode runs cProfile on
+    every request (thorough, but slows every request down).
+    """
+
+    def __init__(self, threshold_ms, directory, mode=PROFILE_MODE, keep=PROFILE_KEEP,
+                 interval_ms=PROFILE_INTERVAL_MS):
+        self.threshold = threshold_ms / 1000.0
+        self.directory = directory
+        self.mode = mode
+        self.keep = keep
+        self.interval = interval_ms / 1000.0
+        self.saved = 0
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """ Start the sampling thread (sample mode only) """
+        if self.mode == 'sample' and (self._thread is None or not self._thread.is_alive()):
+            self._thread = threading.Thread(target=self._run, name='request-sampler',
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """ Sample stacks of in-flight requests, as folded stack strings """
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = dict(self._active)
+            if not active:
+                continue
+            frames = sys._current_frames() # pylint: disable=protected-access
+            for thread_id, samples in active.items():
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(os.path.basename(code.co_filename) + ':' + code.co_name)
+                    frame = frame.f_back
+                if stack:
+                    samples[';'.join(reversed(stack))] += 1
+
+    def begin(self):
+        """ Start profiling the current request """
+        if self.mode == 'cprofile':
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+        else:
+            with self._lock:
+                self._active[threading.get_ident()] = Counter()
+
+    def end(self, duration):
+        """ Stop profiling the current request, saving the profile if it was slow """
+        if self.mode == 'cprofile':
+            profiler = g.pop('profiler', None)
+            if profiler is None:
+                return
+            profiler.disable()
+        else:
+            with self._lock:
+                samples = self._active.pop(threading.get_ident(), None)
+        if duration < self.threshold:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        name = time.strftime('%Y%m%d-%H%M%S') + '-' + str(os.getpid()) + '-' + \
+               (request.endpoint or 'none') + '-' + str(int(duration * 1000)) + 'ms'
+        path = os.path.join(self.directory, name)
+        if self.mode == 'cprofile':
+            profiler.dump_stats(path + '.prof')
+        else:
+            with open(path + '.txt', 'w') as out:
+                out.write(request.method + ' ' + request.full_path + ' ' +
+                          str(round(duration * 1000, 1)) + 'ms\n')
+                out.write('Server-Timing: ' + g.get('server_timing', '') + '\n\n')
+                for stack, count in (samples or Counter()).most_common():
+                    out.write(stack + ' ' + str(count) + '\n')
+        self.saved += 1
+        app.logger.warning("slow request (" + str(int(duration * 1000)) + "ms) profiled in " +
+                           path)
+        self._rotate()
+
+    def _rotate(self):
+        """ Remove the oldest saved profiles beyond keep """
+        paths = [os.path.join(self.directory, f) for f in os.listdir(self.directory)]
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:max(0, len(paths) - self.keep)]:
+            os.remove(path)
+
+
+if SLOW_REQUEST_MS:
+    profiler = SlowRequestProfiler(SLOW_REQUEST_MS, PROFILE_DIR)
+    background_services.append(profiler)
+else:
+    profiler = None
+
+@app.before_request
+def _start_timing():
+    g.timing_start = time.perf_counter()
+    if profiler:
+        profiler.begin()
+
+@app.after_request
+def _add_server_timing(response):
+    if 'timing_start' in g:
+        g.server_timing = server_timing(g.get('timing_spans', {}),
+                                        time.perf_counter() - g.timing_start)
+        response.headers['Server-Timing'] = g.server_timing
+    return response
+
+@app.teardown_request
+def _end_timing(exc): # pylint: disable=unused-argument
+    if profiler and 'timing_start' in g:
+        profiler.end(time.perf_counter() - g.timing_start)
+
+@before_render_template.connect_via(app)
+def _start_render(sender, template, context, **extra): # pylint: disable=unused-argument
+    g.render_start = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _end_render(sender, template, context, **extra): # pylint: disable=unused-argument
+    if 'render_start' in g:
+        add_span('render', time.perf_counter() - g.pop('render_start'))
@@ -14,17 +14,30 @@ Copyright (c) 2017 IBM Corp.
 
 import os
 import sys
-import ipaddress
+import time
 from collections import OrderedDict
-from flask import render_template
+import dns.exception
+from flask import Response, redirect, render_template, request, url_for
 from flask_httpauth import HTTPBasicAuth
 from flask_restful import Api
 from app import app
 from .forms import AddForm, AliasForm, DeleteForm, RangeAddForm
 from .forms import RangeDeleteForm, SearchForm
-from .functions import searcher, create_manager
-from .api import SearchRecord, AddAlias, AddRecord, DeleteRecord, ReplaceRecord
+from .functions import searcher, search_terms, record_index, ManagerPool
+from .httpcache import cached_response, max_age
+from .index import is_pattern
+from .history import HISTORY_ACTIONS, history_store, parse_query
+from .jobs import job_queue
+from .metrics import count_error, render as render_metrics
+from .plan import plan_range
+from .timing import span
+from .api import SearchRecord, BulkSearch, AddAlias, AddRecord, DeleteRecord
+from .api import ReplaceRecord, BatchChange, MirrorStatus, RangeJob, JobStatus, Allocate
+from .api import RangePlan, Export, PatternSearch, History
+from .audit import audit_log
 from .auth import SystemAuth
+from .policy import FORWARD_ZONE, name_allowed, address_allowed, addresses_allowed
+from .policy import range_allowed, is_address
 
 # Need to add path for pybinder
 # Assumes that pybinder is a sibling folder (same parent). Adjust if necessary.
@@ -35,56 +48,36 @@ from managedns import ManageDNSError
 # Enable Flask-RESTful API and add endpoints and resources
 api = Api(app)
 api.add_resource(SearchRecord, '/api/search/<entry>')
+api.add_resource(BulkSearch, '/api/search')
+api.add_resource(PatternSearch, '/api/pattern/<path:pattern>')
 api.add_resource(AddAlias, '/api/alias')
 api.add_resource(AddRecord, '/api/add')
 api.add_resource(DeleteRecord, '/api/delete/<entry>')
 api.add_resource(ReplaceRecord, '/api/replace')
+api.add_resource(BatchChange, '/api/batch')
+api.add_resource(MirrorStatus, '/api/mirror')
+api.add_resource(RangeJob, '/api/range')
+api.add_resource(RangePlan, '/api/range/plan')
+api.add_resource(JobStatus, '/api/jobs/<job_id>')
+api.add_resource(Allocate, '/api/allocate')
+api.add_resource(Export, '/api/export/<path:target>')
+api.add_resource(History, '/api/history', endpoint='api_history')
 
 # Global variable and constants declarations
 http_auth = HTTPBasicAuth()
 system_auth = SystemAuth()
-dns_manager = {}
+dns_manager = ManagerPool()
 
-FORWARD_ZONE = app.config['FORWARD_ZONE']
-if 'ALLOWED_DOMAINS' in app.config:
-    ALLOWED_DOMAINS = [d for d in app.config['ALLOWED_DOMAINS']]
-else:
-    ALLOWED_DOMAINS = None
-
-if 'SUBNETS' in app.config:
-    SUBNETS = [ipaddress.ip_network(x) for x in app.config['SUBNETS']]
-else:
-    SUBNETS = None
-
-def name_allowed(name):
-    """ Return true if name is within the allowed domain list """
-    if not ALLOWED_DOMAINS:
-        return True
-    if '.' in name:
-        [hostname, domain] = name.split('.', 1)
-    else:
-        return True
-    if domain in ALLOWED_DOMAINS or domain == FORWARD_ZONE:
-        return True
-    return False
-
-def address_allowed(ip):
-    """ Return true if IP address is within the allowed subnet list """
-    if not SUBNETS:
-        return True
-    ip = ipaddress.ip_address(ip)
-    for sub in SUBNETS:
-        if ip in sub:
-            return True
-    return False
+def record_history(user, action, name, addresses, answer):
+    """
+    Save a transaction to the shared history store
+    """
+    history_store.append(user, action, name, addresses, answer)
 
-def is_address(entry):
-    """ Check if entry is a valid IP address """
-    try:
-        _ = ipaddress.ip_address(entry)
-    except ValueError:
-        return False
-    return True
+@app.template_filter('timestamp')
+def format_timestamp(seconds):
+    """ Format seconds since the epoch as local date and time """
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(seconds))
 
 @http_auth.verify_password
 def verify_pwd(user, pwd):
@@ -101,15 +94,36 @@ def index():
     """
     return render_template('index.html', title='Home', user=http_auth.username())
 
+@app.route('/metrics')
+def metrics():
+    """
+    Request, authentication and DNS latency metrics (Prometheus text format)
+    """
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/search/<name_or_address>')
 def search_specific(name_or_address):
     """
-    Allows for direct searches through the URL (not the same as the API)
+    Allows for direct searches through the URL (not the same as the API),
+    cacheable by the client for the record TTL
     """
     user = http_auth.username()
     answer = {}
-    answer[name_or_address] = str(searcher.query(name_or_address)).split(' ', 1)[1]
-    return render_template('search_results.html', title='Search', answer=answer, user=user)
+    result = searcher.query(name_or_address)
+    answer[name_or_address] = str(result).split(' ', 1)[1]
+    page = render_template('search_results.html', title='Search', answer=answer, user=user)
+    return cached_response(page, 'text/html', max_age([getattr(result, 'ttl', None)]))
+
+def search_pattern(pattern):
+    """
+    Return OrderedDict of name (or address) to answer for a glob or CIDR pattern
+    """
+    if record_index is None:
+        return OrderedDict([(pattern, 'Error: pattern search is not enabled')])
+    try:
+        return record_index.search(pattern) or OrderedDict([(pattern, 'Not found')])
+    except ValueError as err:
+        return OrderedDict([(pattern, 'Error: ' + str(err))])
 
 @app.route('/search', methods=['GET', 'POST'])
 def search_main():
@@ -120,11 +134,15 @@ def search_main():
     form = SearchForm()
     user = http_auth.username()
     if form.validate_on_submit():
-        query_terms = form.search_terms.data.split(' ')
+        terms = form.search_terms.data.split(' ')
+        with span('dns'):
+            exact = search_terms(t for t in terms if not is_pattern(t))
         answer = OrderedDict()
-        for query in query_terms:
-            result = str(searcher.query(query))
-            answer[query] = result.split(' ', 1)[1]
+        for term in terms:
+            if is_pattern(term):
+                answer.update(search_pattern(term))
+            elif term in exact:
+                answer[term] = exact[term]
         return render_template('search_results.html', title='Search', answer=answer, user=user)
     return render_template('search.html', title='Search', zone=FORWARD_ZONE, form=form, user=user)
 
@@ -136,23 +154,23 @@ def add_main(force=False, title='Add'):
     """
     form = AddForm()
     user = http_auth.username()
-    if user not in dns_manager:
-        dns_manager[user] = create_manager(user)
     if form.validate_on_submit():
         name = ''.join(form.name.data.split())
         ipaddr = form.ipaddr.data.strip()
         ipaddr = ipaddr.split(' ')
         if '.' not in name:
             name = name + '.' + FORWARD_ZONE
+        action = 'replace' if force else 'add'
         try:
-            if not name_allowed(name):
-                raise ValueError("Not authorized to add " + name)
-            for ip in ipaddr:
-                if not address_allowed(ip):
-                    raise ValueError("Not authorized to add " + ip)
-            answer = dns_manager[user].add_record(name, ipaddr, force)
-            app.logger.info(user + " added " + name + " " + ' '.join(ipaddr))
+            with audit_log.action(user, action, name, ipaddr):
+                if not name_allowed(name):
+                    raise ValueError("Not authorized to add " + name)
+                if not addresses_allowed(ipaddr):
+                    raise ValueError("Not authorized to add " + ' '.join(ipaddr))
+                answer = dns_manager.get(user).add_record(name, ipaddr, force)
+                record_history(user, action, name, ipaddr, answer)
         except (ManageDNSError, ValueError) as mde:
+            count_error(mde)
             return render_template('errors.html', title='Error', error=[mde], user=user)
         return render_template('results.html', title=title, answer=answer, user=user)
     return render_template('add.html', title=title, force=force,
@@ -167,8 +185,6 @@ def add_alias(force=False, title='Add Alias'):
     """
     form = AliasForm()
     user = http_auth.username()
-    if user not in dns_manager:
-        dns_manager[user] = create_manager(user)
     if form.validate_on_submit():
         alias = ''.join(form.alias.data.split())
         real_name = ''.join(form.real_name.data.split())
@@ -177,11 +193,14 @@ def add_alias(force=False, title='Add Alias'):
         if '.' not in real_name:
             real_name = real_name + '.' + FORWARD_ZONE
         try:
-            if not name_allowed(alias):
-                raise ValueError("Not authorized to add " + alias)
-            answer = dns_manager[user].add_alias(alias, real_name, force)
-            app.logger.info(user + " added alias " + alias + " for " + real_name)
+            with audit_log.action(user, 'alias', alias) as entry:
+                entry['target'] = real_name
+                if not name_allowed(alias):
+                    raise ValueError("Not authorized to add " + alias)
+                answer = dns_manager.get(user).add_alias(alias, real_name, force)
+                record_history(user, 'alias', alias, [], answer)
         except (ManageDNSError, ValueError) as mde:
+            count_error(mde)
             return render_template('errors.html', title='Error', error=[mde], user=user)
         return render_template('results.html', title=title, answer=answer, user=user)
     return render_template('alias.html', title=title, force=force,
@@ -195,26 +214,30 @@ def add_range(force=False, title='Range Add'):
     """
     form = RangeAddForm()
     user = http_auth.username()
-    if user not in dns_manager:
-        dns_manager[user] = create_manager(user)
     if form.validate_on_submit():
         name = ''.join(form.name.data.split())
         ipaddr = form.ipaddr.data.strip()
         num = form.num.data
-        start_index = form.start_index.data
+        start_index = (form.start_index.data or '').strip() or None
         if '.' not in name:
             name = name + '.' + FORWARD_ZONE
+        action = 'range-replace' if force else 'range-add'
         try:
             if not name_allowed(name):
                 raise ValueError("Not authorized to add " + name)
-            if not address_allowed(ipaddr):
-                raise ValueError("Not authorized to add " + ipaddr)
-            answer = dns_manager[user].add_range(name, ipaddr, num, start_index, force)
-            logmessage = " added " + str(num) + " entries starting with " + name + str(start_index)
-            app.logger.info(user + logmessage)
-        except (ManageDNSError, ValueError) as mde:
+            if not range_allowed(ipaddr, num):
+                raise ValueError("Not authorized to add " + str(num) + " entries from " + ipaddr)
+            if request.form.get('plan'):
+                plan = plan_range(name, ipaddr, num, start_index, force)
+                return render_template('plan.html', title=title, force=force, plan=plan,
+                                       user=user, form=form)
+            job_id = job_queue.submit(user, action, name, ipaddr, num, start_index)
+            audit_log.record(user, action + '-submit', name, [ipaddr], num, job=job_id,
+                             start_index=start_index)
+        except (ManageDNSError, ValueError, OSError, EOFError, dns.exception.DNSException) as mde:
+            count_error(mde)
             return render_template('errors.html', title='Error', error=[mde], user=user)
-        return render_template('results.html', title=title, answer=answer, user=user)
+        return redirect(url_for('job_status', job_id=job_id))
     return render_template('range-add.html', title=title, force=force,
                            zone=FORWARD_ZONE, user=user, form=form)
 
@@ -242,20 +265,20 @@ def delete_main():
     """
     form = DeleteForm()
     user = http_auth.username()
-    if user not in dns_manager:
-        dns_manager[user] = create_manager(user)
     if form.validate_on_submit():
         entry = form.entry.data.strip()
         try:
-            if is_address(entry):
-                if not address_allowed(entry):
-                    raise ValueError("Not authorized to delete " + entry)
-            else:
-                if not name_allowed(entry):
-                    raise ValueError("Not authorized to delete " + entry)
-            answer = dns_manager[user].delete_record(entry)
-            app.logger.info(user + " deleted " + entry)
+            with audit_log.action(user, 'delete', entry):
+                if is_address(entry):
+                    if not address_allowed(entry):
+                        raise ValueError("Not authorized to delete " + entry)
+                else:
+                    if not name_allowed(entry):
+                        raise ValueError("Not authorized to delete " + entry)
+                answer = dns_manager.get(user).delete_record(entry)
+                record_history(user, 'delete', entry, [], answer)
         except (ManageDNSError, ValueError) as mde:
+            count_error(mde)
             return render_template('errors.html', title='Error', error=[mde], user=user)
         return render_template('results.html', title='Delete', answer=answer, user=user)
     return render_template('delete.html', title='Delete', zone=FORWARD_ZONE, user=user, form=form)
@@ -268,39 +291,76 @@ def delete_range():
     """
     form = RangeDeleteForm()
     user = http_auth.username()
-    if user not in dns_manager:
-        dns_manager[user] = create_manager(user)
     if form.validate_on_submit():
         entry = form.entry.data.strip()
         num = form.num.data
         try:
             if is_address(entry):
-                if not address_allowed(entry):
-                    raise ValueError("Not authorized to add " + entry)
+                if not range_allowed(entry, num):
+                    raise ValueError("Not authorized to delete " + str(num) +
+                                     " entries from " + entry)
             else:
                 if not name_allowed(entry):
                     raise ValueError("Not authorized to add " + entry)
-            answer = dns_manager[user].delete_range(entry, num)
-            app.logger.info(user + " deleted " + str(num) + " entries starting with " + entry)
+            job_id = job_queue.submit(user, 'range-delete', entry, None, num)
+            audit_log.record(user, 'range-delete-submit', entry, count=num, job=job_id)
         except (ManageDNSError, ValueError) as mde:
+            count_error(mde)
             return render_template('errors.html', title='Error', error=[mde], user=user)
-        return render_template('results.html', title='Range Delete', answer=answer, user=user)
+        return redirect(url_for('job_status', job_id=job_id))
     return render_template('range-delete.html', title='Range Delete', zone=FORWARD_ZONE,
                            user=user, form=form)
 
+@app.route('/jobs/<job_id>')
+@http_auth.login_required
+def job_status(job_id):
+    """
+    Show progress (and, once finished, results) of a range job
+    """
+    user = http_auth.username()
+    job = job_queue.store.get(job_id)
+    if job is None or job['user'] != user:
+        return render_template('errors.html', title='Error', error=['No such job ' + job_id],
+                               user=user), 404
+    return render_template('job.html', title='Job', job=job, user=user)
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+@http_auth.login_required
+def cancel_job(job_id):
+    """
+    Cancel a range job (entries already applied are kept)
+    """
+    user = http_auth.username()
+    job = job_queue.store.get(job_id)
+    if job is None or job['user'] != user:
+        return render_template('errors.html', title='Error', error=['No such job ' + job_id],
+                               user=user), 404
+    job_queue.cancel(job_id)
+    audit_log.record(user, 'cancel', job['name'], job=job_id)
+    return redirect(url_for('job_status', job_id=job_id))
+
 @app.route('/history')
 @http_auth.login_required
 def history():
     """
-    Return user history (reversed, most recent first)
+    Return a page of user history (most recent first), optionally filtered by
+    action, name, address and time
     """
     user = http_auth.username()
-    if user not in dns_manager:
-        dns_manager[user] = create_manager(user)
-    user_history = dns_manager[user].get_history()
-    if user_history:
-        user_history = reversed(user_history)
-    return render_template('history.html', title='History', history=user_history, user=user)
+    try:
+        query = parse_query(request.args)
+    except ValueError as err:
+        count_error(err)
+        return render_template('errors.html', title='Error', error=[err], user=user), 400
+    entries, cursor = history_store.page(user, **query)
+    if cursor is not None:
+        args = request.args.to_dict()
+        args['before'] = cursor
+        older = url_for('history', **args)
+    else:
+        older = None
+    return render_template('history.html', title='History', history=entries, older=older,
+                           filters=request.args, actions=HISTORY_ACTIONS, user=user)
 
 @app.route('/clear-history', methods=['POST'])
 @http_auth.login_required
@@ -309,8 +369,6 @@ def clear_history():
     Clear user history
     """
     user = http_auth.username()
-    if user in dns_manager:
-        dns_manager[user].clear_history()
-        app.logger.info(user + " cleared their history")
-    user_history = dns_manager[user].get_history()
-    return render_template('history.html', title='History', history=user_history, user=user)
+    history_store.clear(user)
+    audit_log.record(user, 'clear-history')
+    return redirect(url_for('history'))
@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+"""
+Stand-in authoritative DNS server for benchmarks (dnspython based, in memory).
+
+Answers queries for its zones (including AXFR/IXFR, always as a full
+transfer) over UDP and TCP, and applies TSIG-signed dynamic updates
+(prerequisites, adds and deletes) the way BIND does. The TSIG key is read
+from a BIND style key file, the format parse_key_file expects:
+
+    key "bench-key" {
+        algorithm hmac-sha256;
+        secret "c2VjcmV0...";
+    };
+
+Usage: dnsserver.py [--address 127.0.0.1] [--port 53] [--key FILE] ZONE...
+"""
+
+import argparse
+import base64
+import os
+import re
+import socketserver
+import struct
+import threading
+import time
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdataclass
+import dns.rdataset
+import dns.rdatatype
+import dns.rrset
+import dns.tsig
+import dns.zone
+
+# Most records sent in one zone transfer message
+XFR_CHUNK = 200
+
+
+def write_key_file(path, name='bench-key', algorithm='hmac-sha256'):
+    """ Create a BIND style key file with a random secret, returning (name, secret) """
+    secret = base64.b64encode(os.urandom(32)).decode('ascii')
+    with open(path, 'w') as out:
+        out.write('key "' + name + '" {\n\talgorithm ' + algorithm + ';\n\tsecret "' +
+                  secret + '";\n};\n')
+    return name, secret
+
+def read_key_file(path):
+    """ Return (name, algorithm, secret) from a BIND style key file """
+    with open(path) as key_file:
+        text = key_file.read()
+    name = re.search(r'key\s+"?([^"\s{]+)"?', text).group(1)
+    algorithm = re.search(r'algorithm\s+([^;\s]+)', text).group(1)
+    secret = re.search(r'secret\s+"([^"]+)"', text).group(1)
+    return name, algorithm, secret
+
+def make_keyring(name, secret):
+    """ Return a server keyring accepting the key with whatever algorithm the client uses """
+    return {dns.name.from_text(name): base64.b64decode(secret)}
+
+def empty_zone(origin, serial=1):
+    """ Return a zone with just SOA and NS records """
+    return dns.zone.from_text('@ 3600 IN SOA ns1 hostmaster ' + str(serial) +
+                              ' 3600 600 86400 300\n@ 3600 IN NS ns1\n', origin,
+                              relativize=False)
+
+
+class StandInServer(object):
+    """
+    In-memory authoritative server for a set of zones
+    """
+
+    def __init__(self, zones, address='127.0.0.1', port=53, keyring=None, latency=0.0):
+        self.zones = dict((dns.name.from_text(str(z.origin)), z) for z in zones)
+        self.address = address
+        self.port = port
+        self.keyring = keyring
+        self.latency = latency
+        self.queries = 0
+        self.updates = 0
+        self._lock = threading.Lock()
+        self._servers = []
+
+    def _zone_for(self, name):
+        """ Return the zone holding name (longest match), or None """
+        best = None
+        for origin, zone in self.zones.items():
+            if name.is_subdomain(origin) and (best is None or len(origin) > len(best.origin)):
+                best = zone
+        return best
+
+    def handle(self, wire, tcp=False):
+        """ Return list of response messages (wire format) for a request """
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            request = dns.message.from_wire(wire, keyring=self.keyring)
+        except (dns.tsig.BadSignature, dns.tsig.BadTime, dns.message.UnknownTSIGKey):
+            # Can't sign a reply with an unknown or mismatched key, so send it bare
+            response = dns.message.Message(id=struct.unpack('!H', wire[:2])[0])
+            response.flags = dns.flags.QR
+            response.set_rcode(dns.rcode.NOTAUTH)
+            return [response.to_wire()]
+        except dns.exception.DNSException:
+            return []
+        if request.opcode() == dns.opcode.UPDATE:
+            return [self.update(request).to_wire()]
+        self.queries += 1
+        question = request.question[0]
+        if question.rdtype in (dns.rdatatype.AXFR, dns.rdatatype.IXFR) and tcp:
+            return self.transfer(request)
+        return [self.query(request).to_wire(max_size=65535 if tcp else 512)]
+
+    def query(self, request):
+        """ Answer a normal query """
+        response = dns.message.make_response(request)
+        response.flags |= dns.flags.AA
+        question = request.question[0]
+        zone = self._zone_for(question.name)
+        if zone is None:
+            response.set_rcode(dns.rcode.REFUSED)
+            return response
+        with self._lock:
+            name, seen = question.name, set()
+            while name not in seen:
+                seen.add(name)
+                node = zone.get_node(name)
+                if node is None:
+                    if name == question.name:
+                        response.set_rcode(dns.rcode.NXDOMAIN)
+                    break
+                rdataset = node.get_rdataset(zone.rdclass, question.rdtype)
+                cname = node.get_rdataset(zone.rdclass, dns.rdatatype.CNAME)
+                if rdataset is None and cname is not None and \
+                        question.rdtype != dns.rdatatype.CNAME:
+                    rdataset, target = cname, cname[0].target
+                else:
+                    target = None
+                if rdataset is not None:
+                    rrset = dns.rrset.RRset(name, zone.rdclass, rdataset.rdtype)
+                    rrset.update(rdataset)
+                    response.answer.append(rrset)
+                if target is None or not target.is_subdomain(zone.origin):
+                    break
+                name = target
+        return response
+
+    def transfer(self, request):
+        """
+        Answer AXFR (or IXFR, with a full transfer) as one or more messages
+        (wire format), signed as a TSIG sequence if the request was signed
+        """
+        question = request.question[0]
+        zone = self.zones.get(question.name)
+        if zone is None:
+            response = dns.message.make_response(request)
+            response.set_rcode(dns.rcode.NOTAUTH)
+            return [response.to_wire()]
+        with self._lock:
+            soa = dns.rrset.RRset(zone.origin, zone.rdclass, dns.rdatatype.SOA)
+            soa.update(zone.get_rdataset(zone.origin, 'SOA'))
+            rrsets = [soa]
+            for name, rdataset in zone.iterate_rdatasets():
+                if rdataset.rdtype != dns.rdatatype.SOA:
+                    rrset = dns.rrset.RRset(name, zone.rdclass, rdataset.rdtype)
+                    rrset.update(rdataset)
+                    rrsets.append(rrset)
+            rrsets.append(soa)
+        responses, tsig_ctx = [], None
+        for start in range(0, len(rrsets), XFR_CHUNK):
+            response = dns.message.make_response(request)
+            response.flags |= dns.flags.AA
+            response.answer = rrsets[start:start + XFR_CHUNK]
+            responses.append(response.to_wire(multi=True, tsig_ctx=tsig_ctx))
+            tsig_ctx = response.tsig_ctx
+        return responses
+
+    def update(self, request):
+        """ Apply a dynamic update (all or nothing) """
+        response = dns.message.make_response(request)
+        if self.keyring and not request.had_tsig:
+            response.set_rcode(dns.rcode.REFUSED)
+            return response
+        zone = self.zones.get(request.zone[0].name)
+        if zone is None:
+            response.set_rcode(dns.rcode.NOTAUTH)
+            return response
+        with self._lock:
+            for rrset in request.prerequisite:
+                exists = zone.get_node(rrset.name) is not None
+                if rrset.deleting == dns.rdataclass.NONE and exists:
+                    response.set_rcode(dns.rcode.YXDOMAIN)
+                    return response
+                if rrset.deleting == dns.rdataclass.ANY and not exists:
+                    response.set_rcode(dns.rcode.NXDOMAIN)
+                    return response
+            with zone.writer() as txn:
+                for rrset in request.update:
+                    if rrset.deleting == dns.rdataclass.ANY and rrset.rdtype == dns.rdatatype.ANY:
+                        if txn.name_exists(rrset.name) and rrset.name != zone.origin:
+                            txn.delete(rrset.name)
+                    elif rrset.deleting == dns.rdataclass.ANY:
+                        if txn.get(rrset.name, rrset.rdtype):
+                            txn.delete(rrset.name, rrset.rdtype)
+                    elif rrset.deleting == dns.rdataclass.NONE:
+                        existing = txn.get(rrset.name, rrset.rdtype)
+                        for rdata in rrset:
+                            if existing and rdata in existing:
+                                txn.delete_exact(rrset.name, dns.rdataset.from_rdata(
+                                    existing.ttl, rdata))
+                                existing = txn.get(rrset.name, rrset.rdtype)
+                    else:
+                        for rdata in rrset:
+                            txn.add(rrset.name, dns.rdataset.from_rdata(rrset.ttl, rdata))
+                soa = txn.get(zone.origin, 'SOA')
+                txn.replace(zone.origin, dns.rdataset.from_rdata(
+                    soa.ttl, soa[0].replace(serial=soa[0].serial + 1)))
+            self.updates += 1
+        return response
+
+    def start(self):
+        """ Serve UDP and TCP in background threads """
+        server = self
+
+        class TCPHandler(socketserver.BaseRequestHandler):
+            """
+            Length-prefixed DNS messages, several per connection. Each is answered
+            in its own thread (as BIND does), so pipelined queries overlap.
+            """
+            def respond(self, wire, lock):
+                out = b''.join(struct.pack('!H', len(r)) + r
+                               for r in server.handle(wire, tcp=True))
+                with lock:
+                    try:
+                        self.request.sendall(out)
+                    except OSError:
+                        pass
+
+            def handle(self):
+                lock = threading.Lock()
+                while True:
+                    length = self.request.recv(2)
+                    if len(length) < 2:
+                        return
+                    length = struct.unpack('!H', length)[0]
+                    wire = b''
+                    while len(wire) < length:
+                        data = self.request.recv(length - len(wire))
+                        if not data:
+                            return
+                        wire += data
+                    threading.Thread(target=self.respond, args=(wire, lock),
+                                     daemon=True).start()
+
+        class UDPHandler(socketserver.BaseRequestHandler):
+            """ One DNS message per datagram """
+            def handle(self):
+                wire, sock = self.request
+                for out in server.handle(wire):
+                    sock.sendto(out, self.client_address)
+
+        for base, handler in ((socketserver.ThreadingTCPServer, TCPHandler),
+                              (socketserver.ThreadingUDPServer, UDPHandler)):
+            base.allow_reuse_address = True
+            base.daemon_threads = True
+            instance = base((self.address, self.port), handler)
+            threading.Thread(target=instance.serve_forever, daemon=True).start()
+            self._servers.append(instance)
+
+    def stop(self):
+        """ Stop serving """
+        for instance in self._servers:
+            instance.shutdown()
+            instance.server_close()
+        self._servers = []
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in authoritative DNS server')
+    parser.add_argument('zones', nargs='+', help='zone names to serve (created empty)')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=53)
+    parser.add_argument('--key', help='BIND style TSIG key file required for updates')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every request')
+    args = parser.parse_args()
+
+    keyring = None
+    if args.key:
+        name, _, secret = read_key_file(args.key)
+        keyring = make_keyring(name, secret)
+    server = StandInServer([empty_zone(z) for z in args.zones], args.address, args.port,
+                           keyring, args.latency)
+    server.start()
+    print('Serving ' + ', '.join(args.zones) + ' on ' + args.address + ':' + str(args.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+"""
+Simple HTTP load test: concurrent clients (each with a keep-alive connection)
+request a URL for a fixed time, then requests/second and latency percentiles
+are reported as JSON.
+
+Usage: loadtest.py URL [-c CONCURRENCY] [-d SECONDS] [-u USER -p PASSWORD] [-k]
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(values, pct):
+    """ Return the pct percentile of sorted values """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def client(url, headers, context, deadline, latencies, errors):
+    """ Request url repeatedly until deadline, recording latencies """
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    conn = None
+    while time.monotonic() < deadline:
+        if conn is None:
+            if parts.scheme == 'https':
+                conn = http.client.HTTPSConnection(parts.netloc, context=context, timeout=30)
+            else:
+                conn = http.client.HTTPConnection(parts.netloc, timeout=30)
+        start = time.monotonic()
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors.append(response.status)
+            if response.getheader('Connection', '').lower() == 'close':
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException) as err:
+            errors.append(str(err))
+            conn.close()
+            conn = None
+            continue
+        latencies.append(time.monotonic() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP load test')
+    parser.add_argument('url')
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('-d', '--duration', type=float, default=10)
+    parser.add_argument('-u', '--user')
+    parser.add_argument('-p', '--password', default='')
+    parser.add_argument('-k', '--insecure', action='store_true',
+                        help='do not verify the server certificate')
+    args = parser.parse_args()
+
+    headers = {}
+    if args.user:
+        credentials = (args.user + ':' + args.password).encode('utf-8')
+        headers['Authorization'] = 'Basic ' + base64.b64encode(credentials).decode('ascii')
+    context = ssl.create_default_context()
+    if args.insecure:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+    latencies, errors = [], []
+    deadline = time.monotonic() + args.duration
+    start = time.monotonic()
+    threads = [threading.Thread(target=client,
+                                args=(args.url, headers, context, deadline, latencies, errors))
+               for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    latencies.sort()
+    print(json.dumps({
+        'url': args.url,
+        'concurrency': args.concurrency,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'latency_ms': dict((name, round(percentile(latencies, pct) * 1000, 2)
+                            if latencies else None)
+                           for name, pct in (('p50', 50), ('p95', 95), ('p99', 99))),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
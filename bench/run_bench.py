@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+"""
+Benchmark the application end to end, without a real DNS server or PAM.
+
+A stand-in authoritative server (dnsserver.py) is started on the local host
+and seeded with records, the application is configured to manage it with a
+freshly generated TSIG key (PYBINDER_SETTINGS), and PAM is replaced with a
+stub that accepts the benchmark user. The real Flask app is then driven
+through each scenario by concurrent clients, and requests/second and latency
+percentiles (milliseconds) are reported per scenario as JSON, so runs can be
+compared between commits.
+
+pybinder talks to the DNS server on port 53, so the stand-in listens there
+(run as root, or in a container). Run from anywhere; the repository root is
+used as the working directory, as with run.py.
+
+Usage: run_bench.py [-c CONCURRENCY] [-n REQUESTS] [-s SCENARIO ...] [--set KEY=VALUE ...]
+"""
+
+import argparse
+import ast
+import base64
+import ipaddress
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import dns.rdataset
+import dns.name
+import dns.reversename
+
+from dnsserver import StandInServer, empty_zone, make_keyring, write_key_file
+from loadtest import percentile
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+ZONE = 'bench.test'
+USER = 'bench'
+PASSWORD = 'bench-password'
+# Seeded hosts (searched) live in 10.99.0.0/22, everything added by the benchmark above that
+SEED_NET = '10.99.{}.{}'
+SEED_HOSTS = 1000
+FIRST_ADDRESS = ipaddress.ip_address('10.99.4.1')
+SCENARIOS = ('search', 'multi-search', 'add', 'alias', 'range-add-10', 'range-add-100',
+             'range-add-1000', 'delete', 'history')
+
+
+class StubPAM(object):
+    """
+    Stand-in for pam.pam: accepts USER/PASSWORD after a fixed delay, so the
+    real SystemAuth (user list, credential cache, metrics) is still exercised
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def authenticate(self, user, pwd, service='login'):
+        """ Check credentials like PAM would """
+        if self.latency:
+            time.sleep(self.latency)
+        return user == USER and pwd == PASSWORD
+
+
+def seed(server, hosts=SEED_HOSTS):
+    """ Add hosts (A and PTR records) to the stand-in zones """
+    for index in range(hosts):
+        name = 'seed' + str(index) + '.' + ZONE + '.'
+        address = SEED_NET.format(index // 250, index % 250 + 1)
+        ptr = dns.reversename.from_address(address)
+        with server.zones[dns.name.from_text(ZONE)].writer() as txn:
+            txn.add(dns.name.from_text(name), dns.rdataset.from_text('IN', 'A', 3600, address))
+        with server.zones[ptr.parent()].writer() as txn:
+            txn.add(ptr, dns.rdataset.from_text('IN', 'PTR', 3600, name))
+
+def write_settings(directory, key_file, overrides):
+    """ Write the PYBINDER_SETTINGS file pointing the app at the stand-in server """
+    settings = {
+        'SERVER': '127.0.0.1',
+        'FORWARD_ZONE': ZONE,
+        'ALLOWED_DOMAINS': (),
+        'SUBNETS': ('10.99.0.0/16',),
+        'USERS': (USER,),
+        'DDNS_KEY': key_file,
+        'DDNS_KEY_ALGORITHM': 'hmac-sha256',
+        'WTF_CSRF_ENABLED': False,
+        'HISTORY_DB': os.path.join(directory, 'history.db'),
+    }
+    settings.update(overrides)
+    path = os.path.join(directory, 'settings.py')
+    with open(path, 'w') as out:
+        for name, value in sorted(settings.items()):
+            out.write(name + ' = ' + repr(value) + '\n')
+    return path
+
+
+class Scenario(object):
+    """
+    A named benchmark step: request(client, number) makes one request (number
+    is unique within the run) and returns True if it succeeded
+    """
+
+    def __init__(self, name, request, count):
+        self.name = name
+        self.request = request
+        self.count = count
+
+
+class Bench(object):
+    """
+    Scenario requests against the app's test client, sharing a counter so
+    records added by one scenario can be deleted by a later one
+    """
+
+    def __init__(self, app, headers):
+        self.app = app
+        self.headers = headers
+        self.added = []
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def reserve(self, count=1):
+        """ Return the first of count fresh addresses (after the seeded hosts), and a number """
+        with self._lock:
+            number = self._next
+            self._next += count
+        return str(FIRST_ADDRESS + number), number
+
+    def ok(self, response):
+        """ Return True if response is a success (form views show errors with status 200) """
+        return response.status_code < 400 and b'<title>Error - ' not in response.data
+
+    def search(self, client, number):
+        """ Search for a seeded host through the API """
+        response = client.get('/api/search/seed' + str(number % SEED_HOSTS) + '.' + ZONE,
+                              headers=self.headers)
+        return self.ok(response)
+
+    def multi_search(self, client, number):
+        """ Search for several names and addresses through the search form """
+        terms = ['seed' + str((number * 10 + i) % SEED_HOSTS) for i in range(8)]
+        terms += [SEED_NET.format(0, number % 250 + 1), 'missing' + str(number)]
+        response = client.post('/search', data={'search_terms': ' '.join(terms)},
+                               headers=self.headers)
+        return self.ok(response)
+
+    def add(self, client, number):
+        """ Add a host through the add form """
+        address, number = self.reserve()
+        name = 'add' + str(number)
+        response = client.post('/add', data={'name': name, 'ipaddr': address},
+                               headers=self.headers)
+        if self.ok(response):
+            with self._lock:
+                self.added.append(name)
+            return True
+        return False
+
+    def alias(self, client, number):
+        """ Add an alias of a seeded host through the alias form """
+        response = client.post('/alias', data={'alias': 'alias' + str(number),
+                                               'real_name': 'seed' + str(number % SEED_HOSTS)},
+                               headers=self.headers)
+        return self.ok(response)
+
+    def range_add(self, num):
+        """ Return a request submitting a range add of num entries and waiting for it """
+        def request(client, number):
+            address, _ = self.reserve(num)
+            response = client.post('/api/range', headers=self.headers, json={
+                'action': 'add', 'name': 'range' + str(number) + '-' + str(num) + '-1',
+                'address': address, 'num': num})
+            if response.status_code != 202:
+                return False
+            status = response.get_json()['status']
+            while True:
+                job = client.get(status, headers=self.headers).get_json()
+                if job['status'] not in ('queued', 'running'):
+                    return job['status'] == 'done'
+                time.sleep(0.005)
+        return request
+
+    def delete(self, client, number):
+        """ Delete a host added by the add scenario through the delete form """
+        with self._lock:
+            name = self.added.pop() if self.added else 'missing' + str(number)
+        response = client.post('/delete', data={'entry': name}, headers=self.headers)
+        return self.ok(response)
+
+    def history(self, client, number):
+        """ Show the history page """
+        return self.ok(client.get('/history', headers=self.headers))
+
+    def scenarios(self, requests, range_jobs):
+        """ Return the Scenario objects, by name """
+        scenarios = [Scenario('search', self.search, requests),
+                     Scenario('multi-search', self.multi_search, requests),
+                     Scenario('add', self.add, requests),
+                     Scenario('alias', self.alias, requests)]
+        for num in (10, 100, 1000):
+            scenarios.append(Scenario('range-add-' + str(num), self.range_add(num), range_jobs))
+        scenarios += [Scenario('delete', self.delete, requests),
+                      Scenario('history', self.history, requests)]
+        return dict((s.name, s) for s in scenarios)
+
+    def run(self, scenario, concurrency):
+        """ Run scenario with concurrency clients, returning its results """
+        latencies, errors = [], []
+        numbers = iter(range(scenario.count))
+        lock = threading.Lock()
+
+        def worker():
+            client = self.app.test_client()
+            while True:
+                with lock:
+                    number = next(numbers, None)
+                if number is None:
+                    return
+                start = time.perf_counter()
+                try:
+                    if not scenario.request(client, number):
+                        errors.append(number)
+                except Exception as err:  # pylint: disable=broad-except
+                    errors.append(repr(err))
+                latencies.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        return {
+            'requests': len(latencies),
+            'errors': len(errors),
+            'seconds': round(elapsed, 3),
+            'throughput': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        }
+
+
+def parse_override(text):
+    """ Parse KEY=VALUE (VALUE a Python literal, or else a string) """
+    name, _, value = text.partition('=')
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name.strip(), value
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the application against stand-in '
+                                     'DNS and PAM')
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+                        help='concurrent clients (default 8)')
+    parser.add_argument('-n', '--requests', type=int, default=500,
+                        help='requests per scenario (default 500)')
+    parser.add_argument('-j', '--range-jobs', type=int, default=8,
+                        help='jobs per range-add scenario (default 8)')
+    parser.add_argument('-s', '--scenario', action='append', choices=SCENARIOS,
+                        help='scenario to run (repeat for several; default all, in order)')
+    parser.add_argument('--dns-latency', type=float, default=0.0,
+                        help='seconds the stand-in DNS server adds to each request')
+    parser.add_argument('--pam-latency', type=float, default=0.05,
+                        help='seconds each stub PAM check takes (default 0.05)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='override an application setting, e.g. --set SEARCH_CACHE_TTL=0')
+    args = parser.parse_args()
+
+    os.chdir(REPO)
+    sys.path.insert(0, REPO)
+    directory = tempfile.mkdtemp(prefix='pybinder-bench-')
+    key_file = os.path.join(directory, 'bench.key')
+    key_name, secret = write_key_file(key_file)
+    zones = [empty_zone(ZONE)] + [empty_zone(str(octet) + '.99.10.in-addr.arpa')
+                                  for octet in range(256)]
+    server = StandInServer(zones, keyring=make_keyring(key_name, secret),
+                           latency=args.dns_latency)
+    seed(server)
+    server.start()
+
+    overrides = dict(parse_override(o) for o in args.set)
+    os.environ['PYBINDER_SETTINGS'] = write_settings(directory, key_file, overrides)
+    from app import app, api, views
+    api.system_auth.auth = views.system_auth.auth = StubPAM(args.pam_latency)
+
+    credentials = base64.b64encode((USER + ':' + PASSWORD).encode()).decode('ascii')
+    bench = Bench(app, {'Authorization': 'Basic ' + credentials})
+    scenarios = bench.scenarios(args.requests, args.range_jobs)
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        results[name] = bench.run(scenarios[name], args.concurrency)
+    server.stop()
+    print(json.dumps({'concurrency': args.concurrency, 'settings': overrides,
+                      'dns': {'queries': server.queries, 'updates': server.updates},
+                      'scenarios': results}, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
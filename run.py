@@ -1,15 +1,11 @@
 #!/usr/bin/python3
-import logging
-from app import app
+# Development server (single process, debugger enabled). Use serve.py in production.
+from app import app, add_log_handler
 
 
 if __name__ == '__main__':
-    # replace these with the name and location of your SSL certificate and private key
-#    context = ('mycert.pem', 'private.key')
-    context = ('cert.crt', 'privkey.key')
-    if 'LOGFILE' in app.config:
-        handler = logging.FileHandler(app.config['LOGFILE'])
-        handler.setLevel(logging.INFO)
-        handler.setFormatter(logging.Formatter(fmt='%(asctime)s : %(message)s'))
-        app.logger.addHandler(handler)
+    # set SSL_CERT and SSL_KEY in config.local to the name and location of your
+    # SSL certificate and private key
+    context = (app.config.get('SSL_CERT', 'cert.crt'), app.config.get('SSL_KEY', 'privkey.key'))
+    add_log_handler()
     app.run(host='0.0.0.0', port=5353, debug=True, ssl_context=context)
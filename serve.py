@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+"""
+Production server: runs the app under gunicorn, with WORKERS processes of
+THREADS threads each (see config.local). The app, pybinder modules and DDNS
+key are loaded once before the workers are forked.
+
+Send SIGHUP to the master process to gracefully replace the workers (for
+example after renewing the certificate), and SIGTERM to shut down.
+"""
+
+import multiprocessing
+from gunicorn.app.base import BaseApplication
+from app import app, add_log_handler, start_background_services
+
+
+def post_fork(server, worker): # pylint: disable=unused-argument
+    """
+    Set up each worker: log handler and background threads are per process
+    """
+    add_log_handler()
+    start_background_services()
+
+
+class PybinderServer(BaseApplication):
+    """
+    Gunicorn application serving the (already loaded) Flask app
+    """
+
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+if __name__ == '__main__':
+    options = {
+        'bind': app.config.get('BIND', '0.0.0.0:5353'),
+        'workers': app.config.get('WORKERS', multiprocessing.cpu_count() * 2 + 1),
+        'threads': app.config.get('THREADS', 8),
+        'worker_class': 'gthread',
+        'timeout': app.config.get('WORKER_TIMEOUT', 120),
+        'graceful_timeout': app.config.get('GRACEFUL_TIMEOUT', 30),
+        'certfile': app.config.get('SSL_CERT', 'cert.crt'),
+        'keyfile': app.config.get('SSL_KEY', 'privkey.key'),
+        'pidfile': app.config.get('PIDFILE'),
+        'preload_app': True,
+        'post_fork': post_fork,
+    }
+    PybinderServer(app, options).run()
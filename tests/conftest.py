@@ -0,0 +1,81 @@
+"""
+Test setup: the application is pointed (through PYBINDER_SETTINGS, as in the
+benchmark) at a stand-in DNS server (bench/dnsserver.py) holding the test
+zones, and PAM is replaced with a stub. The stand-in listens on port 53, the
+port pybinder uses, so run the tests as root (or in a container):
+
+    sudo python3 -m pytest tests
+"""
+
+import base64
+import os
+import sys
+import tempfile
+import dns.name
+import dns.rdataset
+import dns.reversename
+import pytest
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(REPO, 'bench'))
+sys.path.insert(0, REPO)
+from dnsserver import StandInServer, empty_zone, make_keyring, write_key_file
+from run_bench import StubPAM, ZONE, USER, PASSWORD, write_settings
+
+# A second managed zone, for names outside FORWARD_ZONE
+OTHER_ZONE = 'other.test'
+REVERSE_ZONES = [str(octet) + '.99.10.in-addr.arpa' for octet in range(256)]
+
+DIRECTORY = tempfile.mkdtemp(prefix='pybinder-test-')
+KEY_FILE = os.path.join(DIRECTORY, 'test.key')
+KEY_NAME, SECRET = write_key_file(KEY_FILE)
+SERVER = StandInServer([empty_zone(ZONE), empty_zone(OTHER_ZONE)] +
+                       [empty_zone(zone) for zone in REVERSE_ZONES],
+                       keyring=make_keyring(KEY_NAME, SECRET))
+SERVER.start()
+os.environ['PYBINDER_SETTINGS'] = write_settings(DIRECTORY, KEY_FILE, {
+    'ALLOWED_DOMAINS': (ZONE, OTHER_ZONE), 'SEARCH_CACHE_TTL': 0})
+os.chdir(REPO)
+
+
+def pytest_unconfigure(config):
+    """ Stop the stand-in server """
+    SERVER.stop()
+
+
+def add_records(name, rdtype, *values, ttl=3600):
+    """ Add records to the stand-in server's zone holding name, behind the app's back """
+    name = dns.name.from_text(name)
+    zone = next(z for origin, z in SERVER.zones.items() if name.is_subdomain(origin))
+    with zone.writer() as txn:
+        txn.add(name, dns.rdataset.from_text('IN', rdtype, ttl, *values))
+
+def add_host(name, address, ttl=3600):
+    """ Add an A record and its PTR record to the stand-in server """
+    add_records(name + '.', 'A', address, ttl=ttl)
+    add_records(dns.reversename.from_address(address).to_text(), 'PTR', name + '.', ttl=ttl)
+
+def server_records(name, rdtype):
+    """ Return [(ttl, value)] of the stand-in server's rdtype records at name """
+    name = dns.name.from_text(name)
+    zone = next(z for origin, z in SERVER.zones.items() if name.is_subdomain(origin))
+    rdataset = zone.get_rdataset(name, rdtype)
+    if rdataset is None:
+        return []
+    return sorted((rdataset.ttl, r.to_text().rstrip('.')) for r in rdataset)
+
+
+@pytest.fixture(scope='session')
+def app():
+    """ The application, with PAM replaced by a stub """
+    from app import app as application, api, views
+    api.system_auth.auth = views.system_auth.auth = StubPAM()
+    return application
+
+@pytest.fixture
+def client(app):
+    """ Test client, with credentials for the test user """
+    client = app.test_client()
+    credentials = base64.b64encode((USER + ':' + PASSWORD).encode()).decode('ascii')
+    client.environ_base['HTTP_AUTHORIZATION'] = 'Basic ' + credentials
+    return client
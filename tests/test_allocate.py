@@ -0,0 +1,58 @@
+"""
+Free address allocation (app/allocate.py, /api/allocate)
+"""
+
+import ipaddress
+from conftest import ZONE, add_host
+
+
+def test_taken_address_is_a_conflict(client):
+    response = client.post('/api/allocate', json={'subnet': '10.99.50.0/24'})
+    assert response.status_code == 200
+    address = response.get_json()['addresses'][0]
+    # Added by someone else (another worker) after the bitmap was loaded
+    add_host('taken1.' + ZONE, address)
+    response = client.post('/api/allocate', json={'subnet': '10.99.50.0/24',
+                                                  'name': 'alloc1.' + ZONE})
+    assert response.status_code == 409
+    assert response.get_json()['addresses'] == [address]
+
+
+def bitmap(network, used=(), reserved=()):
+    """ Return a loaded SubnetBitmap of network with the used addresses marked """
+    from app.allocate import SubnetBitmap
+    result = SubnetBitmap(ipaddress.ip_network(network),
+                          reserved=[ipaddress.ip_network(r) for r in reserved])
+    result.load(0)
+    for ip in used:
+        result.mark(ip)
+    return result
+
+def test_find_free_skips_used_and_reserved(app):
+    subnet = bitmap('10.1.0.0/24', used=['10.1.0.1', '10.1.0.3'], reserved=['10.1.0.4/31'])
+    assert subnet.find_free(3) == ['10.1.0.2', '10.1.0.6', '10.1.0.7']
+    # The network and broadcast addresses are never handed out
+    assert subnet.find_free(300)[-1] == '10.1.0.254'
+    assert len(subnet.find_free(300)) == subnet.free_count() == 256 - 2 - 2 - 2
+
+def test_find_free_across_words(app):
+    subnet = bitmap('10.1.0.0/24', used=['10.1.0.' + str(i) for i in range(1, 130)])
+    assert subnet.find_free(2) == ['10.1.0.130', '10.1.0.131']
+    assert subnet.find_free(2, start=200, end=201) == ['10.1.0.200', '10.1.0.201']
+    assert subnet.find_free(5, start=254) == ['10.1.0.254']
+
+def test_find_free_take(app):
+    subnet = bitmap('10.1.0.0/29')
+    assert subnet.find_free(2, take=True) == ['10.1.0.1', '10.1.0.2']
+    assert subnet.find_free(2, take=True) == ['10.1.0.3', '10.1.0.4']
+    assert subnet.find_free(9) == ['10.1.0.5', '10.1.0.6']
+    subnet.mark('10.1.0.2', used=False)
+    assert subnet.find_free(1) == ['10.1.0.2']
+
+def test_load_keeps_marks_made_during_transfer(app):
+    subnet = bitmap('10.1.0.0/29')
+    subnet.begin_load()
+    subnet.mark('10.1.0.1')
+    subnet.find_free(1, take=True)
+    subnet.load(1 << 5)
+    assert subnet.find_free(9) == ['10.1.0.3', '10.1.0.4', '10.1.0.6']
@@ -0,0 +1,108 @@
+"""
+Batch changes (app/batch.py) against the stand-in DNS server
+"""
+
+import dns.message
+import dns.rcode
+import pytest
+from conftest import SERVER, ZONE, add_host, add_records, server_records
+
+
+@pytest.fixture
+def fail_updates(monkeypatch):
+    """ Return a function making the stand-in server fail updates of a zone """
+    update = SERVER.update
+    def fail(origin):
+        def failing_update(request):
+            if request.zone[0].name.to_text().rstrip('.') == origin:
+                response = dns.message.make_response(request)
+                response.set_rcode(dns.rcode.SERVFAIL)
+                return response
+            return update(request)
+        monkeypatch.setattr(SERVER, 'update', failing_update)
+    return fail
+
+
+def test_adds_forward_and_reverse_records(app, client):
+    response = client.post('/api/batch', json=[
+        {'op': 'add', 'name': 'b1', 'address': '10.99.10.1'},
+        {'op': 'add', 'name': 'b2', 'address': '10.99.10.2'}])
+    assert response.status_code == 200
+    assert 'absent' not in response.get_json()['results'][0]['message']
+    assert server_records('b1.' + ZONE, 'A') == [(3600, '10.99.10.1')]
+    assert server_records('2.10.99.10.in-addr.arpa', 'PTR') == [(3600, 'b2.' + ZONE)]
+
+def test_conflict_with_existing_record_fails_only_that_operation(app, client):
+    add_host('b3.' + ZONE, '10.99.10.3')
+    response = client.post('/api/batch', json=[
+        {'op': 'add', 'name': 'b3', 'address': '10.99.10.4'},
+        {'op': 'add', 'name': 'b5', 'address': '10.99.10.5'}])
+    assert response.status_code == 400
+    results = response.get_json()['results']
+    assert len(results) == 1 and results[0]['index'] == 0
+    assert 'already exists' in results[0]['message']
+    assert server_records('b3.' + ZONE, 'A') == [(3600, '10.99.10.3')]
+    assert server_records('b5.' + ZONE, 'A') == [(3600, '10.99.10.5')]
+
+@pytest.mark.parametrize('operations', [
+    # The same name twice
+    [{'op': 'add', 'name': 'b6', 'address': '10.99.10.6'},
+     {'op': 'add', 'name': 'b6', 'address': '10.99.10.7'}],
+    # The same address twice
+    [{'op': 'add', 'name': 'b8', 'address': '10.99.10.8'},
+     {'op': 'add', 'name': 'b9', 'address': '10.99.10.8'}],
+    # An address another operation deletes
+    [{'op': 'delete', 'entry': '10.99.10.9'},
+     {'op': 'add', 'name': 'b10', 'address': '10.99.10.9'}],
+])
+def test_batch_conflicting_with_itself_is_rejected(app, client, operations):
+    response = client.post('/api/batch', json=operations)
+    assert response.status_code == 400
+    assert 'both change' in response.get_json()['message']
+    for oper in operations:
+        if oper['op'] == 'add':
+            assert server_records(oper['name'] + '.' + ZONE, 'A') == []
+
+def test_duplicates_reported_in_request_order(app, client):
+    response = client.post('/api/batch', json=[
+        {'op': 'add', 'name': 'h1', 'address': '10.99.10.15'},
+        {'op': 'add', 'name': 'h1', 'address': '10.99.10.16'},
+        {'op': 'add', 'name': 'h2', 'address': '10.99.10.16'}])
+    assert response.status_code == 400
+    assert response.get_json()['message'].startswith('Error: Operations 0 and 1 both change h1.')
+    assert server_records('h1.' + ZONE, 'A') == []
+    assert server_records('16.10.99.10.in-addr.arpa', 'PTR') == []
+
+def test_failed_replace_restores_records_with_their_ttls(app, client, fail_updates):
+    add_host('r1.' + ZONE, '10.99.31.1', ttl=600)
+    fail_updates('31.99.10.in-addr.arpa')
+    response = client.post('/api/batch', json=[
+        {'op': 'replace', 'name': 'r1', 'address': '10.99.31.2'}])
+    assert response.status_code == 400
+    assert 'were rolled back' in response.get_json()['results'][0]['message']
+    assert server_records('r1.' + ZONE, 'A') == [(600, '10.99.31.1')]
+    assert server_records('1.31.99.10.in-addr.arpa', 'PTR') == [(600, 'r1.' + ZONE)]
+
+def test_failed_name_delete_is_undone(app, client, fail_updates):
+    add_host('r2.' + ZONE, '10.99.32.1', ttl=900)
+    fail_updates('32.99.10.in-addr.arpa')
+    response = client.post('/api/batch', json=[{'op': 'delete', 'entry': 'r2'}])
+    assert response.status_code == 400
+    assert server_records('r2.' + ZONE, 'A') == [(900, '10.99.32.1')]
+
+def test_failed_address_delete_is_undone(app, client, fail_updates):
+    add_host('r3.' + ZONE, '10.99.33.1', ttl=700)
+    fail_updates(ZONE)
+    response = client.post('/api/batch', json=[{'op': 'delete', 'entry': '10.99.33.1'}])
+    assert response.status_code == 400
+    assert server_records('1.33.99.10.in-addr.arpa', 'PTR') == [(700, 'r3.' + ZONE)]
+    assert server_records('r3.' + ZONE, 'A') == [(700, '10.99.33.1')]
+
+def test_delete_keeps_other_record_types(app, client):
+    add_host('r4.' + ZONE, '10.99.34.1')
+    add_records('r4.' + ZONE + '.', 'TXT', '"rack 4"')
+    response = client.post('/api/batch', json=[{'op': 'delete', 'entry': 'r4'}])
+    assert response.status_code == 200
+    assert server_records('r4.' + ZONE, 'A') == []
+    assert server_records('1.34.99.10.in-addr.arpa', 'PTR') == []
+    assert server_records('r4.' + ZONE, 'TXT') == [(3600, '"rack 4"')]
@@ -0,0 +1,25 @@
+"""
+Export targets (app/export.py)
+"""
+
+import ipaddress
+import pytest
+from conftest import ZONE, OTHER_ZONE
+
+
+def test_managed_domains_can_be_exported(app):
+    from app.export import parse_target
+    assert parse_target(ZONE) == (None, ZONE)
+    assert parse_target('Rack1.' + OTHER_ZONE + '.') == (None, 'rack1.' + OTHER_ZONE)
+
+@pytest.mark.parametrize('target', ['example.com', 'test', 'bench.test.example.com'])
+def test_other_domains_are_refused(app, target):
+    from app.export import ExportError, parse_target
+    with pytest.raises(ExportError):
+        parse_target(target)
+
+def test_subnets(app):
+    from app.export import ExportError, parse_target
+    assert parse_target('10.99.1.0/24') == (ipaddress.ip_network('10.99.1.0/24'), None)
+    with pytest.raises(ExportError):
+        parse_target('10.98.0.0/24')
@@ -0,0 +1,77 @@
+"""
+Change history (app/history.py)
+"""
+
+import pytest
+from conftest import ZONE, USER
+
+
+def test_managers_keep_no_history(app):
+    from app.functions import create_manager
+    manager = create_manager(USER)
+    manager.add_record('history1.' + ZONE, ['10.99.40.1'])
+    manager.delete_record('history1.' + ZONE)
+    assert not manager.get_history()
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(app, request, tmp_path, monkeypatch):
+    """ A history store of each kind, holding transactions 1 to 10 made at times 1 to 10 """
+    from app import history
+    if request.param == 'memory':
+        result = history.MemoryHistoryStore()
+    else:
+        result = history.SQLiteHistoryStore(str(tmp_path / 'history.db'))
+    clock = iter(range(1, 100))
+    monkeypatch.setattr(history.time, 'time', lambda: next(clock))
+    for number in range(1, 11):
+        result.append('alice', 'delete' if number % 3 == 0 else 'add',
+                      'host' + str(number % 4), ['10.0.0.' + str(number % 2)], ['done'])
+        result.append('bob', 'add', 'host' + str(number), [], ['done'])
+    return result
+
+def times(entries):
+    """ Return the (fake) creation times of entries """
+    return [entry['time'] for entry in entries]
+
+def pages(store, **filters):
+    """ Return every page of alice's matching transactions, walking the cursors """
+    result, cursor = [], None
+    while True:
+        entries, cursor = store.page('alice', limit=3, before=cursor, **filters)
+        result.append(times(entries))
+        if cursor is None:
+            return result
+
+def test_pages_walk_back_from_newest(store):
+    assert pages(store) == [[19, 17, 15], [13, 11, 9], [7, 5, 3], [1]]
+
+def test_exact_last_page_has_no_cursor(store):
+    entries, cursor = store.page('alice', limit=10)
+    assert len(entries) == 10 and cursor is None
+
+def test_filters(store):
+    assert pages(store, action='delete') == [[17, 11, 5]]
+    assert pages(store, name='host1') == [[17, 9, 1]]
+    assert pages(store, address='10.0.0.1') == [[17, 13, 9], [5, 1]]
+    assert pages(store, address='10.0.0.1', action='add') == [[13, 9, 1]]
+    assert pages(store, address='10.0.0.9') == [[]]
+
+def test_time_bounds(store):
+    assert pages(store, since=8, until=15) == [[13, 11, 9]]
+    assert pages(store, since=8) == [[19, 17, 15], [13, 11, 9]]
+    assert pages(store, until=6) == [[5, 3, 1]]
+    assert pages(store, since=30) == [[]]
+    assert pages(store, until=1) == [[]]
+
+def test_entries(store):
+    entries, _ = store.page('alice', limit=1)
+    assert entries[0]['action'] == 'add'
+    assert entries[0]['name'] == 'host2'
+    assert entries[0]['addresses'] == ['10.0.0.0']
+    assert entries[0]['answer'] == ['done']
+
+def test_clear(store):
+    store.clear('alice')
+    assert store.page('alice') == ([], None)
+    assert len(store.page('bob', limit=20)[0]) == 10
@@ -0,0 +1,36 @@
+"""
+ETags and 304 Not Modified (app/httpcache.py)
+"""
+
+from conftest import ZONE, OTHER_ZONE
+
+
+def test_search_not_modified(client):
+    response = client.get('/api/search/etag1.' + ZONE)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert etag.startswith('W/')
+    assert response.headers['Cache-Control'].startswith('private, max-age=')
+    response = client.get('/api/search/etag1.' + ZONE, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert not response.data
+
+def test_search_other_etag(client):
+    response = client.get('/api/search/etag1.' + ZONE, headers={'If-None-Match': 'W/"other"'})
+    assert response.status_code == 200
+    assert response.get_json()
+
+def test_export_not_modified_until_zone_changes(client):
+    response = client.get('/api/export/' + OTHER_ZONE)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    response = client.get('/api/export/' + OTHER_ZONE, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    response = client.post('/api/batch', json=[{'op': 'add', 'name': 'etag2.' + OTHER_ZONE,
+                                                'address': '10.99.60.1'}])
+    assert response.status_code == 200
+    response = client.get('/api/export/' + OTHER_ZONE, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert b'etag2.' + OTHER_ZONE.encode() in response.data
@@ -0,0 +1,41 @@
+"""
+Range jobs (app/jobs.py)
+"""
+
+import subprocess
+import sys
+from conftest import ZONE, USER
+
+
+def dead_pid():
+    """ Return the ID of a process that has exited """
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+def test_jobs_of_exited_processes_are_failed(app):
+    from app.jobs import job_queue
+    store = job_queue.store
+    orphan = store.create(USER, 'range-add', 'orphan1.' + ZONE, '10.99.30.1', 4, None)
+    store.update(orphan, status='running', pid=dead_pid())
+    alive = store.create(USER, 'range-add', 'alive1.' + ZONE, '10.99.30.10', 4, None)
+    store.update(alive, status='running')
+    job_queue.start()
+    assert store.get(orphan)['status'] == 'failed'
+    assert store.get(orphan)['error'] == 'worker process exited'
+    assert store.get(alive)['status'] == 'running'
+    store.update(alive, status='done')
+
+def test_bookkeeping_failure_is_logged(app, monkeypatch):
+    from app import jobs
+
+    def fail(*args, **kwargs):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(jobs.history_store, 'append', fail)
+    job_id = jobs.job_queue.store.create(USER, 'range-add', 'job1.' + ZONE, '10.99.30.20', 2,
+                                         None)
+    jobs.job_queue.run(job_id)
+    job = jobs.job_queue.store.get(job_id)
+    assert job['status'] == 'done'
+    assert job['done'] == 2
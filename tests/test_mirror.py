@@ -0,0 +1,63 @@
+"""
+Zone mirror (app/mirror.py) answers, from zones transferred from the stand-in
+DNS server
+"""
+
+import pytest
+from conftest import SERVER, ZONE, OTHER_ZONE, add_host, add_records
+
+REVERSE = '20.99.10.in-addr.arpa'
+
+
+@pytest.fixture(scope='module')
+def mirror(app):
+    from app.mirror import ZoneMirror
+    add_host('y.' + OTHER_ZONE, '10.99.20.7', ttl=300)
+    # Same label in FORWARD_ZONE, which a relative target would wrongly resolve to
+    add_host('y.' + ZONE, '10.99.20.8')
+    add_records('x.' + OTHER_ZONE + '.', 'CNAME', 'y.' + OTHER_ZONE + '.')
+    add_host('a.sub.' + ZONE, '10.99.20.9')
+    add_records('c.' + ZONE + '.', 'CNAME', 'a.sub.' + ZONE + '.')
+    add_records('out.' + ZONE + '.', 'CNAME', 'www.example.com.')
+    add_records('loop1.' + ZONE + '.', 'CNAME', 'loop2.' + ZONE + '.')
+    add_records('loop2.' + ZONE + '.', 'CNAME', 'loop1.' + ZONE + '.')
+    zone_mirror = ZoneMirror([ZONE, OTHER_ZONE, REVERSE], '127.0.0.1', port=SERVER.port,
+                             directory=None)
+    zone_mirror.refresh_all()
+    return zone_mirror
+
+def records(mirror, term):
+    answer = mirror.lookup(term)
+    return None if answer is None else answer.records
+
+def test_address_record(mirror):
+    assert records(mirror, 'y.' + OTHER_ZONE) == ['10.99.20.7']
+    assert mirror.lookup('y.' + OTHER_ZONE).ttl == 300
+
+def test_cname_to_another_zone(mirror):
+    assert records(mirror, 'x.' + OTHER_ZONE) == ['y.' + OTHER_ZONE, '10.99.20.7']
+
+def test_cname_to_multi_label_name(mirror):
+    assert records(mirror, 'c.' + ZONE) == ['a.sub.' + ZONE, '10.99.20.9']
+
+def test_short_name_in_forward_zone(mirror):
+    assert records(mirror, 'c') == ['a.sub.' + ZONE, '10.99.20.9']
+
+def test_cname_out_of_mirrored_zones(mirror):
+    assert records(mirror, 'out.' + ZONE) == ['www.example.com']
+
+def test_cname_loop_is_left_to_live_lookup(mirror):
+    assert mirror.lookup('loop1.' + ZONE) is None
+
+def test_reverse(mirror):
+    assert records(mirror, '10.99.20.7') == ['y.' + OTHER_ZONE]
+    assert records(mirror, '10.99.20.9') == ['a.sub.' + ZONE]
+    assert records(mirror, '10.99.20.99') == []
+
+def test_unmirrored_zone(mirror):
+    assert mirror.lookup('10.99.21.1') is None
+
+def test_changed_name_is_not_answered(mirror):
+    mirror.invalidate('y.' + OTHER_ZONE)
+    assert mirror.lookup('y.' + OTHER_ZONE) is None
+    mirror.refresh_all()
@@ -0,0 +1,60 @@
+"""
+Allow-list matching (app/policy.py)
+"""
+
+import ipaddress
+import pytest
+
+
+@pytest.fixture
+def matcher(app):
+    from app.policy import DomainMatcher
+    return DomainMatcher(['Example.com.', 'lab.example.org'])
+
+@pytest.mark.parametrize('domain', ['example.com', 'EXAMPLE.com.', 'rack1.example.com',
+                                    'a.b.lab.example.org', 'lab.example.org'])
+def test_domain_matches(matcher, domain):
+    assert matcher.match(domain)
+
+@pytest.mark.parametrize('domain', ['com', 'notexample.com', 'example.com.au', 'example.org',
+                                    'other.example.org', 'lab.example.org.uk'])
+def test_domain_does_not_match(matcher, domain):
+    assert not matcher.match(domain)
+
+def test_no_domains(app):
+    from app.policy import DomainMatcher
+    assert not DomainMatcher([]).match('example.com')
+
+
+@pytest.fixture
+def index(app):
+    from app.policy import SubnetIndex
+    # The first two are adjacent and merge into 10.0.0.0/23
+    return SubnetIndex([ipaddress.ip_network(n) for n in
+                        ('10.0.1.0/24', '10.0.0.0/24', '10.2.0.0/24', '10.2.0.128/25',
+                         '2001:db8::/120')])
+
+@pytest.mark.parametrize('ip, expected', [
+    ('10.0.0.0', True), ('10.0.1.255', True), ('10.0.2.0', False), ('9.255.255.255', False),
+    ('10.2.0.200', True), ('10.2.1.0', False), ('2001:db8::ff', True), ('2001:db8::100', False),
+    ('::ffff:10.0.0.1', False)])
+def test_contains(index, ip, expected):
+    assert index.contains(ip) == expected
+
+def test_contains_range(index):
+    assert index.contains_range('10.0.0.250', 10)
+    assert index.contains_range('10.0.1.250', 6)
+    assert not index.contains_range('10.0.1.250', 7)
+    assert not index.contains_range('10.1.0.0', 1)
+
+def test_contains_all(index):
+    assert index.contains_all(['10.2.0.1', '10.0.0.1', '2001:db8::1', '10.0.1.9'])
+    assert index.contains_all([])
+    assert not index.contains_all(['10.0.0.1', '10.1.0.1', '10.2.0.1'])
+    assert not index.contains_all(['10.0.0.1', '2001:db8::1:0'])
+
+def test_no_subnets(app):
+    from app.policy import SubnetIndex
+    index = SubnetIndex([])
+    assert not index.contains('10.0.0.1')
+    assert not index.contains_all(['10.0.0.1'])